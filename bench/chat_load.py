@@ -0,0 +1,281 @@
+"""Drive concurrent /api/chat streams against tetsuocode Web and report latency.
+
+Starts the mock provider (bench/mock_provider.py) and a tetsuocode server
+pointed at it, then opens --concurrency streams at a time until --requests
+have completed. Reports time-to-first-byte, time-to-first-token, per-stream
+tokens/sec, p50/p99 end-to-end latency and the server's RSS:
+
+    python bench/chat_load.py --concurrency 32 --requests 256 --format mixed
+    python bench/chat_load.py --server http://127.0.0.1:5000 --server-pid 1234
+
+With --server the driver targets an already running instance (which must
+already point at a provider, e.g. via TETSUO_XAI_BASE_URL); RSS is only
+sampled when --server-pid is given or the driver started the server itself.
+"""
+import argparse
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+import mock_provider  # noqa: E402
+
+FORMATS = {"openai": ("openai", "gpt-4o-mini"), "anthropic": ("anthropic", "claude-haiku-4-5-20251001")}
+
+
+def _children(pid):
+    try:
+        out = []
+        for tid in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{tid}/children") as f:
+                out += [int(c) for c in f.read().split()]
+        return out
+    except OSError:
+        return []
+
+
+def _tree(pid):
+    stack, seen = [pid], []
+    while stack:
+        p = stack.pop()
+        seen.append(p)
+        stack += _children(p)
+    return seen
+
+
+def cpu_seconds(pid):
+    """User+system CPU time used so far by pid and its live descendants, or None without /proc."""
+    total, found = 0, False
+    for p in _tree(pid):
+        try:
+            with open(f"/proc/{p}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            total += int(fields[11]) + int(fields[12])
+            found = True
+        except (OSError, IndexError, ValueError):
+            continue
+    return total / os.sysconf("SC_CLK_TCK") if found else None
+
+
+def rss_bytes(pid):
+    """Resident set size of pid and its descendants (e.g. gunicorn workers), or None without /proc."""
+    total, found = 0, False
+    for p in _tree(pid):
+        try:
+            with open(f"/proc/{p}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+                        found = True
+                        break
+        except OSError:
+            continue
+    return total if found else None
+
+
+class RssSampler(threading.Thread):
+    def __init__(self, pid, interval=0.25):
+        super().__init__(daemon=True)
+        self.pid, self.interval = pid, interval
+        self.samples = []
+        self.stop = threading.Event()
+
+    def run(self):
+        while not self.stop.is_set():
+            rss = rss_bytes(self.pid)
+            if rss is not None:
+                self.samples.append(rss)
+            self.stop.wait(self.interval)
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(workspace, provider_url, server_args):
+    port = _free_port()
+    env = dict(os.environ, TETSUO_WORKSPACE=workspace, XAI_API_KEY="mock", OPENAI_API_KEY="mock",
+               ANTHROPIC_API_KEY="mock", TETSUO_PASSWORD="")
+    for pid in ("XAI", "OPENAI", "ANTHROPIC"):
+        env[f"TETSUO_{pid}_BASE_URL"] = provider_url
+    cmd = [sys.executable, "-m", "web.cli", workspace, "--port", str(port), "--no-browser"] + server_args
+    proc = subprocess.Popen(cmd, cwd=os.path.dirname(here), env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"server exited with {proc.returncode}")
+        try:
+            requests.get(url + "/api/providers", timeout=1)
+            return proc, url
+        except requests.RequestException:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("server did not come up within 30s")
+
+
+def one_stream(url, fmt, prompt, context_mode):
+    provider, model = FORMATS[fmt]
+    body = {"messages": [{"role": "user", "content": prompt}], "provider": provider, "model": model,
+            "context_mode": context_mode}
+    result = {"format": fmt, "ok": False, "ttfb": None, "ttft": None, "frames": 0, "tool_calls": 0}
+    text = []
+    t0 = time.perf_counter()
+    try:
+        with requests.post(url + "/api/chat", json=body, stream=True, timeout=(5, 300)) as resp:
+            buf = b""
+            for chunk in resp.iter_content(chunk_size=None):
+                now = time.perf_counter()
+                if result["ttfb"] is None:
+                    result["ttfb"] = now - t0
+                buf += chunk
+                while b"\n\n" in buf:
+                    frame, buf = buf.split(b"\n\n", 1)
+                    if not frame.startswith(b"data: "):
+                        continue
+                    event = json.loads(frame[6:])
+                    kind = event.get("type")
+                    if kind == "content":
+                        if result["ttft"] is None:
+                            result["ttft"] = now - t0
+                        result["frames"] += 1
+                        text.append(event["content"])
+                        result["last_token"] = now - t0
+                    elif kind == "tool_call":
+                        result["tool_calls"] += 1
+                    elif kind == "done":
+                        result["ok"] = True
+                    elif kind == "error":
+                        result["error"] = event.get("content")
+    except requests.RequestException as e:
+        result["error"] = str(e)
+    result["latency"] = time.perf_counter() - t0
+    # Frames may carry several coalesced deltas; count tokens the way the mock paces them
+    result["tokens"] = len(mock_provider._text_chunks("".join(text))) if text else 0
+    if result["ttft"] is not None and result["tokens"] > 1 and result["last_token"] > result["ttft"]:
+        result["tokens_per_sec"] = (result["tokens"] - 1) / (result["last_token"] - result["ttft"])
+    return result
+
+
+def _pct(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100.0 * (len(values) - 1))))]
+
+
+def summarize(results, wall, rss, cpu):
+    ok = [r for r in results if r["ok"]]
+    ms = lambda xs, q: round(_pct(xs, q) * 1000, 2) if xs else None  # noqa: E731
+
+    def dist(key):
+        xs = [r[key] for r in ok if r.get(key) is not None]
+        return {"p50_ms": ms(xs, 50), "p90_ms": ms(xs, 90), "p99_ms": ms(xs, 99),
+                "max_ms": round(max(xs) * 1000, 2) if xs else None}
+
+    tps = [r["tokens_per_sec"] for r in ok if r.get("tokens_per_sec")]
+    errors = {}
+    for r in results:
+        if not r["ok"]:
+            reason = r.get("error") or "stream ended without done"
+            errors[reason] = errors.get(reason, 0) + 1
+    return {
+        "requests": len(results), "ok": len(ok), "errors": errors, "wall_s": round(wall, 3),
+        "streams_per_sec": round(len(ok) / wall, 2) if wall else None,
+        "ttfb": dist("ttfb"), "ttft": dist("ttft"), "latency": dist("latency"),
+        "tokens_per_sec": {"per_stream_p50": round(statistics.median(tps), 1) if tps else None,
+                           "per_stream_min": round(min(tps), 1) if tps else None,
+                           "aggregate": round(sum(r["tokens"] for r in ok) / wall, 1) if wall else None},
+        "tool_calls": sum(r["tool_calls"] for r in ok),
+        "content_frames": sum(r["frames"] for r in ok),
+        "server_cpu_s": round(cpu, 3) if cpu is not None else None,
+        "server_cpu_us_per_token": round(cpu * 1e6 / max(1, sum(r["tokens"] for r in ok)), 1) if cpu is not None else None,
+        "server_rss": {"start_mb": round(rss[0] / 2**20, 1), "peak_mb": round(max(rss) / 2**20, 1),
+                       "end_mb": round(rss[-1] / 2**20, 1)} if rss else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=16, help="Concurrent chat streams (default: 16)")
+    parser.add_argument("--requests", type=int, default=64, help="Total chat requests (default: 64)")
+    parser.add_argument("--format", choices=["openai", "anthropic", "mixed"], default="mixed",
+                        help="Provider wire format to exercise (default: mixed)")
+    parser.add_argument("--tps", type=float, default=50.0, help="Mock provider deltas/sec per stream")
+    parser.add_argument("--ttft", type=float, default=200, help="Mock provider first-event delay in ms")
+    parser.add_argument("--transcript", help="Transcript JSON for the mock provider")
+    parser.add_argument("--context-mode", default="smart", help="context_mode sent with each chat")
+    parser.add_argument("--workspace", default=here, help="Workspace for the server (default: bench/)")
+    parser.add_argument("--server", help="Use an already running server instead of starting one")
+    parser.add_argument("--server-pid", type=int, help="PID to sample RSS from when using --server")
+    parser.add_argument("--server-arg", action="append", default=[],
+                        help="Extra argument for the spawned server (repeatable)")
+    parser.add_argument("--out", help="Write JSON results here (default: stdout)")
+    args = parser.parse_args()
+
+    proc = None
+    provider = None
+    if args.server:
+        url, pid = args.server.rstrip("/"), args.server_pid
+    else:
+        transcript = mock_provider.load_transcript(args.transcript)
+        provider = mock_provider.start(transcript, args.tps, args.ttft / 1000.0)
+        provider_url = "http://%s:%d/v1" % provider.server_address[:2]
+        proc, url = start_server(os.path.abspath(args.workspace), provider_url, args.server_arg)
+        pid = proc.pid
+
+    sampler = RssSampler(pid) if pid else None
+    cpu_start = cpu_seconds(pid) if pid else None
+    if sampler:
+        sampler.start()
+    formats = ["openai", "anthropic"] if args.format == "mixed" else [args.format]
+    try:
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            futures = [pool.submit(one_stream, url, formats[i % len(formats)], f"Summarize the project ({i})",
+                                   args.context_mode) for i in range(args.requests)]
+            results = [f.result() for f in futures]
+        wall = time.perf_counter() - t0
+        cpu_end = cpu_seconds(pid) if pid else None
+    finally:
+        if sampler:
+            sampler.stop.set()
+            sampler.join()
+        if proc:
+            proc.terminate()
+            proc.wait(timeout=10)
+        if provider:
+            provider.shutdown()
+
+    report = {
+        "meta": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count(),
+                 "timestamp": time.time(), "concurrency": args.concurrency, "format": args.format,
+                 "mock_tps": args.tps, "mock_ttft_ms": args.ttft, "server_args": args.server_arg},
+        "summary": summarize(results, wall, sampler.samples if sampler else [],
+                             cpu_end - cpu_start if cpu_start is not None and cpu_end is not None else None),
+    }
+    if provider:
+        report["meta"]["provider_stats"] = dict(provider.mock.stats)
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,310 @@
+"""Local stand-in for an LLM provider, for exercising /api/chat without paying one.
+
+Speaks the OpenAI-compatible `/chat/completions` SSE format and the Anthropic
+`/messages` event format, including streamed tool calls. Responses come from
+a transcript and are paced to a configurable tokens/sec:
+
+    python bench/mock_provider.py --port 8400 --tps 80 --ttft 300
+    TETSUO_XAI_BASE_URL=http://127.0.0.1:8400/v1 XAI_API_KEY=mock python web/app.py
+
+A transcript is {"turns": [...]}. Each turn is either neutral --
+{"text": "...", "tool_calls": [{"name": "read_file", "arguments": {...}}]} --
+which is rendered in whichever format the request asked for, or a recorded
+{"format": "openai"|"anthropic", "events": [{"event": ..., "data": ...}]}
+which is replayed verbatim. The turn is picked by how many assistant turns
+follow the last real user message, so a tool loop walks the transcript in
+order. Record a real provider with:
+
+    python bench/mock_provider.py --record session.json --upstream https://api.x.ai/v1
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+DEFAULT_TRANSCRIPT = {
+    "turns": [
+        {"text": "Let me look at the workspace first.",
+         "tool_calls": [{"name": "list_files", "arguments": {"path": "."}}]},
+        {"text": ("Here is an overview of the project. " * 40).strip()},
+    ],
+}
+CHUNK_RE = re.compile(r"\s*\S+|\s+")
+ARG_CHUNK = 12
+
+
+def _text_chunks(text):
+    """Split text into roughly token-sized deltas."""
+    return CHUNK_RE.findall(text) or [""]
+
+
+def _arg_chunks(arguments):
+    raw = arguments if isinstance(arguments, str) else json.dumps(arguments)
+    return [raw[i:i + ARG_CHUNK] for i in range(0, len(raw), ARG_CHUNK)] or [""]
+
+
+def _turn_index(messages, fmt):
+    """Number of assistant turns since the last message the user actually typed."""
+    count = 0
+    for msg in reversed(messages):
+        if msg.get("role") == "assistant":
+            count += 1
+        elif msg.get("role") == "user":
+            content = msg.get("content")
+            is_tool_result = fmt == "anthropic" and isinstance(content, list) and content and all(
+                isinstance(b, dict) and b.get("type") == "tool_result" for b in content)
+            if not is_tool_result:
+                break
+    return count
+
+
+def openai_events(turn, model):
+    """Render a neutral turn as OpenAI chat.completion.chunk payloads."""
+    base = {"id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": int(time.time()), "model": model}
+
+    def chunk(delta, finish=None):
+        return {**base, "choices": [{"index": 0, "delta": delta, "finish_reason": finish}]}
+
+    yield chunk({"role": "assistant", "content": ""})
+    completion = 0
+    for piece in _text_chunks(turn.get("text", "")):
+        completion += 1
+        yield chunk({"content": piece})
+    calls = turn.get("tool_calls") or []
+    for i, call in enumerate(calls):
+        yield chunk({"tool_calls": [{"index": i, "id": f"call_mock_{i}", "type": "function",
+                                     "function": {"name": call["name"], "arguments": ""}}]})
+        for piece in _arg_chunks(call.get("arguments", {})):
+            completion += 1
+            yield chunk({"tool_calls": [{"index": i, "function": {"arguments": piece}}]})
+    yield chunk({}, "tool_calls" if calls else "stop")
+    yield {**base, "choices": [], "usage": {"prompt_tokens": 0, "completion_tokens": completion,
+                                           "total_tokens": completion}}
+
+
+def anthropic_events(turn, model):
+    """Render a neutral turn as Anthropic (event, data) pairs."""
+    calls = turn.get("tool_calls") or []
+    yield "message_start", {"type": "message_start", "message": {
+        "id": "msg_mock", "type": "message", "role": "assistant", "model": model, "content": [],
+        "stop_reason": None, "usage": {"input_tokens": 0, "output_tokens": 0}}}
+    index = 0
+    completion = 0
+    if turn.get("text"):
+        yield "content_block_start", {"type": "content_block_start", "index": index,
+                                      "content_block": {"type": "text", "text": ""}}
+        for piece in _text_chunks(turn["text"]):
+            completion += 1
+            yield "content_block_delta", {"type": "content_block_delta", "index": index,
+                                          "delta": {"type": "text_delta", "text": piece}}
+        yield "content_block_stop", {"type": "content_block_stop", "index": index}
+        index += 1
+    for i, call in enumerate(calls):
+        yield "content_block_start", {"type": "content_block_start", "index": index, "content_block": {
+            "type": "tool_use", "id": f"toolu_mock_{i}", "name": call["name"], "input": {}}}
+        for piece in _arg_chunks(call.get("arguments", {})):
+            completion += 1
+            yield "content_block_delta", {"type": "content_block_delta", "index": index,
+                                          "delta": {"type": "input_json_delta", "partial_json": piece}}
+        yield "content_block_stop", {"type": "content_block_stop", "index": index}
+        index += 1
+    yield "message_delta", {"type": "message_delta",
+                            "delta": {"stop_reason": "tool_use" if calls else "end_turn"},
+                            "usage": {"output_tokens": completion}}
+    yield "message_stop", {"type": "message_stop"}
+
+
+class MockProvider:
+    """Transcript state, pacing and counters shared by all handler threads."""
+
+    def __init__(self, transcript, tps=50.0, ttft=0.2, record=None, upstream=None):
+        self.transcript = transcript
+        self.delay = 1.0 / tps if tps > 0 else 0.0
+        self.ttft = ttft
+        self.record = record
+        self.upstream = upstream.rstrip("/") if upstream else None
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "active": 0, "peak_active": 0, "events": 0}
+
+    def turn_for(self, messages, fmt):
+        turns = self.transcript.get("turns") or DEFAULT_TRANSCRIPT["turns"]
+        return turns[min(_turn_index(messages, fmt), len(turns) - 1)]
+
+    def events_for(self, turn, fmt, model):
+        """Yield (event_name_or_None, data_str) for one response."""
+        if "events" in turn:
+            if turn.get("format", "openai") != fmt:
+                raise ValueError(f"transcript turn was recorded as {turn.get('format')}, request is {fmt}")
+            for ev in turn["events"]:
+                yield ev.get("event"), ev["data"]
+            return
+        if fmt == "anthropic":
+            for name, data in anthropic_events(turn, model):
+                yield name, json.dumps(data)
+        else:
+            for data in openai_events(turn, model):
+                yield None, json.dumps(data)
+            yield None, "[DONE]"
+
+    def save_turn(self, turn):
+        with self.lock:
+            self.transcript.setdefault("turns", []).append(turn)
+            tmp = self.record + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.transcript, f, indent=1)
+            os.replace(tmp, self.record)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "tetsuo-mock/1.0"
+
+    def log_message(self, *args):
+        pass
+
+    def _write_chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def _start_stream(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def _json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        mock = self.server.mock
+        if self.path.rstrip("/").endswith("/stats"):
+            with mock.lock:
+                return self._json(200, dict(mock.stats))
+        self._json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        mock = self.server.mock
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if self.path.endswith("/chat/completions"):
+            fmt = "openai"
+        elif self.path.endswith("/messages"):
+            fmt = "anthropic"
+        else:
+            return self._json(404, {"error": {"message": f"unknown endpoint {self.path}"}})
+        with mock.lock:
+            mock.stats["requests"] += 1
+            mock.stats["active"] += 1
+            mock.stats["peak_active"] = max(mock.stats["peak_active"], mock.stats["active"])
+        try:
+            if mock.upstream:
+                self._proxy(fmt, body)
+            else:
+                self._replay(fmt, body)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+        finally:
+            with mock.lock:
+                mock.stats["active"] -= 1
+
+    def _replay(self, fmt, body):
+        mock = self.server.mock
+        turn = mock.turn_for(body.get("messages", []), fmt)
+        try:
+            events = list(mock.events_for(turn, fmt, body.get("model", "mock")))
+        except ValueError as e:
+            return self._json(400, {"error": {"message": str(e)}})
+        self._start_stream()
+        time.sleep(mock.ttft)
+        for name, data in events:
+            frame = (f"event: {name}\n" if name else "") + f"data: {data}\n\n"
+            self._write_chunk(frame.encode())
+            if mock.delay:
+                time.sleep(mock.delay)
+        self._write_chunk(b"")
+        with mock.lock:
+            mock.stats["events"] += len(events)
+
+    def _proxy(self, fmt, body):
+        """Forward to the real provider, stream the reply back and record it as a turn."""
+        mock = self.server.mock
+        headers = {k: v for k, v in self.headers.items()
+                   if k.lower() in ("authorization", "x-api-key", "anthropic-version", "content-type")}
+        url = mock.upstream + ("/messages" if fmt == "anthropic" else "/chat/completions")
+        resp = requests.post(url, headers=headers, json=body, stream=True, timeout=(10, 300))
+        if resp.status_code != 200:
+            return self._json(resp.status_code, resp.json() if resp.content else {})
+        self._start_stream()
+        events, name = [], None
+        for line in resp.iter_lines(decode_unicode=True):
+            if line.startswith("event: "):
+                name = line[7:]
+            elif line.startswith("data: "):
+                events.append({"event": name, "data": line[6:]})
+                self._write_chunk(((f"event: {name}\n" if name else "") + line + "\n\n").encode())
+                name = None
+        self._write_chunk(b"")
+        mock.save_turn({"format": fmt, "events": events})
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024  # load tests open hundreds of connections at once
+
+    def handle_error(self, request, client_address):
+        pass  # clients dropping pooled keep-alive connections at shutdown is expected
+
+
+def start(transcript=None, tps=50.0, ttft=0.2, host="127.0.0.1", port=0, record=None, upstream=None):
+    """Start a mock provider on a daemon thread; returns the server (see .server_address)."""
+    server = Server((host, port), Handler)
+    server.mock = MockProvider(transcript or DEFAULT_TRANSCRIPT, tps, ttft, record, upstream)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def load_transcript(path):
+    if not path:
+        return DEFAULT_TRANSCRIPT
+    with open(path) as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8400)
+    parser.add_argument("--transcript", help="Transcript JSON to replay (default: built-in tool loop)")
+    parser.add_argument("--tps", type=float, default=50.0, help="Streamed deltas per second (0 = unpaced)")
+    parser.add_argument("--ttft", type=float, default=200, help="Delay before the first event, in ms")
+    parser.add_argument("--record", help="Proxy to --upstream and append each response to this transcript")
+    parser.add_argument("--upstream", help="Real provider base URL to record from (e.g. https://api.x.ai/v1)")
+    args = parser.parse_args()
+    if bool(args.record) != bool(args.upstream):
+        parser.error("--record and --upstream go together")
+
+    transcript = {"turns": []} if args.record else load_transcript(args.transcript)
+    server = start(transcript, args.tps, args.ttft / 1000.0, args.host, args.port, args.record, args.upstream)
+    host, port = server.server_address[:2]
+    mode = f"recording {args.upstream} -> {args.record}" if args.record else f"{args.tps:g} tok/s"
+    print(f"mock provider on http://{host}:{port}/v1 ({mode})", file=sys.stderr)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+"""Benchmark the workspace-facing hot paths of tetsuocode Web.
+
+Generates deterministic synthetic workspaces (mixed languages, a few large
+and binary files), then times the file tree, quick-open search, grep,
+replace, index build/search, symbols, skeleton summary and diff paths
+through the Flask test client. Results are written as JSON so runs from
+different commits can be compared:
+
+    python bench/workspace_bench.py --sizes 1000,10000 --out before.json
+    python bench/workspace_bench.py --sizes 1000,10000 --out after.json --compare before.json
+
+Generated workspaces are cached under --workdir and reused across runs.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+
+WORDS = ["user", "account", "session", "token", "cache", "index", "request", "response", "handler", "widget",
+         "render", "parse", "config", "stream", "buffer", "client", "server", "query", "result", "event"]
+LANGS = [".py", ".js", ".ts", ".go", ".rs", ".java", ".rb", ".md", ".json"]
+GEN_VERSION = 1
+FILES_PER_DIR = 25
+LARGE_FILE_BYTES = 2 * 1024 * 1024
+REPLACE_FROM, REPLACE_TO = "BENCH_MARKER_ALPHA", "BENCH_MARKER_OMEGA"
+RARE_TOKEN = "zyzzogeton_quux"
+
+
+def _ident(rng):
+    return "_".join(rng.sample(WORDS, 2)) + str(rng.randrange(1000))
+
+
+def _source(rng, ext, units):
+    """Source text in the style of ext with roughly `units` functions."""
+    out = []
+    for _ in range(units):
+        name, other = _ident(rng), _ident(rng)
+        if ext == ".py":
+            out.append(f"class {name.title().replace('_', '')}:\n    def {name}(self, {other}):\n"
+                       f"        return self.{other} + {rng.randrange(100)}  # {REPLACE_FROM}\n\n")
+        elif ext in (".js", ".ts"):
+            out.append(f"export const {name} = async ({other}) => {{\n  return {other}.{rng.choice(WORDS)}; // {REPLACE_FROM}\n}};\n"
+                       f"function {other}() {{ return {rng.randrange(100)}; }}\n\n")
+        elif ext == ".go":
+            out.append(f"func {name}({other} int) int {{\n\treturn {other} * {rng.randrange(100)} // {REPLACE_FROM}\n}}\n\n")
+        elif ext == ".rs":
+            out.append(f"pub fn {name}({other}: u32) -> u32 {{\n    {other} + {rng.randrange(100)} // {REPLACE_FROM}\n}}\n\n")
+        elif ext == ".java":
+            out.append(f"    public static int {name}(int {other}) {{\n        return {other}; // {REPLACE_FROM}\n    }}\n\n")
+        elif ext == ".rb":
+            out.append(f"def {name}({other})\n  {other} + {rng.randrange(100)} # {REPLACE_FROM}\nend\n\n")
+        elif ext == ".json":
+            out.append(f'{{"{name}": "{other}", "n": {rng.randrange(1000)}}}\n')
+        else:
+            out.append(f"## {name}\n\nThe {other} {rng.choice(WORDS)} handles {rng.choice(WORDS)} {REPLACE_FROM}.\n\n")
+    return "".join(out)
+
+
+def generate_workspace(path, n_files, seed):
+    """Create n_files under path: mixed sources, ~2% binary, a few multi-megabyte files."""
+    rng = random.Random(seed * 1000003 + n_files)
+    n_large = min(20, max(1, n_files // 500))
+    n_binary = max(1, n_files // 50)
+    for i in range(n_files):
+        d = os.path.join(path, f"pkg{i // (FILES_PER_DIR * FILES_PER_DIR)}", f"mod{(i // FILES_PER_DIR) % FILES_PER_DIR}")
+        os.makedirs(d, exist_ok=True)
+        if i < n_binary:
+            with open(os.path.join(d, f"blob{i}.{'png' if i % 2 else 'dat'}"), "wb") as f:
+                f.write(b"\x89PNG\0" + rng.randbytes(rng.randrange(4096, 65536)))
+            continue
+        ext = LANGS[i % len(LANGS)]
+        if i < n_binary + n_large:
+            ext = ".py"
+            units = LARGE_FILE_BYTES // 150
+        else:
+            units = rng.randrange(3, 40)
+        text = _source(rng, ext, units)
+        if i % 997 == 0:
+            text += f"# {RARE_TOKEN}\n"
+        with open(os.path.join(d, f"file{i}{ext}"), "w", encoding="utf-8") as f:
+            f.write(text)
+    with open(os.path.join(path, ".bench-complete"), "w") as f:
+        json.dump({"files": n_files, "seed": seed, "version": GEN_VERSION}, f)
+
+
+def ensure_workspace(workdir, n_files, seed):
+    path = os.path.join(workdir, f"ws-{n_files}-{seed}-v{GEN_VERSION}")
+    if not os.path.exists(os.path.join(path, ".bench-complete")):
+        shutil.rmtree(path, ignore_errors=True)
+        t0 = time.perf_counter()
+        generate_workspace(path, n_files, seed)
+        print(f"  generated {n_files} files in {time.perf_counter() - t0:.1f}s -> {path}", file=sys.stderr)
+    return path
+
+
+def _largest(path, ext):
+    best, best_size = None, -1
+    for root, dirs, files in os.walk(path):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        for fn in files:
+            if fn.endswith(ext):
+                size = os.path.getsize(os.path.join(root, fn))
+                if size > best_size:
+                    best, best_size = os.path.join(root, fn), size
+    return best
+
+
+def _stats(samples, cold=None):
+    ms = sorted(s * 1000 for s in samples)
+    out = {"runs": len(ms), "median_ms": round(statistics.median(ms), 3), "min_ms": round(ms[0], 3),
+           "p95_ms": round(ms[min(len(ms) - 1, int(len(ms) * 0.95))], 3)}
+    if cold is not None:
+        out["cold_ms"] = round(cold * 1000, 3)
+    return out
+
+
+def _timed(fn):
+    t0 = time.perf_counter()
+    resp = fn()
+    elapsed = time.perf_counter() - t0
+    if getattr(resp, "status_code", 200) >= 400:
+        raise RuntimeError(f"benchmark request failed: {resp.status_code} {resp.get_data(as_text=True)[:200]}")
+    return elapsed
+
+
+def _reset_caches(A):
+    """Drop the in-process caches so the next call measures a cold path."""
+    for name, value in (("SCAN_CACHE", {"root": None, "dirs": {}, "files": [], "checked": 0.0}),):
+        if hasattr(A, name):
+            getattr(A, name).update(value)
+    for name in ("SCAN_CACHES", "FILE_TOKEN_CACHE", "TOKEN_CACHE"):
+        if hasattr(A, name):
+            getattr(A, name).clear()
+
+
+def run_size(A, client, ws, repeat):
+    A.WORKSPACE = ws
+    big_py = _largest(ws, ".py")
+    big_text = open(big_py, encoding="utf-8").read()
+    edited = big_text.replace(REPLACE_FROM, REPLACE_TO, 1)
+    results = {}
+
+    def bench(name, fn, reset=None):
+        if reset:
+            reset()
+        cold = _timed(fn)
+        samples = [_timed(fn) for _ in range(repeat)]
+        results[name] = _stats(samples, cold)
+        print(f"    {name:<16} cold {results[name]['cold_ms']:>10.1f} ms   median {results[name]['median_ms']:>10.1f} ms",
+              file=sys.stderr)
+
+    bench("tree", lambda: client.get("/api/files/tree?max=200"), reset=lambda: _reset_caches(A))
+    bench("search_files", lambda: client.get("/api/files/search?q=file12"))
+    bench("grep_common", lambda: client.get(f"/api/files/grep?q={WORDS[3]}"))
+    bench("grep_rare", lambda: client.get(f"/api/files/grep?q={RARE_TOKEN}"))
+    bench("grep_regex", lambda: client.get("/api/files/grep?q=def%20%5Cw%2Bsession&regex=true"))
+
+    toggle = [REPLACE_FROM, REPLACE_TO]
+
+    def replace():
+        resp = client.post("/api/files/replace", json={"query": toggle[0], "replacement": toggle[1], "case": True})
+        toggle.reverse()
+        return resp
+    bench("replace_in_files", replace)
+    if toggle[0] != REPLACE_FROM:
+        replace()
+
+    def reset_index():
+        shutil.rmtree(os.path.join(ws, ".tetsuo"), ignore_errors=True)
+        if hasattr(A, "INDEXES"):
+            A.INDEXES.pop(ws, None)
+        elif hasattr(A, "WORKSPACE_INDEX") and "root" in A.WORKSPACE_INDEX:
+            A.WORKSPACE_INDEX["root"] = None
+    bench("build_index", lambda: client.post("/api/index/build"), reset=reset_index)
+    bench("index_search", lambda: client.post("/api/index/search", json={"query": f"{WORDS[1]} {WORDS[9]} render"}))
+    bench("file_symbols", lambda: client.get("/api/files/symbols", query_string={"path": big_py}))
+    bench("file_skeleton", lambda: client.get("/api/files/summary", query_string={"path": big_py}))
+    # compute_diff has no route of its own; it runs inside write_file/edit_file
+    bench("compute_diff", lambda: A.compute_diff(big_text, edited, big_py))
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(here), timeout=5).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def compare(current, baseline, threshold):
+    """Print median deltas against baseline; return the number of regressions past threshold."""
+    regressions = 0
+    for size, benches in current["results"].items():
+        base = baseline.get("results", {}).get(size, {})
+        for name, stats in benches.items():
+            if name not in base:
+                continue
+            old, new = base[name]["median_ms"], stats["median_ms"]
+            delta = (new - old) / old if old else 0.0
+            flag = ""
+            if delta > threshold:
+                regressions += 1
+                flag = "  REGRESSION"
+            print(f"{size:>7} {name:<16} {old:>10.1f} -> {new:>10.1f} ms  {delta:+7.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000,10000", help="Comma-separated workspace sizes (e.g. 1000,10000,100000)")
+    parser.add_argument("--repeat", type=int, default=5, help="Warm runs per benchmark (default: 5)")
+    parser.add_argument("--seed", type=int, default=1, help="Generator seed (default: 1)")
+    parser.add_argument("--workdir", default=os.path.join(tempfile.gettempdir(), "tetsuo-bench"),
+                        help="Where generated workspaces are cached")
+    parser.add_argument("--out", help="Write JSON results here (default: stdout)")
+    parser.add_argument("--compare", help="Baseline JSON to compare medians against")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="Relative median slowdown that counts as a regression (default: 0.25)")
+    args = parser.parse_args()
+
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+    os.makedirs(args.workdir, exist_ok=True)
+    workspaces = {n: ensure_workspace(args.workdir, n, args.seed) for n in sizes}
+
+    os.environ.setdefault("TETSUO_WORKSPACE", workspaces[sizes[0]])
+    from web import app as A
+    client = A.app.test_client()
+
+    report = {
+        "meta": {"commit": git_commit(), "python": platform.python_version(), "platform": platform.platform(),
+                 "cpus": os.cpu_count(), "timestamp": time.time(), "seed": args.seed, "repeat": args.repeat},
+        "results": {},
+    }
+    for n in sizes:
+        print(f"  workspace {n} files", file=sys.stderr)
+        report["results"][str(n)] = run_size(A, client, workspaces[n], args.repeat)
+
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(report, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
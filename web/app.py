@@ -2,13 +2,37 @@
 import json
 import os
 import re
+import math
 import time
-import difflib
+import heapq
+import bisect
+import itertools
+import mmap
+import collections
+import queue
+import atexit
+import threading
 import hashlib
+import sqlite3
+import contextlib
+import contextvars
+import codecs
+import secrets
+import tempfile
+import zlib
+import gzip
+import base64
+import io
+import struct
 import subprocess
 import mimetypes
+from array import array
 import requests
-from flask import Flask, render_template, request, Response, stream_with_context, jsonify, redirect
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlencode, urlsplit
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, TimeoutError as FutureTimeout
+from flask import (Flask, render_template, request, Response, stream_with_context, jsonify, redirect, g, send_file,
+                   has_request_context)
 
 app = Flask(__name__)
 
@@ -18,40 +42,284 @@ API_KEY = os.environ.get("XAI_API_KEY", "")
 AUTH_PASSWORD = os.environ.get("TETSUO_PASSWORD", "")
 WORKSPACE = os.path.abspath(os.environ.get("TETSUO_WORKSPACE", os.getcwd()))
 
-FILE_EDIT_HISTORY = []  # [{path, old_content, new_content, tool, timestamp}]
 MAX_UNDO_HISTORY = 50
 
 
-def estimate_tokens(text):
-    """Rough token estimate: ~4 chars per token."""
-    return len(text) // 4
+# ── Token Accounting ──────────────────────────
+
+# Offline token estimate: text is pre-tokenized with the same split rules
+# GPT-style tokenizers use (contractions, letter runs, <=3 digit runs,
+# punctuation runs, whitespace), then each piece is priced with a rule of
+# thumb for how BPE merges treat it. The per-family parameters are hand-set,
+# not fitted to any vocabulary, so counts are estimates for budgeting only.
+# When tiktoken and its encoding files are available, families that name an
+# encoding are counted exactly instead.
+TOKENIZER_FAMILIES = {
+    "openai": {"encoding": "o200k_base", "word_chars": 9, "subword_chars": 5.5, "wide_per_token": 1.2, "other_per_token": 2.6},
+    "xai": {"encoding": "cl100k_base", "word_chars": 8, "subword_chars": 5.0, "wide_per_token": 0.9, "other_per_token": 2.2},
+    "anthropic": {"encoding": None, "word_chars": 7, "subword_chars": 4.5, "wide_per_token": 0.8, "other_per_token": 2.0},
+    "default": {"encoding": None, "word_chars": 8, "subword_chars": 5.0, "wide_per_token": 0.9, "other_per_token": 2.2},
+}
+TOKEN_PRETOKEN_RE = re.compile(
+    r"'(?:[sdmt]|ll|ve|re)|(?:[^\r\n\w]|_)?[^\W\d_]+|\d{1,3}| ?(?:[^\s\w]|_)+[\r\n]*|\s*[\r\n]+|\s+(?!\S)|\s+")
+TOKEN_SUBWORD_RE = re.compile(r"[A-Z]?[a-z]+|[A-Z]+(?![a-z])|[^\W\d_]+")
+TOKEN_CACHE_SIZE = 50000
+TOKEN_CACHE_MIN_CHARS = 256  # shorter strings are cheaper to count than to hash
+TOKEN_FILE_SAMPLE_BYTES = 256 * 1024  # larger files are counted from a prefix sample and scaled
+
+TOKEN_COUNTERS = {}  # {family: callable(text) -> int}, see register_token_counter
+TOKEN_CACHE = collections.OrderedDict()  # {(family, sha1(text)): count}
+FILE_TOKEN_CACHE = collections.OrderedDict()  # {path: (mtime, size, family, count)}
+TOKEN_LOCK = threading.Lock()
+
+
+def _price_piece(piece, params):
+    word = piece.lstrip()
+    if not word:
+        return 1
+    if word.isascii():
+        if not word[-1].isalpha():
+            return 1 + (len(word.rstrip()) - 1) // 3
+        tokens = 0
+        for part in TOKEN_SUBWORD_RE.findall(word):
+            tokens += 1 if len(part) <= params["word_chars"] else math.ceil(len(part) / params["subword_chars"])
+        return max(tokens, 1)
+    wide = sum(1 for ch in word if ord(ch) >= 0x2E80)
+    other = len(word) - wide
+    return max(1, math.ceil(wide / params["wide_per_token"] + other / params["other_per_token"]))
+
+
+def _heuristic_counter(family):
+    params = TOKENIZER_FAMILIES.get(family, TOKENIZER_FAMILIES["default"])
+
+    def count(text):
+        return sum(_price_piece(piece, params) for piece in TOKEN_PRETOKEN_RE.findall(text))
+    return count
+
+
+def register_token_counter(family, counter):
+    """Plug in a counter (callable text -> int) for a provider family."""
+    with TOKEN_LOCK:
+        TOKEN_COUNTERS[family] = counter
+        for key in [k for k in TOKEN_CACHE if k[0] == family]:
+            del TOKEN_CACHE[key]
+
+
+def _token_counter(family):
+    counter = TOKEN_COUNTERS.get(family)
+    if counter is not None:
+        return counter
+    counter = None
+    encoding = TOKENIZER_FAMILIES.get(family, TOKENIZER_FAMILIES["default"])["encoding"]
+    if encoding:
+        try:
+            import tiktoken
+            enc = tiktoken.get_encoding(encoding)
+            counter = lambda text: len(enc.encode(text, disallowed_special=()))
+        except Exception:
+            counter = None
+    TOKEN_COUNTERS[family] = counter or _heuristic_counter(family)
+    return TOKEN_COUNTERS[family]
+
+
+def token_family(provider_id=None, model=None):
+    """Map a provider id or model name to a TOKENIZER_FAMILIES key."""
+    if provider_id in TOKENIZER_FAMILIES:
+        return provider_id
+    model = (model or "").lower()
+    if model.startswith(("gpt-", "o1", "o3", "o4")):
+        return "openai"
+    if model.startswith("claude"):
+        return "anthropic"
+    if model.startswith("grok"):
+        return "xai"
+    return "default"
+
+
+def count_tokens_batch(texts, family="default"):
+    """Token counts (estimates unless the family's counter is exact) for many strings.
+
+    Long strings are hashed so repeated payloads are free.
+    """
+    counter = _token_counter(family)
+    counts = [None] * len(texts)
+    keys = {}
+    with TOKEN_LOCK:
+        for i, text in enumerate(texts):
+            if len(text) >= TOKEN_CACHE_MIN_CHARS:
+                key = (family, hashlib.sha1(text.encode("utf-8", "surrogatepass")).hexdigest())
+                keys[i] = key
+                if key in TOKEN_CACHE:
+                    TOKEN_CACHE.move_to_end(key)
+                    counts[i] = TOKEN_CACHE[key]
+    for i, text in enumerate(texts):
+        if counts[i] is None:
+            counts[i] = counter(text) if text else 0
+    with TOKEN_LOCK:
+        for i, key in keys.items():
+            TOKEN_CACHE[key] = counts[i]
+        while len(TOKEN_CACHE) > TOKEN_CACHE_SIZE:
+            TOKEN_CACHE.popitem(last=False)
+    return counts
+
+
+def count_tokens(text, family="default"):
+    """Estimated token count of text; exact only when tiktoken serves the family."""
+    return count_tokens_batch([text], family)[0] if text else 0
+
+
+def count_file_tokens(full, family="default", size=None, mtime=None):
+    """Token count of a file, cached by (mtime, size) and by content hash."""
+    if size is None or mtime is None:
+        try:
+            st = os.stat(full)
+        except OSError:
+            return 0
+        size, mtime = st.st_size, st.st_mtime
+    with TOKEN_LOCK:
+        cached = FILE_TOKEN_CACHE.get(full)
+        if cached and cached[:3] == (mtime, size, family):
+            FILE_TOKEN_CACHE.move_to_end(full)
+            return cached[3]
+    try:
+        with open(full, "rb") as f:
+            raw = f.read(TOKEN_FILE_SAMPLE_BYTES)
+    except OSError:
+        return 0
+    count = count_tokens(raw.decode("utf-8", errors="replace"), family)
+    if size > len(raw) and raw:
+        count = int(count * size / len(raw))
+    with TOKEN_LOCK:
+        FILE_TOKEN_CACHE[full] = (mtime, size, family, count)
+        while len(FILE_TOKEN_CACHE) > TOKEN_CACHE_SIZE:
+            FILE_TOKEN_CACHE.popitem(last=False)
+    return count
+
+
+# ── Workspace Scanner ──────────────────────────
+
+SCAN_SKIP_DIRS = {".git", "node_modules", "__pycache__", "dist", "build", ".next", "venv", ".venv", ".tox", "egg-info"}
+SCAN_SKIP_EXT = {".pyc", ".pyo", ".exe", ".dll", ".so", ".o", ".class", ".png", ".jpg", ".gif", ".ico", ".woff", ".woff2", ".ttf", ".map"}
+SCAN_TTL = 2.0  # seconds a validated snapshot is served without re-statting directories
+
+# Snapshot of each workspace: dirs maps rel dir -> {mtime, files, subdirs}; files
+# is the flattened walk-order list served to callers. A directory is only
+# re-listed when its own mtime changes (entries added, removed or renamed);
+# the files of an unchanged directory are re-statted, since an in-place edit
+# leaves the directory's mtime alone.
+SCAN_CACHES = {}  # {root: {dirs, files, checked, lock}}
+SCAN_LOCK = threading.Lock()
+
+
+def _scan_dir(root, rel):
+    full_dir = os.path.join(root, rel) if rel else root
+    files, subdirs = [], []
+    with os.scandir(full_dir) as it:
+        for entry in it:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name not in SCAN_SKIP_DIRS and not entry.name.startswith("."):
+                        subdirs.append(entry.name)
+                elif entry.is_file():
+                    st = entry.stat()
+                    path = f"{rel}/{entry.name}" if rel else entry.name
+                    files.append({"path": path, "full": entry.path.replace("\\", "/"), "name": entry.name,
+                                  "ext": os.path.splitext(entry.name)[1].lower(),
+                                  "size": st.st_size, "mtime": st.st_mtime})
+            except OSError:
+                continue
+    files.sort(key=lambda f: f["name"])
+    subdirs.sort()
+    return {"mtime": os.stat(full_dir).st_mtime_ns, "files": files, "subdirs": subdirs}
 
 
-def _get_workspace_tree(max_files=200):
-    """Return compact workspace file listing with sizes."""
-    skip_dirs = {".git", "node_modules", "__pycache__", "dist", "build", ".next", "venv", ".venv", ".tox", "egg-info"}
-    skip_ext = {".pyc", ".pyo", ".exe", ".dll", ".so", ".o", ".class", ".png", ".jpg", ".gif", ".ico", ".woff", ".woff2", ".ttf", ".map"}
-    files = []
-    for root, dirs, filenames in os.walk(WORKSPACE):
-        dirs[:] = sorted([d for d in dirs if d not in skip_dirs and not d.startswith(".")])
-        for fn in sorted(filenames):
-            ext = os.path.splitext(fn)[1].lower()
-            if ext in skip_ext:
+def _restat_files(files):
+    """Refresh size/mtime of a listed directory's files in place; returns whether any changed."""
+    changed = False
+    for i, entry in enumerate(files):
+        try:
+            st = os.stat(entry["full"])
+        except OSError:
+            continue
+        if st.st_size != entry["size"] or st.st_mtime != entry["mtime"]:
+            # A new dict, so lists already handed to callers keep a consistent snapshot
+            files[i] = {**entry, "size": st.st_size, "mtime": st.st_mtime}
+            changed = True
+    return changed
+
+
+def _revalidate_scan(root, cache):
+    """Walk the cached directory tree, re-listing directories whose mtime changed and re-statting the rest."""
+    old_dirs = cache["dirs"]
+    new_dirs = {}
+    changed = not old_dirs
+    stack = [""]
+    while stack:
+        rel = stack.pop()
+        cached = old_dirs.get(rel)
+        try:
+            mtime = os.stat(os.path.join(root, rel) if rel else root).st_mtime_ns
+            if cached is None or cached["mtime"] != mtime:
+                cached = _scan_dir(root, rel)
+                changed = True
+            elif _restat_files(cached["files"]):
+                changed = True
+        except OSError:
+            changed = True
+            continue
+        new_dirs[rel] = cached
+        stack.extend(f"{rel}/{d}" if rel else d for d in reversed(cached["subdirs"]))
+    if changed or len(new_dirs) != len(old_dirs):
+        files = []
+        stack = [""]
+        while stack:
+            rel = stack.pop()
+            d = new_dirs.get(rel)
+            if d is None:
                 continue
-            full = os.path.join(root, fn)
-            rel = os.path.relpath(full, WORKSPACE).replace("\\", "/")
-            try:
-                size = os.path.getsize(full)
-            except Exception:
-                size = 0
-            files.append({"path": rel, "size": size, "tokens": size // 4})
-            if len(files) >= max_files:
-                break
-        if len(files) >= max_files:
-            break
+            files.extend(d["files"])
+            stack.extend(f"{rel}/{s}" if rel else s for s in reversed(d["subdirs"]))
+        cache["files"] = files
+    cache["dirs"] = new_dirs
+
+
+def scan_workspace(root=None, text_only=False):
+    """Return the cached workspace file list [{path, full, name, ext, size, mtime}] in walk order."""
+    root = root or current_workspace()
+    with SCAN_LOCK:
+        cache = SCAN_CACHES.get(root)
+        if cache is None:
+            cache = SCAN_CACHES[root] = {"dirs": {}, "files": [], "checked": 0.0, "lock": threading.Lock()}
+    with cache["lock"]:
+        now = time.monotonic()
+        if now - cache["checked"] > SCAN_TTL:
+            _revalidate_scan(root, cache)
+            cache["checked"] = now
+        files = cache["files"]
+    if text_only:
+        return [f for f in files if f["ext"] not in SCAN_SKIP_EXT]
     return files
 
 
+def invalidate_scan(path=None, root=None):
+    """Force revalidation on the next scan (of every workspace, or just root); with a path, also drop its directory listing."""
+    with SCAN_LOCK:
+        caches = [(r, c) for r, c in SCAN_CACHES.items() if root is None or r == root]
+    parent = os.path.dirname(os.path.abspath(path)) if path else None
+    for cache_root, cache in caches:
+        with cache["lock"]:
+            cache["checked"] = 0.0
+            if parent and (parent == cache_root or parent.startswith(cache_root + os.sep)):
+                rel = os.path.relpath(parent, cache_root).replace("\\", "/")
+                cache["dirs"].pop("" if rel == "." else rel, None)
+
+
+def _get_workspace_tree(max_files=200, family="default"):
+    """Return compact workspace file listing with sizes and token counts."""
+    return [{"path": f["path"], "size": f["size"], "tokens": count_file_tokens(f["full"], family, f["size"], f["mtime"])}
+            for f in scan_workspace(text_only=True)[:max_files]]
+
+
 def _build_file_skeleton(path, content):
     """Build a skeleton summary of a file: imports + function/class signatures."""
     ext = os.path.splitext(path)[1].lower()
@@ -87,12 +355,563 @@ def _build_file_skeleton(path, content):
     return "\n".join(parts) if parts else "\n".join(lines[:30]) + "\n// ..."
 
 
-# ── Security & Approval ──────────────────────────
+# ── Shared State ──────────────────────────────
+
+# Small settings (approval mode, MCP servers, active workspace) live behind a
+# store rather than in bare globals, so concurrent requests can't interleave
+# half-applied updates. A single process uses an in-memory store guarded by
+# a lock; multi-worker servers (cli.py --workers) set TETSUO_STATE_DB so every
+# worker shares one SQLite file instead. Edits themselves go to the
+# workspace's edit journal below.
+
+STATE_DB = os.environ.get("TETSUO_STATE_DB", "")
+STATE_BUSY_TIMEOUT = 10.0  # seconds a writer waits on another worker's transaction
+
+
+class MemoryState:
+    """Thread-safe in-process store."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.settings = {}
+
+    def get(self, key, default=None):
+        with self.lock:
+            return self.settings.get(key, default)
+
+    def set(self, key, value):
+        with self.lock:
+            self.settings[key] = value
+
+    def update(self, key, fn, default=None):
+        """Atomically replace settings[key] with fn(current); returns the new value."""
+        with self.lock:
+            value = self.settings[key] = fn(self.settings.get(key, default))
+            return value
+
+    def items(self, prefix):
+        with self.lock:
+            return [(k, v) for k, v in self.settings.items() if k.startswith(prefix)]
+
+    def delete(self, key, expected):
+        """Remove key if it still holds expected; returns whether it did."""
+        with self.lock:
+            if self.settings.get(key) != expected:
+                return False
+            del self.settings[key]
+            return True
+
+
+class SqliteStore:
+    """Per-thread connections and write transactions on one SQLite file (WAL mode)."""
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    def _db(self):
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=STATE_BUSY_TIMEOUT, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.local.db = db
+        return db
+
+    @contextlib.contextmanager
+    def _tx(self):
+        """Write transaction; BEGIN IMMEDIATE takes the write lock up front so read-modify-write can't race."""
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+
+class SqliteState(SqliteStore):
+    """Settings shared by worker processes through one SQLite file."""
+
+    def __init__(self, path):
+        super().__init__(path)
+        with self._tx() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)")
+
+    def get(self, key, default=None):
+        row = self._db().execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set(self, key, value):
+        with self._tx() as db:
+            db.execute("INSERT OR REPLACE INTO settings VALUES (?, ?)", (key, json.dumps(value)))
+
+    def update(self, key, fn, default=None):
+        with self._tx() as db:
+            row = db.execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+            value = fn(json.loads(row[0]) if row else default)
+            db.execute("INSERT OR REPLACE INTO settings VALUES (?, ?)", (key, json.dumps(value)))
+            return value
+
+    def items(self, prefix):
+        rows = self._db().execute("SELECT key, value FROM settings WHERE substr(key, 1, ?) = ?",
+                                  (len(prefix), prefix)).fetchall()
+        return [(k, json.loads(v)) for k, v in rows]
+
+    def delete(self, key, expected):
+        with self._tx() as db:
+            return db.execute("DELETE FROM settings WHERE key = ? AND value = ?",
+                              (key, json.dumps(expected))).rowcount > 0
+
+
+STATE = SqliteState(STATE_DB) if STATE_DB else MemoryState()
+
+
+# ── Edit Journal ──────────────────────────────
+
+# Undo history and pending edits are journaled per workspace under
+# .tetsuo/journal: entries in a SQLite file (so they survive restarts and are
+# shared by worker processes) and file contents as content-addressed, zlib
+# compressed blobs. A blob whose parent version is already stored is kept as
+# a line delta against it when that is smaller, so repeated edits to a big
+# file cost roughly the size of each change. Decoded blobs are cached up to
+# JOURNAL_MEMORY_BYTES; past JOURNAL_DISK_BYTES unreferenced blobs are
+# removed first, then the oldest undo entries. Undo history and pending
+# edits are per session: each browser sees and reverts only its own.
+
+JOURNAL_DIR = "journal"  # under INDEX_DIR
+JOURNAL_MEMORY_BYTES = int(os.environ.get("TETSUO_JOURNAL_MEMORY_MB", "32")) << 20
+JOURNAL_DISK_BYTES = int(os.environ.get("TETSUO_JOURNAL_DISK_MB", "256")) << 20
+JOURNAL_DELTA_MIN_CHARS = 4096  # smaller contents are stored whole
+JOURNAL_MAX_CHAIN = 16  # deltas on deltas before a blob is stored whole again
+JOURNAL_GRACE = 60.0  # seconds a fresh blob is safe from collection before its entry lands
+
+
+def _new_edit_id():
+    return f"pe_{int(time.time() * 1000)}_{os.urandom(3).hex()}"
+
+
+def _line_delta(base, content):
+    """Ops rebuilding content from base: [i1, i2] copies base lines, a string is new text."""
+    base_lines, lines = base.splitlines(keepends=True), content.splitlines(keepends=True)
+    ids = {}
+    a = [ids.setdefault(line, len(ids)) for line in base_lines]
+    b = [ids.setdefault(line, len(ids)) for line in lines]
+    ops = []
+    for tag, i1, i2, j1, j2 in _opcodes(a, b):
+        if tag == "equal":
+            ops.append([i1, i2])
+        elif j1 < j2:
+            ops.append("".join(lines[j1:j2]))
+    return ops
+
+
+def _apply_line_delta(base, ops):
+    base_lines = base.splitlines(keepends=True)
+    return "".join(op if isinstance(op, str) else "".join(base_lines[op[0]:op[1]]) for op in ops)
+
+
+class EditJournal(SqliteStore):
+    """Content-addressed, delta-compressed edit history for one workspace."""
+
+    def __init__(self, directory):
+        self.dir = directory
+        self.objects = os.path.join(directory, "objects")
+        os.makedirs(self.objects, exist_ok=True)
+        super().__init__(os.path.join(directory, "journal.db"))
+        self.cache = collections.OrderedDict()  # {hash: content}, LRU order
+        self.cache_bytes = 0
+        self.cache_lock = threading.Lock()
+        with self._tx() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS history (id INTEGER PRIMARY KEY AUTOINCREMENT, path TEXT, entry TEXT,"
+                       " session TEXT)")
+            db.execute("CREATE TABLE IF NOT EXISTS pending (id TEXT PRIMARY KEY, entry TEXT, created REAL, session TEXT)")
+            db.execute("CREATE TABLE IF NOT EXISTS blobs (hash TEXT PRIMARY KEY, size INTEGER, base TEXT,"
+                       " depth INTEGER, created REAL)")
+            for table in ("history", "pending"):  # journals written before entries were per session
+                if "session" not in [row[1] for row in db.execute(f"PRAGMA table_info({table})")]:
+                    db.execute(f"ALTER TABLE {table} ADD COLUMN session TEXT")
+            db.execute("CREATE INDEX IF NOT EXISTS history_session ON history (session, id)")
+
+    # Blobs
+
+    def drop_cache(self):
+        with self.cache_lock:
+            self.cache.clear()
+            self.cache_bytes = 0
+
+    def _blob_path(self, digest):
+        return os.path.join(self.objects, digest[:2], digest[2:])
+
+    def _cache_put(self, digest, content):
+        with self.cache_lock:
+            if digest in self.cache:
+                self.cache.move_to_end(digest)
+                return
+            self.cache[digest] = content
+            self.cache_bytes += len(content)
+            while self.cache_bytes > JOURNAL_MEMORY_BYTES and self.cache:
+                _, old = self.cache.popitem(last=False)
+                self.cache_bytes -= len(old)
+
+    def put(self, content, base=None):
+        """Store content (as a delta against blob `base` when smaller); returns its hash."""
+        raw = content.encode("utf-8", "surrogatepass")
+        digest = hashlib.sha1(raw).hexdigest()
+        with self._tx() as db:
+            # Refresh an existing blob's grace period: the entry about to reference it isn't written yet
+            reused = db.execute("UPDATE blobs SET created = ? WHERE hash = ?", (time.time(), digest)).rowcount
+        if reused:
+            self._cache_put(digest, content)
+            return digest
+        db = self._db()
+        data, base_hash, depth = b"F" + zlib.compress(raw), None, 0
+        row = db.execute("SELECT depth FROM blobs WHERE hash = ?", (base,)).fetchone() if base else None
+        if row and row[0] < JOURNAL_MAX_CHAIN and len(content) >= JOURNAL_DELTA_MIN_CHARS:
+            ops = json.dumps(_line_delta(self.get(base), content)).encode("utf-8", "surrogatepass")
+            delta = b"D" + base.encode() + zlib.compress(ops)
+            if len(delta) < len(data):
+                data, base_hash, depth = delta, base, row[0] + 1
+        path = self._blob_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        with self._tx() as db:
+            db.execute("INSERT OR IGNORE INTO blobs VALUES (?, ?, ?, ?, ?)",
+                       (digest, len(data), base_hash, depth, time.time()))
+        self._cache_put(digest, content)
+        self._enforce_limits()
+        return digest
+
+    def get(self, digest):
+        with self.cache_lock:
+            if digest in self.cache:
+                self.cache.move_to_end(digest)
+                return self.cache[digest]
+        with open(self._blob_path(digest), "rb") as f:
+            data = f.read()
+        if data[:1] == b"D":
+            ops = json.loads(zlib.decompress(data[41:]).decode("utf-8", "surrogatepass"))
+            content = _apply_line_delta(self.get(data[1:41].decode()), ops)
+        else:
+            content = zlib.decompress(data[1:]).decode("utf-8", "surrogatepass")
+        self._cache_put(digest, content)
+        return content
+
+    def _collect(self, trim):
+        """Delete blobs nothing references (optionally after dropping the oldest half of history); returns bytes left."""
+        with self._tx() as db:
+            if trim:
+                count = db.execute("SELECT COUNT(*) FROM history").fetchone()[0]
+                db.execute("DELETE FROM history WHERE id IN (SELECT id FROM history ORDER BY id LIMIT ?)",
+                           (count // 2 or count,))
+            entries = [json.loads(r[0]) for r in db.execute("SELECT entry FROM history UNION ALL SELECT entry FROM pending")]
+            blobs = {h: (size, base, created) for h, size, base, created in
+                     db.execute("SELECT hash, size, base, created FROM blobs")}
+            live, stack = set(), [e[k] for e in entries for k in ("old", "new")]
+            while stack:
+                h = stack.pop()
+                if h in blobs and h not in live:
+                    live.add(h)
+                    if blobs[h][1]:
+                        stack.append(blobs[h][1])
+            cutoff = time.time() - JOURNAL_GRACE  # a fresh blob's entry may not be written yet
+            dead = [h for h, (_, _, created) in blobs.items() if h not in live and created < cutoff]
+            db.executemany("DELETE FROM blobs WHERE hash = ?", [(h,) for h in dead])
+        for h in dead:
+            with contextlib.suppress(OSError):
+                os.remove(self._blob_path(h))
+        dead = set(dead)
+        return sum(size for h, (size, _, _) in blobs.items() if h not in dead)
+
+    def _enforce_limits(self):
+        total = self._db().execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+        if total > JOURNAL_DISK_BYTES and self._collect(trim=False) > JOURNAL_DISK_BYTES:
+            self._collect(trim=True)
+
+    # Undo history
+
+    def push_edit(self, entry, limit, session=None):
+        """Append entry to session's undo history, keeping its newest limit entries."""
+        with self._tx() as db:
+            db.execute("INSERT INTO history (path, entry, session) VALUES (?, ?, ?)",
+                       (entry["path"], json.dumps(entry), session))
+            db.execute("DELETE FROM history WHERE session IS ? AND id <= (SELECT id FROM history WHERE session IS ?"
+                       " ORDER BY id DESC LIMIT 1 OFFSET ?)", (session, session, limit))
+
+    def pop_edit(self, path=None, session=None):
+        """Remove and return session's newest entry, or its newest for path."""
+        with self._tx() as db:
+            if path:
+                row = db.execute("SELECT id, entry FROM history WHERE session IS ? AND path = ? ORDER BY id DESC"
+                                 " LIMIT 1", (session, path)).fetchone()
+            else:
+                row = db.execute("SELECT id, entry FROM history WHERE session IS ? ORDER BY id DESC LIMIT 1",
+                                 (session,)).fetchone()
+            if not row:
+                return None
+            db.execute("DELETE FROM history WHERE id = ?", (row[0],))
+            return json.loads(row[1])
+
+    def recent_edits(self, n, session=None):
+        rows = self._db().execute("SELECT entry FROM history WHERE session IS ? ORDER BY id DESC LIMIT ?",
+                                  (session, n)).fetchall()
+        return [json.loads(r[0]) for r in reversed(rows)]
+
+    # Pending edits
+
+    def add_pending(self, entry, session=None):
+        edit_id = _new_edit_id()
+        with self._tx() as db:
+            db.execute("INSERT INTO pending VALUES (?, ?, ?, ?)", (edit_id, json.dumps(entry), time.time(), session))
+        return edit_id
+
+    def take_pending(self, edit_id, session=None):
+        with self._tx() as db:
+            row = db.execute("SELECT entry FROM pending WHERE id = ? AND session IS ?", (edit_id, session)).fetchone()
+            if not row:
+                return None
+            db.execute("DELETE FROM pending WHERE id = ?", (edit_id,))
+            return json.loads(row[0])
+
+    def pending_edits(self, session=None):
+        rows = self._db().execute("SELECT id, entry FROM pending WHERE session IS ? ORDER BY created",
+                                  (session,)).fetchall()
+        return [(r[0], json.loads(r[1])) for r in rows]
+
+    def forget_session(self, session):
+        """Drop an expired session's undo history and pending edits."""
+        with self._tx() as db:
+            db.execute("DELETE FROM history WHERE session IS ?", (session,))
+            db.execute("DELETE FROM pending WHERE session IS ?", (session,))
+
+
+JOURNALS = {}  # {workspace root: EditJournal}
+JOURNAL_LOCK = threading.Lock()
+
+
+def journal():
+    """The edit journal of the current workspace (in the temp dir if the workspace is read-only)."""
+    root = current_workspace()
+    with JOURNAL_LOCK:
+        j = JOURNALS.get(root)
+        if j is None:
+            try:
+                j = EditJournal(os.path.join(tetsuo_dir(root), JOURNAL_DIR))
+            except (OSError, sqlite3.Error):
+                key = hashlib.sha1(root.encode("utf-8", "surrogatepass")).hexdigest()[:12]
+                j = EditJournal(os.path.join(tempfile.gettempdir(), f"tetsuo-journal-{key}"))
+            j = JOURNALS[root] = j
+        return j
+
+
+def record_edit(path, old_content, new_content, tool):
+    """Journal an applied edit onto the current session's undo history."""
+    j = journal()
+    old = j.put(old_content)
+    j.push_edit({"path": path, "tool": tool, "timestamp": time.time(), "old": old,
+                 "new": j.put(new_content, base=old)}, MAX_UNDO_HISTORY, current_session())
+
+
+def stage_edit(path, old_content, new_content, diff, tool):
+    """Journal an edit awaiting the current session's approval; returns its pending id."""
+    j = journal()
+    old = j.put(old_content)
+    return j.add_pending({"path": path, "tool": tool, "timestamp": time.time(), "diff": diff, "old": old,
+                          "new": j.put(new_content, base=old)}, current_session())
+
+
+# ── Sessions ──────────────────────────────────
+
+# Each browser session (cookie, or header for API clients) has a record in
+# STATE: {workspace, require_approval, seen}. Caches are keyed by workspace
+# root, so sessions on the same directory share them; a reaper drops the
+# caches of workspaces no request has touched for SESSION_IDLE seconds, and
+# earlier when one holds more than TENANT_CACHE_BYTES or all of them more
+# than CACHE_BUDGET_BYTES. Records unseen for SESSION_TTL are deleted along
+# with the session's undo history and pending edits.
+SESSION_COOKIE = "tetsuo_session"
+SESSION_HEADER = "X-Tetsuo-Session"
+SESSION_ID_RE = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+SESSION_IDLE = float(os.environ.get("TETSUO_SESSION_IDLE", "1800"))
+SESSION_TTL = float(os.environ.get("TETSUO_SESSION_TTL", str(7 * 86400)))
+SESSION_SEEN_REFRESH = 300.0  # seconds between last-seen writes to a session's record
+SESSION_ACTIVE = 60.0  # seconds since last use during which a workspace is never evicted
+SESSION_REAP_INTERVAL = 30.0
+TENANT_CACHE_BYTES = int(os.environ.get("TETSUO_TENANT_CACHE_MB", "256")) << 20
+CACHE_BUDGET_BYTES = int(os.environ.get("TETSUO_CACHE_MB", "1024")) << 20
 
-PENDING_EDITS = {}  # {id: {path, old_content, new_content, diff, tool, timestamp}}
-REQUIRE_APPROVAL = False
-MCP_SERVERS = []  # [{name, url, tools}]
-FILE_MTIMES = {}  # {path: mtime} for file watcher
+CURRENT_WORKSPACE = contextvars.ContextVar("tetsuo_workspace", default=None)
+CURRENT_SESSION = contextvars.ContextVar("tetsuo_session", default=None)
+WORKSPACE_USAGE = {}  # {root: monotonic time of last use}
+SESSION_LOCK = threading.Lock()
+REAPER = {"thread": None}
+
+
+def current_workspace():
+    """The workspace of the request (or tool call) being served; the startup workspace otherwise."""
+    return CURRENT_WORKSPACE.get() or WORKSPACE
+
+
+def current_session():
+    """The session id of the request (or tool call) being served, or None."""
+    return CURRENT_SESSION.get()
+
+
+def session_record(sid):
+    """sid's record in STATE ({} if it has none), marking it seen every SESSION_SEEN_REFRESH seconds."""
+    record = (STATE.get(f"session:{sid}") if sid else None) or {}
+    if record and time.time() - record.get("seen", 0) > SESSION_SEEN_REFRESH:
+        record = update_session(sid)
+    return record
+
+
+def update_session(sid, **changes):
+    """Merge changes into sid's record and mark it seen; returns the record."""
+    return STATE.update(f"session:{sid}", lambda record: {**(record or {}), **changes, "seen": time.time()})
+
+
+def session_workspace(sid):
+    """The workspace sid has selected, or the startup workspace."""
+    path = session_record(sid).get("workspace")
+    return path if path and os.path.isdir(path) else WORKSPACE
+
+
+def approval_required():
+    """Whether the current session stages edits for approval instead of applying them."""
+    return bool(session_record(current_session()).get("require_approval"))
+
+
+def _touch_workspace(root):
+    with SESSION_LOCK:
+        WORKSPACE_USAGE[root] = time.monotonic()
+        if REAPER["thread"] is None:
+            REAPER["thread"] = threading.Thread(target=_reap_loop, daemon=True, name="tetsuo-reaper")
+            REAPER["thread"].start()
+
+
+def enter_workspace(root, session=None):
+    """Make root and session the workspace and session of the current context (request thread or task)."""
+    CURRENT_WORKSPACE.set(root)
+    CURRENT_SESSION.set(session)
+    _touch_workspace(root)
+
+
+def in_workspace(root, fn, *args, session=None):
+    """Call fn(*args) with root as the current workspace (and session's), e.g. on a pool thread."""
+    token, session_token = CURRENT_WORKSPACE.set(root), CURRENT_SESSION.set(session)
+    try:
+        _touch_workspace(root)
+        return fn(*args)
+    finally:
+        CURRENT_SESSION.reset(session_token)
+        CURRENT_WORKSPACE.reset(token)
+
+
+def workspace_footprint(root):
+    """Rough bytes held in memory for root by the scanner, index, symbol table, journal and line index."""
+    total = 0
+    cache = SCAN_CACHES.get(root)
+    if cache:
+        total += len(cache["files"]) * 400 + len(cache["dirs"]) * 200
+    idx = INDEXES.get(root)
+    if idx:
+        total += sum(len(entry["terms"]) for entry in list(idx["files"].values())) * 120
+    table = SYMBOL_TABLES.get(root)
+    if table:
+        total += sum(len(entry["symbols"]) for entry in list(table["files"].values())) * 250
+    j = JOURNALS.get(root)
+    if j:
+        total += j.cache_bytes
+    git = GIT_CACHE.get(root, {})
+    total += sum(len(text) for kind in ("staged", "unstaged") if kind in git for text in git[kind][1].values())
+    total += sum(len(entry["rows"]) * 120 + len(entry["commits"]) * 200
+                 for entry in list(git.get("blame", {}).values()))
+    prefix = root + os.sep
+    with LINE_INDEX_LOCK:
+        total += sum(len(offsets) * offsets.itemsize for path, (_, _, offsets) in LINE_INDEX_CACHE.items()
+                     if path.startswith(prefix))
+    return total
+
+
+def evict_workspace(root):
+    """Drop root's in-memory caches; each is rebuilt (or reloaded from disk) on next use."""
+    with SCAN_LOCK:
+        SCAN_CACHES.pop(root, None)
+    with GIT_LOCK:
+        git = GIT_CACHE.pop(root, None) or {}
+    for pool in git.get("batch", {}).values():
+        pool.close()
+    with INDEX_LOCK:
+        idx = INDEXES.pop(root, None)
+        if idx:
+            _flush_index(idx)
+    with SYMBOL_LOCK:
+        SYMBOL_TABLES.pop(root, None)
+    j = JOURNALS.get(root)
+    if j:
+        j.drop_cache()
+    prefix = root + os.sep
+    with LINE_INDEX_LOCK:
+        for path in [p for p in LINE_INDEX_CACHE if p.startswith(prefix)]:
+            _, _, offsets = LINE_INDEX_CACHE.pop(path)
+            LINE_INDEX_STATE["bytes"] -= len(offsets) * offsets.itemsize
+    stop_watcher(root)
+    with SESSION_LOCK:
+        WORKSPACE_USAGE.pop(root, None)
+
+
+def reap_workspaces():
+    """Evict idle workspaces' caches; returns the roots evicted."""
+    with WATCH_LOCK:
+        followed = {sub["root"] for sub in WATCH_SUBSCRIBERS}
+    now = time.monotonic()
+    with SESSION_LOCK:
+        for root in followed:
+            WORKSPACE_USAGE[root] = now  # an open events stream is an open tab
+        usage = dict(WORKSPACE_USAGE)
+    roots = set(SCAN_CACHES) | set(INDEXES) | set(SYMBOL_TABLES) | set(usage)
+    sizes = {root: workspace_footprint(root) for root in roots}
+    evicted = []
+    # Least recently used first, so the budget pass below drops the stalest
+    for root in sorted(roots, key=lambda r: usage.get(r, 0.0)):
+        idle = now - usage.get(root, 0.0)
+        over_budget = sum(sizes.values()) > CACHE_BUDGET_BYTES
+        if idle > SESSION_IDLE or (idle > SESSION_ACTIVE and (sizes[root] > TENANT_CACHE_BYTES or over_budget)):
+            evict_workspace(root)
+            sizes.pop(root)
+            evicted.append(root)
+    return evicted
+
+
+def reap_sessions():
+    """Delete session records unseen for SESSION_TTL, and those sessions' journal entries; returns their ids."""
+    cutoff = time.time() - SESSION_TTL
+    expired = [key[len("session:"):] for key, record in STATE.items("session:")
+               if (record or {}).get("seen", 0) < cutoff and STATE.delete(key, record)]
+    if expired:
+        with JOURNAL_LOCK:
+            journals = list(JOURNALS.values())
+        for j in journals:
+            for sid in expired:
+                j.forget_session(sid)
+    return expired
+
+
+def _reap_loop():
+    while True:
+        time.sleep(SESSION_REAP_INTERVAL)
+        try:
+            reap_workspaces()
+            reap_sessions()
+        except Exception:
+            pass
+
+
+# ── Security & Approval ──────────────────────────
 
 DANGEROUS_PATTERNS = [
     "rm -rf /", "rm -rf ~", "rm -rf .", "mkfs.", "dd if=/dev", ":(){",
@@ -106,14 +925,21 @@ def _resolve_path(path):
     """Resolve path to absolute, ensure within workspace."""
     if not path:
         return None
+    root = current_workspace()
     if not os.path.isabs(path):
-        path = os.path.join(WORKSPACE, path)
+        path = os.path.join(root, path)
     abs_path = os.path.abspath(path)
-    if not abs_path.startswith(os.path.abspath(WORKSPACE)):
+    if not abs_path.startswith(os.path.abspath(root)):
         return None
     return abs_path
 
 
+def _is_internal(path):
+    """Whether path lies in the workspace's .tetsuo directory (index, journal), which tools must not write."""
+    internal = os.path.join(os.path.abspath(current_workspace()), INDEX_DIR)
+    return path == internal or path.startswith(internal + os.sep)
+
+
 def _is_dangerous(command):
     """Check for dangerous command patterns. Returns matched pattern or None."""
     cl = command.lower().strip()
@@ -175,6 +1001,20 @@ PROVIDERS = {
     },
 }
 
+# Point a provider at a proxy, gateway or local stand-in (e.g. TETSUO_OPENAI_BASE_URL)
+for _pid, _provider in PROVIDERS.items():
+    _provider["base_url"] = os.environ.get(f"TETSUO_{_pid.upper()}_BASE_URL", _provider["base_url"]).rstrip("/")
+
+MODEL_CONTEXT_LIMITS = {
+    "grok-4-1-fast-reasoning": 131072, "grok-3-fast": 131072, "grok-3": 131072, "grok-3-mini": 131072,
+    "gpt-4o": 128000, "gpt-4o-mini": 128000, "o1": 200000, "o1-mini": 128000,
+    "claude-sonnet-4-5-20250929": 200000, "claude-haiku-4-5-20251001": 200000,
+}
+
+
+def context_limit(model):
+    return MODEL_CONTEXT_LIMITS.get(model, 131072)
+
 SYSTEM_PROMPT = """You are tetsuocode, an elite AI coding assistant. You are powered by Grok.
 
 When responding:
@@ -186,9 +1026,11 @@ When responding:
 TOOL_DEFINITIONS = [
     {"type": "function", "function": {
         "name": "read_file",
-        "description": "Read the contents of a file at the given path.",
+        "description": "Read the contents of a file at the given path, optionally only a range of lines.",
         "parameters": {"type": "object", "properties": {
-            "path": {"type": "string", "description": "Path to the file"}
+            "path": {"type": "string", "description": "Path to the file"},
+            "start_line": {"type": "integer", "description": "First line to read (1-based, optional)"},
+            "end_line": {"type": "integer", "description": "Last line to read, inclusive (optional)"},
         }, "required": ["path"]},
     }},
     {"type": "function", "function": {
@@ -234,13 +1076,85 @@ TOOL_DEFINITIONS = [
 ]
 
 
+# ── Provider HTTP Sessions ──────────────────────
+
+HTTP_POOL_SIZE = int(os.environ.get("TETSUO_HTTP_POOL_SIZE", "16"))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("TETSUO_HTTP_CONNECT_TIMEOUT", "10"))
+HTTP_TIMEOUTS = {  # read timeouts in seconds, overridable per kind via TETSUO_HTTP_TIMEOUT_<KIND>
+    kind: float(os.environ.get(f"TETSUO_HTTP_TIMEOUT_{kind.upper()}", default))
+    for kind, default in {"chat": 120, "complete": 10, "mcp": 30}.items()
+}
+
+HTTP_SESSIONS = {}  # {origin: requests.Session} with keep-alive connection pools
+HTTP_LOCK = threading.Lock()
+
+
+def _origin(url):
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def http_session(url):
+    """Return the pooled keep-alive session for url's origin, creating it on first use."""
+    origin = _origin(url)
+    with HTTP_LOCK:
+        session = HTTP_SESSIONS.get(origin)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            HTTP_SESSIONS[origin] = session
+    return session
+
+
+def http_post(url, kind="chat", **kwargs):
+    """POST through the pooled session for url using the configured timeout for kind."""
+    kwargs.setdefault("timeout", (HTTP_CONNECT_TIMEOUT, HTTP_TIMEOUTS[kind]))
+    return http_session(url).post(url, **kwargs)
+
+
+def release_response(resp, reuse=True):
+    """Drain what is left of a streamed response so its connection goes back to the pool.
+
+    With reuse=False (a stream abandoned midway) the connection is closed
+    instead, rather than reading the rest of a reply nobody will see.
+    """
+    if not reuse:
+        resp.close()
+        return
+    try:
+        resp.raw.drain_conn()
+        resp.raw.release_conn()
+    except Exception:
+        resp.close()
+
+
+def http_pool_stats():
+    """Per-origin request and connection counts; requests > connections means reuse."""
+    stats = {}
+    with HTTP_LOCK:
+        sessions = list(HTTP_SESSIONS.items())
+    for origin, session in sessions:
+        reqs = conns = 0
+        adapter = session.get_adapter(origin)
+        for key in list(adapter.poolmanager.pools.keys()):
+            pool = adapter.poolmanager.pools.get(key)
+            if pool is not None:
+                reqs += pool.num_requests
+                conns += pool.num_connections
+        stats[origin] = {"requests": reqs, "connections": conns, "reused": max(0, reqs - conns),
+                         "reuse_ratio": round(1 - conns / reqs, 3) if reqs else 0.0}
+    return stats
+
+
 # ── Auth ──────────────────────────────────────
 
 @app.before_request
 def check_auth():
     if not AUTH_PASSWORD:
         return
-    if request.path in ("/api/auth",) or request.path.startswith("/static/"):
+    if request.path in ("/api/auth",) or request.path.startswith(("/static/", "/assets/")):
         return
     token = request.cookies.get("tetsuo_auth")
     expected = hashlib.sha256(AUTH_PASSWORD.encode()).hexdigest()
@@ -274,11 +1188,635 @@ def auth_check():
 
 # ── Diff ──────────────────────────────────────
 
-def compute_diff(old_content, new_content, path):
-    old_lines = old_content.splitlines(keepends=True)
-    new_lines = new_content.splitlines(keepends=True)
-    diff = difflib.unified_diff(old_lines, new_lines, fromfile=f"a/{path}", tofile=f"b/{path}", n=3)
-    return "".join(diff)
+# Unified diffs for write_file/edit_file. Lines are interned to ints, common
+# prefix and suffix are trimmed, and what remains is matched with patience
+# anchors (lines unique to both sides), falling back to linear-space Myers
+# between anchors. Matching blocks come out in file order, so formatting can
+# stop as soon as `limit` characters of diff exist. edit_file knows exactly
+# which span it replaced and diffs only those lines plus their context.
+
+DIFF_CONTEXT = 3
+DIFF_OUTPUT_LIMIT = 3000  # chars of diff returned to the model and kept on pending edits
+DIFF_MAX_COST = 1000  # edit distance Myers explores before treating a gap as one replace
+
+
+def _bisect(a, b):
+    """Myers middle snake of a and b as a split point (x, y), or None when cheaper to replace."""
+    n, m = len(a), len(b)
+    max_d = min((n + m + 1) // 2, DIFF_MAX_COST)
+    offset, size = max_d, 2 * max_d + 2
+    v1, v2 = [-1] * size, [-1] * size
+    v1[offset + 1] = v2[offset + 1] = 0
+    delta = n - m
+    front = delta % 2 != 0
+    k1start = k1end = k2start = k2end = 0
+    for d in range(max_d):
+        for k1 in range(-d + k1start, d + 1 - k1end, 2):
+            k1_off = offset + k1
+            if k1 == -d or (k1 != d and v1[k1_off - 1] < v1[k1_off + 1]):
+                x1 = v1[k1_off + 1]
+            else:
+                x1 = v1[k1_off - 1] + 1
+            y1 = x1 - k1
+            while x1 < n and y1 < m and a[x1] == b[y1]:
+                x1 += 1
+                y1 += 1
+            v1[k1_off] = x1
+            if x1 > n:
+                k1end += 2
+            elif y1 > m:
+                k1start += 2
+            elif front:
+                k2_off = offset + delta - k1
+                if 0 <= k2_off < size and v2[k2_off] != -1 and x1 >= n - v2[k2_off]:
+                    return x1, y1
+        for k2 in range(-d + k2start, d + 1 - k2end, 2):
+            k2_off = offset + k2
+            if k2 == -d or (k2 != d and v2[k2_off - 1] < v2[k2_off + 1]):
+                x2 = v2[k2_off + 1]
+            else:
+                x2 = v2[k2_off - 1] + 1
+            y2 = x2 - k2
+            while x2 < n and y2 < m and a[n - x2 - 1] == b[m - y2 - 1]:
+                x2 += 1
+                y2 += 1
+            v2[k2_off] = x2
+            if x2 > n:
+                k2end += 2
+            elif y2 > m:
+                k2start += 2
+            elif not front:
+                k1_off = offset + delta - k2
+                if 0 <= k1_off < size and v1[k1_off] != -1:
+                    x1 = v1[k1_off]
+                    if x1 >= n - x2:
+                        return x1, offset + x1 - k1_off
+    return None
+
+
+def _trimmed(a, b, i0, j0, inner):
+    """Yield the common prefix, inner's blocks for the middle, then the common suffix."""
+    n, m = len(a), len(b)
+    pre = 0
+    while pre < n and pre < m and a[pre] == b[pre]:
+        pre += 1
+    suf = 0
+    while suf < n - pre and suf < m - pre and a[n - 1 - suf] == b[m - 1 - suf]:
+        suf += 1
+    if pre:
+        yield i0, j0, pre
+    if pre < n - suf and pre < m - suf:
+        yield from inner(a[pre:n - suf], b[pre:m - suf], i0 + pre, j0 + pre)
+    if suf:
+        yield i0 + n - suf, j0 + m - suf, suf
+
+
+def _myers_blocks(a, b, i0, j0):
+    if set(a).isdisjoint(b):
+        return
+    split = _bisect(a, b)
+    if split is None:
+        return
+    x, y = split
+    yield from _trimmed(a[:x], b[:y], i0, j0, _myers_blocks)
+    yield from _trimmed(a[x:], b[y:], i0 + x, j0 + y, _myers_blocks)
+
+
+def _patience_blocks(a, b, i0, j0):
+    counts = {}
+    for line in a:
+        counts[line] = counts.get(line, 0) + 1
+    for line in b:
+        if counts.get(line, 0) == 1:
+            counts[line] = -1  # unique in a, seen once in b
+        elif counts.get(line) == -1:
+            counts[line] = 0  # seen twice in b
+    in_b = {line: j for j, line in enumerate(b) if counts.get(line) == -1}
+    pairs = [(i, in_b[line]) for i, line in enumerate(a) if line in in_b]
+    if not pairs:
+        yield from _myers_blocks(a, b, i0, j0)
+        return
+
+    # Longest increasing run of b positions, in a order (patience sorting)
+    tails, tail_js, links = [], [], []
+    for k, (_, j) in enumerate(pairs):
+        pos = bisect.bisect_left(tail_js, j)
+        links.append(tails[pos - 1] if pos else -1)
+        if pos == len(tails):
+            tails.append(k)
+            tail_js.append(j)
+        else:
+            tails[pos], tail_js[pos] = k, j
+    anchors, k = [], tails[-1]
+    while k != -1:
+        anchors.append(pairs[k])
+        k = links[k]
+    anchors.reverse()
+
+    pi = pj = 0
+    for i, j in anchors + [(len(a), len(b))]:
+        if pi < i and pj < j:
+            yield from _trimmed(a[pi:i], b[pj:j], i0 + pi, j0 + pj, _patience_blocks)
+        if i < len(a):
+            yield i0 + i, j0 + j, 1
+        pi, pj = i + 1, j + 1
+
+
+def _matching_blocks(a, b):
+    """Maximal matching blocks (i, j, size) of a and b, in order, ending with (len(a), len(b), 0)."""
+    cur = None
+    for block in _trimmed(a, b, 0, 0, _patience_blocks):
+        if cur and cur[0] + cur[2] == block[0] and cur[1] + cur[2] == block[1]:
+            cur = (cur[0], cur[1], cur[2] + block[2])
+            continue
+        if cur:
+            yield cur
+        cur = block
+    if cur:
+        yield cur
+    yield len(a), len(b), 0
+
+
+def _opcodes(a, b):
+    i = j = 0
+    for ai, bj, size in _matching_blocks(a, b):
+        if i < ai and j < bj:
+            yield "replace", i, ai, j, bj
+        elif i < ai:
+            yield "delete", i, ai, j, bj
+        elif j < bj:
+            yield "insert", i, ai, j, bj
+        if size:
+            yield "equal", ai, ai + size, bj, bj + size
+        i, j = ai + size, bj + size
+
+
+def _grouped_opcodes(codes, n):
+    """difflib.SequenceMatcher.get_grouped_opcodes over a lazy opcode stream."""
+    group, first = [], True
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == "equal":
+            if first:
+                i1, j1 = max(i1, i2 - n), max(j1, j2 - n)
+            elif i2 - i1 > 2 * n:
+                group.append((tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)))
+                yield group
+                group = []
+                i1, j1 = max(i1, i2 - n), max(j1, j2 - n)
+        first = False
+        group.append((tag, i1, i2, j1, j2))
+    if group and group[-1][0] == "equal":
+        tag, i1, i2, j1, j2 = group[-1]
+        group[-1] = (tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n))
+    if any(code[0] != "equal" for code in group):
+        yield group
+
+
+def _bounded(codes, old_lines, new_lines, limit):
+    """Cut the opcode stream once its changed lines alone would fill `limit` chars."""
+    size = 0
+    for code in codes:
+        yield code
+        tag, i1, i2, j1, j2 = code
+        if tag != "equal":
+            size += sum(map(len, old_lines[i1:i2])) + sum(map(len, new_lines[j1:j2])) + i2 - i1 + j2 - j1
+            if size >= limit:
+                return
+
+
+def _format_range(start, stop):
+    length = stop - start
+    if length == 1:
+        return str(start + 1)
+    return f"{start + 1 if length else start},{length}"
+
+
+def _unified(old_lines, new_lines, path, offset=0, limit=None):
+    """Unified diff text of two line lists starting at line `offset`, at most `limit` chars."""
+    ids = {}
+    a = [ids.setdefault(line, len(ids)) for line in old_lines]
+    b = [ids.setdefault(line, len(ids)) for line in new_lines]
+    codes = _opcodes(a, b)
+    if limit is not None:
+        codes = _bounded(codes, old_lines, new_lines, limit)
+    out, size = [], 0
+    for group in _grouped_opcodes(codes, DIFF_CONTEXT):
+        if not out:
+            out.append(f"--- a/{path}\n+++ b/{path}\n")
+        first, last = group[0], group[-1]
+        parts = [f"@@ -{_format_range(first[1] + offset, last[2] + offset)} "
+                 f"+{_format_range(first[3] + offset, last[4] + offset)} @@\n"]
+        for tag, i1, i2, j1, j2 in group:
+            if tag == "equal":
+                parts += [" " + line for line in old_lines[i1:i2]]
+                continue
+            if tag in ("replace", "delete"):
+                parts += ["-" + line for line in old_lines[i1:i2]]
+            if tag in ("replace", "insert"):
+                parts += ["+" + line for line in new_lines[j1:j2]]
+        out += parts
+        size += sum(map(len, parts))
+        if limit is not None and size >= limit:
+            break
+    text = "".join(out)
+    return text[:limit] if limit is not None else text
+
+
+def compute_diff(old_content, new_content, path, limit=None):
+    return _unified(old_content.splitlines(keepends=True), new_content.splitlines(keepends=True), path,
+                    limit=limit)
+
+
+def compute_edit_diff(content, start, old_string, new_string, path, limit=None):
+    """Diff of replacing content[start:start + len(old_string)] with new_string, touching only that region."""
+    end = start + len(old_string)
+    lo = content.rfind("\n", 0, start) + 1
+    for _ in range(DIFF_CONTEXT):
+        if lo == 0:
+            break
+        lo = content.rfind("\n", 0, lo - 1) + 1
+    hi = end
+    for _ in range(DIFF_CONTEXT + 1):
+        nl = content.find("\n", hi)
+        if nl == -1:
+            hi = len(content)
+            break
+        hi = nl + 1
+    old_region = content[lo:hi]
+    new_region = content[lo:start] + new_string + content[end:hi]
+    return _unified(old_region.splitlines(keepends=True), new_region.splitlines(keepends=True), path,
+                    offset=content.count("\n", 0, lo), limit=limit)
+
+
+# ── File Reads ──────────────────────────────
+
+# Reads stop at a character limit instead of loading the whole file first,
+# and can be narrowed to a byte window or a line range. /api/files/read tags
+# every response with an ETag of (inode, size, mtime) and answers a matching
+# If-None-Match with 304 before opening the file, so the browser cache makes
+# re-reading an unchanged tab nearly free.
+#
+# Line ranges go through a line-offset index (the byte offset of every line
+# start) built in one streaming pass and cached by (path, mtime, size), so a
+# window deep into a huge log is one seek and one read.
+
+FILE_READ_LIMIT = 200000  # chars returned by /api/files/read
+TOOL_READ_LIMIT = 100000  # chars returned by the read_file tool
+LINE_INDEX_CACHE_BYTES = 64 << 20  # offsets kept across all cached files
+
+LINE_INDEX_CACHE = collections.OrderedDict()  # {path: (mtime_ns, size, offsets)}, LRU order
+LINE_INDEX_LOCK = threading.Lock()
+LINE_INDEX_STATE = {"bytes": 0}
+
+
+def line_index(path):
+    """(offsets, size): byte offset of each line start in path, cached until the file changes."""
+    st = os.stat(path)
+    with LINE_INDEX_LOCK:
+        cached = LINE_INDEX_CACHE.get(path)
+        if cached and cached[:2] == (st.st_mtime_ns, st.st_size):
+            LINE_INDEX_CACHE.move_to_end(path)
+            return cached[2], st.st_size
+    with open(path, "rb") as f:
+        # Running sums of raw line lengths; the last one is the end of the file, not a line start
+        offsets = array("q", itertools.accumulate(map(len, f), initial=0))
+    size = offsets.pop()
+    with LINE_INDEX_LOCK:
+        old = LINE_INDEX_CACHE.pop(path, None)
+        if old:
+            LINE_INDEX_STATE["bytes"] -= old[2].itemsize * len(old[2])
+        LINE_INDEX_CACHE[path] = (st.st_mtime_ns, st.st_size, offsets)
+        LINE_INDEX_STATE["bytes"] += offsets.itemsize * len(offsets)
+        while LINE_INDEX_STATE["bytes"] > LINE_INDEX_CACHE_BYTES and len(LINE_INDEX_CACHE) > 1:
+            _, (_, _, dropped) = LINE_INDEX_CACHE.popitem(last=False)
+            LINE_INDEX_STATE["bytes"] -= dropped.itemsize * len(dropped)
+    return offsets, size
+
+
+def _split_lines(text):
+    """text as readlines() would return it: universal newlines, line endings kept."""
+    lines = text.replace("\r\n", "\n").split("\n")
+    last = lines.pop()
+    lines = [line + "\n" for line in lines]
+    if last:
+        lines.append(last)
+    return lines
+
+
+def read_lines(path, start, end=None):
+    """Lines [start, end) of path (0-based, like readlines()[start:end]) and the file's line count."""
+    offsets, size = line_index(path)
+    total = len(offsets)
+    end = total if end is None else max(start, min(end, total))
+    if start >= end:
+        return [], total
+    stop = offsets[end] if end < total else size
+    with open(path, "rb") as f:
+        f.seek(offsets[start])
+        data = f.read(stop - offsets[start])
+    return _split_lines(data.decode("utf-8", errors="replace")), total
+
+
+def file_etag(st):
+    return f"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"
+
+
+def _char_boundary(data, pos):
+    """pos moved forward past UTF-8 continuation bytes (at most 3) to the start of a character."""
+    stop = min(len(data), pos + 3)
+    while pos < stop and data[pos] & 0xC0 == 0x80:
+        pos += 1
+    return pos
+
+
+def read_text(path, limit, offset=None, length=None, start_line=None, end_line=None):
+    """Read up to limit chars of a text file, optionally a byte window or line range; returns (text, truncated).
+
+    Byte windows are widened to whole UTF-8 characters: both ends move forward
+    to the next character start, so consecutive windows tile the file.
+    """
+    if start_line or end_line:
+        offsets, size = line_index(path)
+        start = max(1, start_line or 1) - 1
+        end = len(offsets) if end_line is None else max(start, min(end_line, len(offsets)))
+        if start >= end:
+            return "", False
+        stop = offsets[end] if end < len(offsets) else size
+        with open(path, "rb") as f:
+            f.seek(offsets[start])
+            data = f.read(min(stop - offsets[start], limit * 4))  # utf-8 is at most 4 bytes a char
+        text = "".join(_split_lines(data.decode("utf-8", errors="replace")))
+        return text[:limit], len(text) > limit or offsets[start] + len(data) < stop
+    if offset is not None or length is not None:
+        offset = max(0, offset or 0)
+        size = limit if length is None else max(0, min(length, limit))
+        with open(path, "rb") as f:
+            f.seek(offset)
+            data = f.read(size + 3)  # room to finish a character split by the window's end
+            more = bool(f.read(1))
+        start = _char_boundary(data, 0) if offset else 0
+        end = max(start, _char_boundary(data, size))
+        truncated = (length is None or length > limit) and (end < len(data) or more)
+        return data[start:end].decode("utf-8", errors="replace"), truncated
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        text = f.read(limit)
+        return text, bool(f.read(1))
+
+
+def _int_arg(name):
+    value = request.args.get(name, "")
+    return int(value) if value.lstrip("-").isdigit() else None
+
+
+# ── Images ──────────────────────────────────
+
+# Uploaded and pasted images are stored once under IMAGE_DIR, named by the
+# SHA-1 of their bytes. Chat messages carry only a reference block,
+# {"type": "image_url", "image_url": {"url": "/api/images/<id>"}}, which the
+# browser can also render directly. provider_request swaps in a base64 copy
+# at send time, downscaled to IMAGE_MAX_EDGE when Pillow is installed. The
+# encoded copies are kept in an LRU keyed by id, so a tool loop doesn't
+# re-encode each turn.
+try:
+    from PIL import Image
+except ImportError:  # optional: pip install 'tetsuocode[images]'
+    Image = None
+
+IMAGE_DIR = os.environ.get("TETSUO_IMAGE_DIR") or os.path.join(tempfile.gettempdir(), "tetsuo-images")
+IMAGE_URL_PREFIX = "/api/images/"
+IMAGE_ID_RE = re.compile(r"^[0-9a-f]{40}$")
+IMAGE_MAX_BYTES = 20 << 20  # rejected on upload
+IMAGE_MODEL_BYTES = 5 << 20  # largest image sent to a provider
+IMAGE_MAX_EDGE = 1568  # longest side sent to a provider, when Pillow can resize
+IMAGE_DISK_BYTES = int(os.environ.get("TETSUO_IMAGE_DISK_MB", "512")) << 20
+IMAGE_CACHE_BYTES = 64 << 20
+
+IMAGE_CACHE = collections.OrderedDict()  # {id: (mime, base64)}, LRU order
+IMAGE_LOCK = threading.Lock()
+IMAGE_STATE = {"bytes": 0}
+
+
+def sniff_image(data):
+    """(mime, width, height) from the header of PNG, JPEG, GIF or WebP bytes, or None."""
+    if data[:8] == b"\x89PNG\r\n\x1a\n" and len(data) >= 24:
+        return ("image/png",) + struct.unpack(">II", data[16:24])
+    if data[:6] in (b"GIF87a", b"GIF89a") and len(data) >= 10:
+        return ("image/gif",) + struct.unpack("<HH", data[6:10])
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP" and len(data) >= 30:
+        chunk = data[12:16]
+        if chunk == b"VP8X":
+            w = int.from_bytes(data[24:27], "little") + 1
+            h = int.from_bytes(data[27:30], "little") + 1
+        elif chunk == b"VP8L":
+            bits = int.from_bytes(data[21:25], "little")
+            w, h = (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        else:
+            w, h = struct.unpack("<HH", data[26:30])
+            w, h = w & 0x3FFF, h & 0x3FFF
+        return "image/webp", w, h
+    if data[:2] == b"\xff\xd8":
+        i = 2
+        while i + 9 < len(data):
+            if data[i] != 0xFF:
+                i += 1
+                continue
+            marker = data[i + 1]
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                h, w = struct.unpack(">HH", data[i + 5:i + 9])
+                return "image/jpeg", w, h
+            if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+                i += 2
+                continue
+            i += 2 + struct.unpack(">H", data[i + 2:i + 4])[0]
+        return "image/jpeg", 0, 0
+    return None
+
+
+def image_path(image_id):
+    return os.path.join(IMAGE_DIR, image_id[:2], image_id)
+
+
+def _prune_images():
+    """Delete least recently stored images while IMAGE_DIR is over IMAGE_DISK_BYTES."""
+    entries = []
+    for sub in os.scandir(IMAGE_DIR):
+        if sub.is_dir():
+            entries.extend((e.stat().st_mtime, e.stat().st_size, e.path) for e in os.scandir(sub.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= IMAGE_DISK_BYTES:
+            break
+        with contextlib.suppress(OSError):
+            os.remove(path)
+        total -= size
+
+
+def store_image(data):
+    """Store image bytes by content hash; returns {id, url, mime, size, width, height}.
+
+    Raises ValueError for anything that isn't a PNG, JPEG, GIF or WebP within IMAGE_MAX_BYTES.
+    """
+    info = sniff_image(data)
+    if info is None:
+        raise ValueError("unsupported image format (expected PNG, JPEG, GIF or WebP)")
+    if len(data) > IMAGE_MAX_BYTES:
+        raise ValueError(f"image is larger than {IMAGE_MAX_BYTES >> 20} MB")
+    image_id = hashlib.sha1(data).hexdigest()
+    path = image_path(image_id)
+    if os.path.exists(path):
+        os.utime(path)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        _prune_images()
+    mime, width, height = info
+    return {"id": image_id, "url": IMAGE_URL_PREFIX + image_id, "mime": mime, "size": len(data),
+            "width": width, "height": height}
+
+
+def transcode_image(data):
+    """PNG bytes of an image in a format providers don't take (BMP, ICO, TIFF, ...), or None without Pillow."""
+    if Image is None:
+        return None
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            out = io.BytesIO()
+            img.save(out, "PNG", optimize=True)
+    except Exception:
+        return None
+    return out.getvalue()
+
+
+def _normalize_image(data, mime, width, height):
+    """Downscale to IMAGE_MAX_EDGE and recompress when Pillow is available and it helps."""
+    if Image is None or (max(width, height) <= IMAGE_MAX_EDGE and len(data) <= IMAGE_MODEL_BYTES):
+        return mime, data
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            img.thumbnail((IMAGE_MAX_EDGE, IMAGE_MAX_EDGE))
+            out = io.BytesIO()
+            if img.mode in ("RGBA", "LA", "P"):
+                img.save(out, "PNG", optimize=True)
+                mime = "image/png"
+            else:
+                img.convert("RGB").save(out, "JPEG", quality=85)
+                mime = "image/jpeg"
+    except Exception:
+        return mime, data
+    return (mime, out.getvalue()) if out.tell() < len(data) else (mime, data)
+
+
+def model_image(image_id):
+    """(mime, base64) of a stored image as sent to providers, or None if it is gone or too large."""
+    with IMAGE_LOCK:
+        cached = IMAGE_CACHE.get(image_id)
+        if cached:
+            IMAGE_CACHE.move_to_end(image_id)
+            return cached
+    try:
+        with open(image_path(image_id), "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+    info = sniff_image(data)
+    if info is None:
+        return None
+    mime, data = _normalize_image(data, *info)
+    if len(data) > IMAGE_MODEL_BYTES:
+        return None
+    entry = (mime, base64.b64encode(data).decode("ascii"))
+    with IMAGE_LOCK:
+        if image_id not in IMAGE_CACHE:
+            IMAGE_CACHE[image_id] = entry
+            IMAGE_STATE["bytes"] += len(entry[1])
+        while IMAGE_STATE["bytes"] > IMAGE_CACHE_BYTES and len(IMAGE_CACHE) > 1:
+            _, (_, dropped) = IMAGE_CACHE.popitem(last=False)
+            IMAGE_STATE["bytes"] -= len(dropped)
+    return entry
+
+
+def image_ref(image_id):
+    return {"type": "image_url", "image_url": {"url": IMAGE_URL_PREFIX + image_id}}
+
+
+def intern_images(messages):
+    """Messages with inline data: URLs stored and replaced by references, and "images": [id] expanded."""
+    out = []
+    for msg in messages:
+        images = msg.get("images")
+        content = msg.get("content")
+        if not images and not isinstance(content, list):
+            out.append(msg)
+            continue
+        msg = {k: v for k, v in msg.items() if k != "images"}
+        if isinstance(content, list):
+            blocks = []
+            for block in content:
+                url = block.get("image_url", {}).get("url", "") if block.get("type") == "image_url" else ""
+                if url.startswith("data:"):
+                    try:
+                        block = image_ref(store_image(base64.b64decode(url.split(",", 1)[1]))["id"])
+                    except (ValueError, IndexError, OSError):
+                        pass  # leave it inline; the provider will say what's wrong with it
+                blocks.append(block)
+        else:
+            blocks = [{"type": "text", "text": content or ""}]
+        for image_id in images or []:
+            if isinstance(image_id, str) and IMAGE_ID_RE.match(image_id):
+                blocks.append(image_ref(image_id))
+        msg["content"] = blocks
+        out.append(msg)
+    return out
+
+
+def resolve_images(messages):
+    """Copy of messages with image references replaced by base64 data URLs for the provider."""
+    out = []
+    for msg in messages:
+        content = msg.get("content")
+        if not isinstance(content, list) or not any(
+                b.get("image_url", {}).get("url", "").startswith(IMAGE_URL_PREFIX) for b in content):
+            out.append(msg)
+            continue
+        blocks = []
+        for block in content:
+            url = block.get("image_url", {}).get("url", "")
+            if url.startswith(IMAGE_URL_PREFIX):
+                image_id = url[len(IMAGE_URL_PREFIX):]
+                image = model_image(image_id) if IMAGE_ID_RE.match(image_id) else None
+                if image is None:
+                    block = {"type": "text", "text": "[image unavailable]"}
+                else:
+                    block = {"type": "image_url", "image_url": {"url": f"data:{image[0]};base64,{image[1]}"}}
+            blocks.append(block)
+        out.append(dict(msg, content=blocks))
+    return out
+
+
+@app.route("/api/images/<image_id>")
+def serve_image(image_id):
+    """Raw stored image; immutable, with ETag and Range support."""
+    if not IMAGE_ID_RE.match(image_id) or not os.path.exists(image_path(image_id)):
+        return jsonify({"error": "not found"}), 404
+    with open(image_path(image_id), "rb") as f:
+        mime = (sniff_image(f.read(32 << 10)) or ("application/octet-stream",))[0]
+    resp = send_file(image_path(image_id), mimetype=mime, conditional=True, etag=image_id, max_age=31536000)
+    resp.headers["Cache-Control"] = ASSET_CACHE_CONTROL
+    return resp
+
+
+@app.route("/api/files/raw")
+def raw_file():
+    """A workspace file's bytes, with ETag revalidation and Range requests."""
+    path = _resolve_path(request.args.get("path", ""))
+    if path is None or not os.path.isfile(path):
+        return jsonify({"error": "not found"}), 404
+    resp = send_file(path, conditional=True, etag=file_etag(os.stat(path)))
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
 
 
 # ── Tool Execution ──────────────────────────────
@@ -291,11 +1829,15 @@ def execute_tool(name, args):
             return json.dumps({"error": "Access denied: path outside workspace"})
         path = resolved
         try:
-            with open(path, "r", encoding="utf-8", errors="replace") as f:
-                content = f.read()
-            if len(content) > 100000:
-                content = content[:100000] + f"\n\n... [truncated, {len(content)} bytes]"
-            return json.dumps({"content": content, "path": path})
+            start_line, end_line = args.get("start_line"), args.get("end_line")
+            content, truncated = read_text(path, TOOL_READ_LIMIT, start_line=start_line, end_line=end_line)
+            result = {"content": content, "path": path}
+            if start_line or end_line:
+                result["start_line"] = max(1, start_line or 1)
+                result["end_line"] = result["start_line"] + len(content.splitlines()) - 1
+            if truncated:
+                result["content"] += f"\n\n... [truncated, {os.path.getsize(path)} bytes]"
+            return json.dumps(result)
         except Exception as e:
             return json.dumps({"error": str(e)})
 
@@ -305,6 +1847,8 @@ def execute_tool(name, args):
         resolved = _resolve_path(path)
         if resolved is None:
             return json.dumps({"error": "Access denied: path outside workspace"})
+        if _is_internal(resolved):
+            return json.dumps({"error": f"Access denied: {INDEX_DIR} is managed by tetsuocode"})
         path = resolved
         try:
             old_content = ""
@@ -313,18 +1857,16 @@ def execute_tool(name, args):
                     old_content = f.read()
             except FileNotFoundError:
                 pass
-            diff = compute_diff(old_content, content, path)
-            if REQUIRE_APPROVAL:
-                edit_id = f"pe_{int(time.time()*1000)}"
-                PENDING_EDITS[edit_id] = {"path": path, "old_content": old_content, "new_content": content, "diff": diff, "tool": "write_file", "timestamp": time.time()}
-                return json.dumps({"pending": True, "pending_id": edit_id, "path": path, "diff": diff[:3000]})
-            FILE_EDIT_HISTORY.append({"path": path, "old_content": old_content, "new_content": content, "tool": "write_file", "timestamp": time.time()})
-            if len(FILE_EDIT_HISTORY) > MAX_UNDO_HISTORY:
-                FILE_EDIT_HISTORY.pop(0)
+            diff = compute_diff(old_content, content, path, DIFF_OUTPUT_LIMIT)
+            if approval_required():
+                edit_id = stage_edit(path, old_content, content, diff, "write_file")
+                return json.dumps({"pending": True, "pending_id": edit_id, "path": path, "diff": diff})
+            record_edit(path, old_content, content, "write_file")
             os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
             with open(path, "w", encoding="utf-8") as f:
                 f.write(content)
-            return json.dumps({"success": True, "path": path, "diff": diff[:3000]})
+            invalidate_scan(path)
+            return json.dumps({"success": True, "path": path, "diff": diff})
         except Exception as e:
             return json.dumps({"error": str(e)})
 
@@ -335,6 +1877,8 @@ def execute_tool(name, args):
         resolved = _resolve_path(path)
         if resolved is None:
             return json.dumps({"error": "Access denied: path outside workspace"})
+        if _is_internal(resolved):
+            return json.dumps({"error": f"Access denied: {INDEX_DIR} is managed by tetsuocode"})
         path = resolved
         try:
             with open(path, "r", encoding="utf-8") as f:
@@ -345,18 +1889,17 @@ def execute_tool(name, args):
             if count > 1:
                 return json.dumps({"error": f"old_string found {count} times, must be unique"})
             old_content = content
-            content = content.replace(old_string, new_string, 1)
-            diff = compute_diff(old_content, content, path)
-            if REQUIRE_APPROVAL:
-                edit_id = f"pe_{int(time.time()*1000)}"
-                PENDING_EDITS[edit_id] = {"path": path, "old_content": old_content, "new_content": content, "diff": diff, "tool": "edit_file", "timestamp": time.time()}
-                return json.dumps({"pending": True, "pending_id": edit_id, "path": path, "diff": diff[:3000]})
-            FILE_EDIT_HISTORY.append({"path": path, "old_content": old_content, "new_content": content, "tool": "edit_file", "timestamp": time.time()})
-            if len(FILE_EDIT_HISTORY) > MAX_UNDO_HISTORY:
-                FILE_EDIT_HISTORY.pop(0)
+            start = content.find(old_string)
+            content = content[:start] + new_string + content[start + len(old_string):]
+            diff = compute_edit_diff(old_content, start, old_string, new_string, path, DIFF_OUTPUT_LIMIT)
+            if approval_required():
+                edit_id = stage_edit(path, old_content, content, diff, "edit_file")
+                return json.dumps({"pending": True, "pending_id": edit_id, "path": path, "diff": diff})
+            record_edit(path, old_content, content, "edit_file")
             with open(path, "w", encoding="utf-8") as f:
                 f.write(content)
-            return json.dumps({"success": True, "path": path, "diff": diff[:3000]})
+            invalidate_scan(path)
+            return json.dumps({"success": True, "path": path, "diff": diff})
         except Exception as e:
             return json.dumps({"error": str(e)})
 
@@ -367,7 +1910,7 @@ def execute_tool(name, args):
             return json.dumps({"error": f"Blocked: dangerous pattern '{danger}' detected. Disable safety in settings to override."})
         try:
             result = subprocess.run(
-                command, shell=True, capture_output=True, text=True, timeout=30
+                command, shell=True, capture_output=True, text=True, timeout=30, cwd=current_workspace()
             )
             out = result.stdout
             if len(out) > 50000:
@@ -379,50 +1922,85 @@ def execute_tool(name, args):
             return json.dumps({"error": str(e)})
 
     elif name == "list_files":
-        path = args.get("path", ".")
-        max_depth = int(args.get("max_depth", 3))
+        path = _resolve_path(args.get("path") or current_workspace())
+        if path is None:
+            return json.dumps({"error": "Access denied: path outside workspace"})
         try:
-            files = []
-            for root, dirs, filenames in os.walk(path):
-                depth = root.replace(path, "").count(os.sep)
-                if depth >= max_depth:
-                    dirs.clear()
-                    continue
-                dirs[:] = [d for d in dirs if d not in (".git", "node_modules", "__pycache__")]
-                for fn in filenames:
-                    files.append(os.path.join(root, fn))
-                if len(files) > 500:
-                    break
+            max_depth = int(args.get("max_depth", 3))
+            # From the scanner, so skipped and hidden directories (.git, .tetsuo, ...) stay out
+            prefix = os.path.relpath(path, current_workspace()).replace("\\", "/")
+            prefix = "" if prefix == "." else prefix + "/"
+            files = [f["path"] for f in scan_workspace()
+                     if f["path"].startswith(prefix) and f["path"].count("/", len(prefix)) < max_depth]
             return json.dumps({"files": files[:500], "count": len(files)})
         except Exception as e:
             return json.dumps({"error": str(e)})
 
     elif name == "grep_files":
-        pattern = args.get("pattern", "")
-        path = args.get("path", ".")
+        resolved = _resolve_path(args.get("path", "") or current_workspace())
+        if resolved is None:
+            return json.dumps({"error": "Access denied: path outside workspace"})
         try:
-            result = subprocess.run(
-                ["rg", "--no-heading", "--line-number", "--max-count", "50", pattern, path],
-                capture_output=True, text=True, timeout=10,
-            )
-            matches = [l for l in result.stdout.splitlines() if l.strip()][:50]
+            pattern = compile_grep_pattern(args.get("pattern", ""), is_regex=True, case_sensitive=True)
+        except re.error as e:
+            return json.dumps({"error": f"Invalid regex: {e}"})
+        prefix = resolved.replace("\\", "/")
+        if os.path.isfile(resolved):
+            files = [{"path": os.path.relpath(resolved, current_workspace()).replace("\\", "/"), "full": prefix}]
+        else:
+            files = [f for f in scan_workspace(text_only=True) if f["full"].startswith(prefix.rstrip("/") + "/")]
+        try:
+            matches = [f"{entry['path']}:{m['line']}:{m['text']}"
+                       for entry, found in grep_stream(pattern, files, max_results=50, max_per_file=50)
+                       for m in found]
             return json.dumps({"matches": matches, "count": len(matches)})
-        except FileNotFoundError:
-            try:
-                result = subprocess.run(
-                    f'grep -rn --max-count=50 "{pattern}" "{path}"',
-                    shell=True, capture_output=True, text=True, timeout=10,
-                )
-                matches = [l for l in result.stdout.splitlines() if l.strip()][:50]
-                return json.dumps({"matches": matches, "count": len(matches)})
-            except Exception as e:
-                return json.dumps({"error": str(e)})
         except Exception as e:
             return json.dumps({"error": str(e)})
 
     return json.dumps({"error": f"Unknown tool: {name}"})
 
 
+READ_ONLY_TOOLS = {"read_file", "list_files", "grep_files"}
+TOOL_WORKERS = int(os.environ.get("TETSUO_TOOL_WORKERS", "8"))
+TOOL_EXECUTOR = ThreadPoolExecutor(max_workers=TOOL_WORKERS, thread_name_prefix="tetsuo-tool")
+
+
+def _execute_tool_safe(name, args):
+    try:
+        return execute_tool(name, args)
+    except Exception as e:
+        return json.dumps({"error": str(e)})
+
+
+def tool_batches(calls):
+    """Split [(name, args)] into [i, j) ranges that may run together.
+
+    Consecutive read-only calls form one concurrent batch; any other tool is a
+    barrier that runs alone, after everything before it.
+    """
+    i = 0
+    while i < len(calls):
+        j = i
+        while j < len(calls) and calls[j][0] in READ_ONLY_TOOLS:
+            j += 1
+        j = j if j - i >= 2 else i + 1
+        yield i, j
+        i = j
+
+
+def run_tool_calls(calls, root=None, session=None):
+    """Execute [(name, args)] in workspace root for session and yield (index, result) as each call finishes."""
+    root = root or current_workspace()
+    for i, j in tool_batches(calls):
+        if j - i == 1:
+            yield i, in_workspace(root, _execute_tool_safe, *calls[i], session=session)
+            continue
+        futures = {TOOL_EXECUTOR.submit(in_workspace, root, _execute_tool_safe, *calls[k], session=session): k
+                   for k in range(i, j)}
+        for fut in as_completed(futures):
+            yield futures[fut], fut.result()
+
+
 # ── Anthropic Helpers ──────────────────────────
 
 def convert_tools_for_anthropic(tools):
@@ -470,6 +2048,238 @@ def convert_messages_for_anthropic(messages):
     return system, result
 
 
+# ── Context Compaction ──────────────────────────
+
+# Every tool result is resent on each iteration of the tool loop, so a long
+# session's prompt grows with each read_file and run_command. Before each
+# provider request, once the prompt is over its model's budget, older tool
+# results are compacted oldest first: a file that was re-read or edited later
+# becomes a reference, other file reads become a skeleton, and anything else
+# keeps a head/tail excerpt. The latest round stays verbatim, and compacted
+# results are never rewritten, so the prompt prefix stays stable.
+
+COMPACT_RATIO = float(os.environ.get("TETSUO_COMPACT_RATIO", "0.5"))  # share of the context window
+COMPACT_MAX_TOKENS = int(os.environ.get("TETSUO_COMPACT_MAX_TOKENS", "48000"))
+COMPACT_MIN_TOKENS = 256  # smaller results aren't worth compacting
+COMPACT_EXCERPT_CHARS = 1500  # kept from each end of a long text field
+COMPACT_LIST_ITEMS = 40
+MESSAGE_OVERHEAD_TOKENS = 4  # role/separator framing per message
+PATH_TOOLS = ("read_file", "write_file", "edit_file")
+
+
+def context_budget(model):
+    """Prompt tokens a conversation may use before older tool results are compacted."""
+    return min(int(context_limit(model) * COMPACT_RATIO), COMPACT_MAX_TOKENS)
+
+
+def _message_text(msg):
+    content = msg.get("content", "") or ""
+    if isinstance(content, list):
+        content = "\n".join(b.get("text", "") for b in content if isinstance(b, dict))
+    return content
+
+
+def _excerpt(text, limit=COMPACT_EXCERPT_CHARS):
+    if len(text) <= 2 * limit + 200:
+        return text
+    omitted = text.count("\n", limit, len(text) - limit)
+    return (f"{text[:limit]}\n... [{omitted} lines, {len(text) - 2 * limit} chars omitted] ...\n"
+            f"{text[-limit:]}")
+
+
+def _compact_result(name, args, result, later_paths):
+    """A smaller stand-in for one tool result."""
+    try:
+        data = json.loads(result)
+    except (json.JSONDecodeError, TypeError):
+        return _excerpt(result)
+    if not isinstance(data, dict):
+        return _excerpt(result)
+    path = data.get("path") or args.get("path", "")
+    if name == "read_file" and isinstance(data.get("content"), str):
+        if _resolve_path(path) in later_paths:
+            return json.dumps({"path": path, "compacted": "reference",
+                               "note": "This file was read or edited again later; see the newer result."})
+        content = data["content"]
+        return json.dumps({"path": path, "compacted": "skeleton", "lines": content.count("\n") + 1,
+                           "skeleton": _excerpt(_build_file_skeleton(path, content)),
+                           "note": "Older result compacted to a skeleton; call read_file again for the full text."})
+    out = {"compacted": "excerpt"}
+    for key, value in data.items():
+        if isinstance(value, str):
+            out[key] = _excerpt(value)
+        elif isinstance(value, list) and len(value) > COMPACT_LIST_ITEMS:
+            out[key] = value[:COMPACT_LIST_ITEMS] + [f"... {len(value) - COMPACT_LIST_ITEMS} more"]
+        else:
+            out[key] = value
+    return json.dumps(out)
+
+
+def compact_tool_results(conv):
+    """Compact older tool results in conv until the prompt fits conv["budget"]; returns (before, after) tokens."""
+    messages, family = conv["messages"], conv["family"]
+    counts = count_tokens_batch([_message_text(m) for m in messages], family)
+    total = before = sum(counts) + MESSAGE_OVERHEAD_TOKENS * len(messages)
+    budget = conv.get("budget")
+    if not budget or total <= budget:
+        return before, total
+
+    # Walk newest first so each result knows which paths later calls touched
+    calls, later_paths, candidates = {}, set(), []
+    latest_round = max((i for i, m in enumerate(messages) if m.get("tool_calls")), default=len(messages))
+    for i in range(len(messages) - 1, -1, -1):
+        msg = messages[i]
+        if msg.get("role") == "tool":
+            if i > latest_round or msg.get("tool_call_id") in conv["compacted"] or counts[i] < COMPACT_MIN_TOKENS:
+                continue
+            candidates.append((i, set(later_paths)))
+        for tc in msg.get("tool_calls") or ():
+            fn = tc.get("function", {})
+            try:
+                args = json.loads(fn.get("arguments") or "{}")
+            except json.JSONDecodeError:
+                args = {}
+            if not isinstance(args, dict):
+                args = {}
+            calls[tc.get("id")] = (fn.get("name", ""), args)
+            resolved = _resolve_path(args.get("path", "")) if fn.get("name") in PATH_TOOLS else None
+            if resolved is not None:
+                later_paths.add(resolved)
+
+    for i, later in reversed(candidates):
+        if total <= budget:
+            break
+        msg = messages[i]
+        name, args = calls.get(msg["tool_call_id"], ("", {}))
+        compacted = _compact_result(name, args, msg["content"], later)
+        n = count_tokens(compacted, family)
+        conv["compacted"].add(msg["tool_call_id"])
+        if n < counts[i]:
+            messages[i] = dict(msg, content=compacted)
+            total -= counts[i] - n
+    return before, total
+
+
+# ── Static Assets & Compression ──────────────────
+
+# Static files are served under /assets/<hash>/<name> with a year-long
+# immutable lifetime; the hash changes whenever the file does, so a new
+# build is picked up on the next page load. Text assets are compressed once
+# per process at the highest level, while JSON and other dynamic text over
+# COMPRESS_MIN_BYTES is compressed per response at a cheap level.
+try:
+    import brotli
+except ImportError:  # optional: pip install 'tetsuocode[compress]'
+    brotli = None
+
+ASSET_CACHE_CONTROL = "public, max-age=31536000, immutable"
+ASSET_COMPRESS_EXT = {".js", ".css", ".html", ".svg", ".json", ".txt", ".map"}
+COMPRESS_MIN_BYTES = int(os.environ.get("TETSUO_COMPRESS_MIN_BYTES", "1024"))
+COMPRESS_MIMETYPES = {"application/json", "text/html", "text/plain", "text/css", "text/javascript",
+                      "application/javascript"}
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+ASSETS = {}  # {name: {hash, mtime, size, mime, identity, gzip, br}}
+ASSET_LOCK = threading.Lock()
+
+
+def _precompress(data):
+    variants = {"gzip": gzip.compress(data, 9, mtime=0)}
+    if brotli is not None:
+        variants["br"] = brotli.compress(data, quality=11)
+    return {enc: body for enc, body in variants.items() if len(body) < len(data)}
+
+
+def static_asset(name):
+    """Fingerprinted (and precompressed) contents of static/name, or None if it doesn't exist."""
+    path = os.path.join(app.static_folder, name)
+    if not os.path.abspath(path).startswith(os.path.abspath(app.static_folder) + os.sep):
+        return None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    with ASSET_LOCK:
+        asset = ASSETS.get(name)
+        if asset and asset["mtime"] == st.st_mtime_ns and asset["size"] == st.st_size:
+            return asset
+    with open(path, "rb") as f:
+        data = f.read()
+    asset = {"hash": hashlib.sha1(data).hexdigest()[:12], "mtime": st.st_mtime_ns, "size": st.st_size,
+             "mime": mimetypes.guess_type(name)[0] or "application/octet-stream", "identity": data}
+    if os.path.splitext(name)[1].lower() in ASSET_COMPRESS_EXT and len(data) >= COMPRESS_MIN_BYTES:
+        asset.update(_precompress(data))
+    with ASSET_LOCK:
+        ASSETS[name] = asset
+    return asset
+
+
+@app.template_global()
+def asset_url(name):
+    asset = static_asset(name)
+    return f"/assets/{asset['hash']}/{name}" if asset else f"/static/{name}"
+
+
+def accepted_encodings():
+    """Content codings the client accepts (q > 0), from Accept-Encoding."""
+    accepted = set()
+    for part in request.headers.get("Accept-Encoding", "").split(","):
+        coding, _, params = part.strip().partition(";")
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(coding.strip().lower())
+    return accepted
+
+
+@app.route("/assets/<fingerprint>/<path:name>")
+def serve_asset(fingerprint, name):
+    asset = static_asset(name)
+    if asset is None:
+        return jsonify({"error": "not found"}), 404
+    etag = f'"{asset["hash"]}"'
+    # A page rendered before the file changed asks for the old hash: serve the
+    # current content, but don't let it be cached under the stale URL
+    cache_control = ASSET_CACHE_CONTROL if fingerprint == asset["hash"] else "no-cache"
+    headers = {"ETag": etag, "Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+    if etag in request.headers.get("If-None-Match", ""):
+        return Response(status=304, headers=headers)
+    accepted = accepted_encodings()
+    encoding = next((enc for enc in ("br", "gzip") if enc in asset and enc in accepted), None)
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(asset[encoding or "identity"], mimetype=asset["mime"], headers=headers)
+
+
+@app.after_request
+def compress_response(resp):
+    """Negotiate gzip/brotli for buffered text responses past COMPRESS_MIN_BYTES."""
+    if (resp.direct_passthrough or resp.is_streamed or resp.status_code != 200
+            or resp.mimetype not in COMPRESS_MIMETYPES or "Content-Encoding" in resp.headers):
+        return resp
+    data = resp.get_data()
+    if len(data) < COMPRESS_MIN_BYTES:
+        return resp
+    resp.vary.add("Accept-Encoding")
+    accepted = accepted_encodings()
+    encoded = brotli is not None and "br" in accepted or "gzip" in accepted
+    etag, weak = resp.get_etag()
+    if encoded and etag and not weak:
+        resp.set_etag(etag, weak=True)  # the coded bytes differ from the identity representation
+    if brotli is not None and "br" in accepted:
+        resp.set_data(brotli.compress(data, quality=BROTLI_QUALITY))
+        resp.headers["Content-Encoding"] = "br"
+    elif "gzip" in accepted:
+        resp.set_data(gzip.compress(data, GZIP_LEVEL, mtime=0))
+        resp.headers["Content-Encoding"] = "gzip"
+    return resp
+
+
 # ── Chat Endpoint ──────────────────────────────
 
 @app.route("/")
@@ -477,13 +2287,99 @@ def index():
     return render_template("index.html")
 
 
-@app.route("/api/chat", methods=["POST"])
-def chat():
-    data = request.json
+# Both wire formats run through one tool loop. The conversation stays in
+# OpenAI message form (converted per request for Anthropic) and each streamed
+# line is folded into a turn dict by parse_stream_line. stream_chat below and
+# the async engine in asgi.py share these helpers and differ only in I/O.
+
+MAX_TOOL_ITERATIONS = 10
+
+# Content deltas are coalesced into one frame per SSE_WINDOW (or SSE_MAX_CHARS
+# of text), so a fast provider costs one encode, one write and one client
+# JSON.parse per window rather than per token. Every other event flushes the
+# buffer first, and the chat loop flushes explicitly before tools run. The
+# threaded engine checks the window as provider lines arrive; the async
+# engine also flushes on a timer when the provider goes quiet.
+
+SSE_WINDOW = float(os.environ.get("TETSUO_SSE_WINDOW_MS", "25")) / 1000.0
+SSE_MAX_CHARS = int(os.environ.get("TETSUO_SSE_MAX_CHARS", "1024"))
+_SSE_CONTENT_HEAD = b'data: {"type": "content", "content": '
+_SSE_CONTENT_TAIL = b'}\n\n'
+_encode_json_str = getattr(json.encoder, "c_encode_basestring_ascii", None) or json.encoder.py_encode_basestring_ascii
+
+
+def _sse(event):
+    return f"data: {json.dumps(event)}\n\n"
+
+
+def _sse_content(text):
+    """Pre-encoded content frame; byte-identical to _sse({"type": "content", ...})."""
+    return _SSE_CONTENT_HEAD + _encode_json_str(text).encode("ascii") + _SSE_CONTENT_TAIL
+
+
+class SSEWriter:
+    """Turns chat events into SSE frames (bytes), coalescing content deltas."""
+
+    def __init__(self, window=None, max_chars=None):
+        self.window = SSE_WINDOW if window is None else window
+        self.max_chars = SSE_MAX_CHARS if max_chars is None else max_chars
+        self.parts = []
+        self.chars = 0
+        self.since = 0.0
+
+    def push(self, event):
+        """Frames to send now for event; b"" while content is being held."""
+        if event.get("type") != "content":
+            return self.flush() + _sse(event).encode()
+        if not self.parts:
+            self.since = time.monotonic()
+        self.parts.append(event["content"])
+        self.chars += len(event["content"])
+        if self.chars >= self.max_chars or self.remaining() == 0:
+            return self.flush()
+        return b""
+
+    def remaining(self):
+        """Seconds until held content is due, or None when nothing is held."""
+        if not self.parts:
+            return None
+        return max(0.0, self.window - (time.monotonic() - self.since))
+
+    def flush(self):
+        if not self.parts:
+            return b""
+        text = self.parts[0] if len(self.parts) == 1 else "".join(self.parts)
+        self.parts = []
+        self.chars = 0
+        return _sse_content(text)
+
+
+
+def _attachment_id(img):
+    """Image id for one entry of a /api/chat "images" list: an id, {"id": ...} or {"data": base64}."""
+    if isinstance(img, dict):
+        img = img.get("id") or store_image(base64.b64decode(img["data"]))["id"]
+    if not isinstance(img, str) or not IMAGE_ID_RE.match(img):
+        raise ValueError("expected an image id or base64 data")
+    return img
+
+
+def _redact(text, api_key):
+    return text.replace(api_key, "[REDACTED]") if api_key else text
+
+
+def prepare_chat(data):
+    """Resolve provider, key and prompt for a /api/chat body; returns (conv, error)."""
     messages = data.get("messages", [])
+    if data.get("images") and messages and messages[-1].get("role") == "user":
+        # Older clients send this turn's attachments beside the messages
+        try:
+            ids = [_attachment_id(img) for img in data["images"]]
+        except (ValueError, KeyError, TypeError, OSError) as e:
+            return None, f"Invalid image attachment: {e}"
+        messages = messages[:-1] + [dict(messages[-1], images=ids)]
+    messages = intern_images(messages)
     model = data.get("model", "grok-4-1-fast-reasoning")
-    temperature = data.get("temperature", 0.7)
-    max_tokens = data.get("max_tokens", 4096)
     custom_system = data.get("system_prompt", "")
     provider_id = data.get("provider", "xai")
     user_api_key = data.get("api_key", "")
@@ -495,18 +2391,14 @@ def chat():
     if not api_key and provider_id != "ollama":
         pname = provider["name"]
         env_key = provider.get("env_key", "")
-        err_msg = f"No API key configured for {pname}. Set {env_key} or enter a key in settings."
-        return Response(
-            f"data: {json.dumps({'type': 'error', 'content': err_msg})}\n\n",
-            mimetype="text/event-stream",
-        )
+        return None, f"No API key configured for {pname}. Set {env_key} or enter a key in settings."
 
     context_mode = data.get("context_mode", "smart")
     sys_prompt = custom_system if custom_system else SYSTEM_PROMPT
 
     # Lazy mode: inject workspace file listing so the model uses read_file tool
     if context_mode == "lazy":
-        tree_files = _get_workspace_tree(150)
+        tree_files = _get_workspace_tree(150, token_family(provider_id, model))
         file_list = "\n".join(f"  {f['path']} (~{f['tokens']} tokens)" for f in tree_files)
         sys_prompt += (
             "\n\nYou have access to this workspace. Use the read_file tool to access any file you need. "
@@ -514,268 +2406,256 @@ def chat():
             f"Workspace files:\n{file_list}"
         )
 
-    full_messages = [{"role": "system", "content": sys_prompt}] + messages
+    return {
+        "format": provider["format"],
+        "base_url": provider["base_url"],
+        "api_key": api_key,
+        "model": model,
+        "temperature": data.get("temperature", 0.7),
+        "max_tokens": data.get("max_tokens", 4096),
+        "messages": [{"role": "system", "content": sys_prompt}] + messages,
+        "family": token_family(provider_id, model),
+        "budget": context_budget(model),
+        "compacted": set(),  # tool_call_ids already compacted (or not worth it)
+        "workspace": current_workspace(),
+        "session": current_session(),
+    }, None
+
+
+def provider_request(conv):
+    """(url, headers, body) for the next streamed completion of conv."""
+    compact_tool_results(conv)
+    messages = resolve_images(conv["messages"])
+    if conv["format"] == "anthropic":
+        system, anthropic_msgs = convert_messages_for_anthropic(messages)
+        body = {"model": conv["model"], "max_tokens": conv["max_tokens"], "messages": anthropic_msgs,
+                "tools": convert_tools_for_anthropic(TOOL_DEFINITIONS), "stream": True}
+        if system:
+            body["system"] = system
+        if conv["temperature"] is not None:
+            body["temperature"] = conv["temperature"]
+        headers = {"Content-Type": "application/json", "x-api-key": conv["api_key"],
+                   "anthropic-version": "2023-06-01"}
+        return f"{conv['base_url']}/messages", headers, body
+    body = {
+        "model": conv["model"],
+        "messages": messages,
+        "max_tokens": conv["max_tokens"],
+        "temperature": conv["temperature"],
+        "stream": True,
+        "tools": TOOL_DEFINITIONS,
+        "tool_choice": "auto",
+    }
+    headers = {"Content-Type": "application/json", "Authorization": f"Bearer {conv['api_key']}"}
+    return f"{conv['base_url']}/chat/completions", headers, body
 
-    def generate():
-        nonlocal full_messages
-        iteration = 0
-        max_iterations = 10
 
+def provider_error(conv, status, text):
+    """User-facing message for a non-200 provider response."""
+    error_msg = f"{'Anthropic API' if conv['format'] == 'anthropic' else 'API'} error {status}"
+    try:
+        err = json.loads(text).get("error")
+        if isinstance(err, dict):
+            error_msg = err.get("message", error_msg)
+    except Exception:
+        pass
+    return _redact(error_msg, conv["api_key"])
+
+
+def new_turn():
+    return {"content": "", "tool_calls": {}, "stop": None, "event": None, "done": False, "error": False}
+
+
+def parse_stream_line(conv, line, turn):
+    """Fold one line of the provider stream into turn; returns the events to emit."""
+    if not line:
+        return []
+    if line.startswith("event: "):
+        turn["event"] = line[7:]
+        return []
+    if not line.startswith("data: "):
+        return []
+    payload = line[6:]
+    if payload.strip() == "[DONE]":
+        turn["done"] = True
+        return []
+    try:
+        data = json.loads(payload)
+    except json.JSONDecodeError:
+        return []
+    if conv["format"] == "anthropic":
+        return _anthropic_stream_events(data, turn)
+    return _openai_stream_events(data, turn)
+
+
+def _openai_stream_events(chunk, turn):
+    if "error" in chunk:
+        turn["done"] = turn["error"] = True
+        return [{"type": "error", "content": chunk["error"].get("message", "Unknown error")}]
+    events = []
+    choices = chunk.get("choices", [])
+    if choices:
+        choice = choices[0]
+        delta = choice.get("delta", {})
+        turn["stop"] = choice.get("finish_reason") or turn["stop"]
+
+        if delta.get("content"):
+            turn["content"] += delta["content"]
+            events.append({"type": "content", "content": delta["content"]})
+
+        for tc in delta.get("tool_calls") or ():
+            call = turn["tool_calls"].setdefault(tc["index"], {"id": "", "name": "", "arguments": ""})
+            fn = tc.get("function", {})
+            if tc.get("id"):
+                call["id"] = tc["id"]
+            if fn.get("name"):
+                call["name"] += fn["name"]
+            if fn.get("arguments"):
+                call["arguments"] += fn["arguments"]
+
+    if chunk.get("usage"):
+        events.append({"type": "usage", "usage": chunk["usage"]})
+    return events
+
+
+def _anthropic_stream_events(data, turn):
+    event = turn["event"]
+    if event == "content_block_start":
+        block = data.get("content_block", {})
+        if block.get("type") == "tool_use":
+            turn["tool_calls"][data["index"]] = {"id": block["id"], "name": block["name"], "arguments": ""}
+            return [{"type": "tool_call", "id": block["id"], "name": block["name"], "args": ""}]
+
+    elif event == "content_block_delta":
+        delta = data.get("delta", {})
+        if delta.get("type") == "text_delta":
+            turn["content"] += delta["text"]
+            return [{"type": "content", "content": delta["text"]}]
+        if delta.get("type") == "input_json_delta" and data["index"] in turn["tool_calls"]:
+            turn["tool_calls"][data["index"]]["arguments"] += delta.get("partial_json", "")
+
+    elif event == "message_delta":
+        turn["stop"] = data.get("delta", {}).get("stop_reason")
+        usage = data.get("usage", {})
+        if usage:
+            out = usage.get("output_tokens", 0)
+            return [{"type": "usage", "usage": {"prompt_tokens": 0, "completion_tokens": out, "total_tokens": out}}]
+
+    elif event == "message_start":
+        usage = data.get("message", {}).get("usage", {})
+        if usage:
+            inp = usage.get("input_tokens", 0)
+            return [{"type": "usage", "usage": {"prompt_tokens": inp, "completion_tokens": 0, "total_tokens": inp}}]
+    return []
+
+
+def begin_tool_round(conv, turn):
+    """Record the assistant's tool calls on conv; returns (tool_calls, [(name, args)], events) or None."""
+    if turn["stop"] not in ("tool_calls", "tool_use") or not turn["tool_calls"]:
+        return None
+    tool_calls = [turn["tool_calls"][k] for k in sorted(turn["tool_calls"])]
+    conv["messages"].append({"role": "assistant", "content": turn["content"] or None, "tool_calls": [
+        {"id": tc["id"], "type": "function", "function": {"name": tc["name"], "arguments": tc["arguments"]}}
+        for tc in tool_calls
+    ]})
+    calls = []
+    for tc in tool_calls:
         try:
-          while iteration < max_iterations:
-            iteration += 1
-
-            if provider["format"] == "anthropic":
-                yield from _stream_anthropic(api_key, full_messages, model, temperature, max_tokens)
-                return
-
-            # OpenAI-compatible path
-            base_url = provider["base_url"]
-            body = {
-                "model": model,
-                "messages": full_messages,
-                "max_tokens": max_tokens,
-                "temperature": temperature,
-                "stream": True,
-                "tools": TOOL_DEFINITIONS,
-                "tool_choice": "auto",
-            }
-
-            resp = requests.post(
-                f"{base_url}/chat/completions",
-                headers={"Content-Type": "application/json", "Authorization": f"Bearer {api_key}"},
-                json=body, stream=True, timeout=120,
-            )
-            resp.encoding = "utf-8"
+            args = json.loads(tc["arguments"])
+        except json.JSONDecodeError:
+            args = {}
+        calls.append((tc["name"], args))
+    # Anthropic announced its calls as the tool_use blocks opened
+    events = [] if conv["format"] == "anthropic" else [
+        {"type": "tool_call", "id": tc["id"], "name": tc["name"], "args": tc["arguments"][:200]}
+        for tc in tool_calls
+    ]
+    return tool_calls, calls, events
 
-            if resp.status_code != 200:
-                error_msg = f"API error {resp.status_code}"
-                try:
-                    err_data = resp.json()
-                    if "error" in err_data:
-                        error_msg = err_data["error"].get("message", error_msg)
-                except Exception:
-                    pass
-                if api_key:
-                    error_msg = error_msg.replace(api_key, "[REDACTED]")
-                yield f"data: {json.dumps({'type': 'error', 'content': error_msg})}\n\n"
-                return
 
-            content_buffer = ""
-            tool_calls = {}
-            finish_reason = None
+def tool_result_event(tool_call, result):
+    return {"type": "tool_result", "id": tool_call["id"], "name": tool_call["name"], "result": result[:500]}
 
-            for line in resp.iter_lines(decode_unicode=True):
-                if not line:
-                    continue
-                if line.startswith("data: "):
-                    payload = line[6:]
-                    if payload.strip() == "[DONE]":
-                        break
-                    try:
-                        chunk = json.loads(payload)
-                    except json.JSONDecodeError:
-                        continue
 
-                    if "error" in chunk:
-                        yield f"data: {json.dumps({'type': 'error', 'content': chunk['error'].get('message', 'Unknown error')})}\n\n"
-                        return
+def end_tool_round(conv, tool_calls, results):
+    for tc, result in zip(tool_calls, results):
+        conv["messages"].append({"role": "tool", "tool_call_id": tc["id"], "content": result})
 
-                    choices = chunk.get("choices", [])
-                    if not choices:
-                        continue
-                    choice = choices[0]
-                    delta = choice.get("delta", {})
-                    finish_reason = choice.get("finish_reason") or finish_reason
-
-                    if delta.get("content"):
-                        content_buffer += delta["content"]
-                        yield f"data: {json.dumps({'type': 'content', 'content': delta['content']})}\n\n"
-
-                    if delta.get("tool_calls"):
-                        for tc in delta["tool_calls"]:
-                            idx = tc["index"]
-                            if idx not in tool_calls:
-                                tool_calls[idx] = {"id": tc.get("id", ""), "function": {"name": "", "arguments": ""}}
-                            if tc.get("id"):
-                                tool_calls[idx]["id"] = tc["id"]
-                            if tc.get("function", {}).get("name"):
-                                tool_calls[idx]["function"]["name"] += tc["function"]["name"]
-                            if tc.get("function", {}).get("arguments"):
-                                tool_calls[idx]["function"]["arguments"] += tc["function"]["arguments"]
-
-                    if chunk.get("usage"):
-                        yield f"data: {json.dumps({'type': 'usage', 'usage': chunk['usage']})}\n\n"
-
-            if finish_reason == "tool_calls" and tool_calls:
-                sorted_calls = [tool_calls[k] for k in sorted(tool_calls.keys())]
-                assistant_msg = {"role": "assistant", "content": content_buffer or None}
-                assistant_msg["tool_calls"] = [
-                    {"id": tc["id"], "type": "function", "function": tc["function"]}
-                    for tc in sorted_calls
-                ]
-                full_messages.append(assistant_msg)
-
-                for tc in sorted_calls:
-                    name = tc["function"]["name"]
-                    try:
-                        args = json.loads(tc["function"]["arguments"])
-                    except json.JSONDecodeError:
-                        args = {}
-                    yield f"data: {json.dumps({'type': 'tool_call', 'name': name, 'args': tc['function']['arguments'][:200]})}\n\n"
-                    result = execute_tool(name, args)
-                    yield f"data: {json.dumps({'type': 'tool_result', 'name': name, 'result': result[:500]})}\n\n"
-                    full_messages.append({"role": "tool", "tool_call_id": tc["id"], "content": result})
-
-                content_buffer = ""
-                tool_calls = {}
-                finish_reason = None
-                continue
 
-            yield f"data: {json.dumps({'type': 'done'})}\n\n"
-            return
+def stream_chat(conv):
+    """Run the provider/tool loop for conv, yielding SSE frames."""
+    out = SSEWriter()
+    try:
+        for _ in range(MAX_TOOL_ITERATIONS):
+            url, headers, body = provider_request(conv)
+            resp = http_post(url, headers=headers, json=body, stream=True)
+            resp.encoding = "utf-8"
+            turn = new_turn()
+            finished = False
+            try:
+                if resp.status_code != 200:
+                    error = provider_error(conv, resp.status_code, resp.text)
+                    finished = True
+                    yield out.push({"type": "error", "content": error})
+                    return
+                for line in resp.iter_lines(decode_unicode=True):
+                    for event in parse_stream_line(conv, line, turn):
+                        frame = out.push(event)
+                        if frame:
+                            yield frame
+                    if turn["done"]:
+                        break
+                finished = True
+            finally:
+                # Also runs on errors and when the client disconnects mid-stream (GeneratorExit)
+                release_response(resp, reuse=finished)
+            if turn["error"]:
+                return
 
-          yield f"data: {json.dumps({'type': 'error', 'content': 'Max tool iterations reached'})}\n\n"
+            tool_round = begin_tool_round(conv, turn)
+            if tool_round is None:
+                yield out.push({"type": "done"})
+                return
+            # Tools can take a while; don't sit on text the user hasn't seen
+            frame = out.flush()
+            if frame:
+                yield frame
+            tool_calls, calls, events = tool_round
+            for event in events:
+                yield out.push(event)
+            results = [None] * len(calls)
+            for i, result in run_tool_calls(calls, conv["workspace"], conv["session"]):
+                results[i] = result
+                yield out.push(tool_result_event(tool_calls[i], result))
+            end_tool_round(conv, tool_calls, results)
+
+        yield out.push({"type": "error", "content": "Max tool iterations reached"})
+
+    except requests.exceptions.ConnectionError:
+        yield out.push({"type": "error", "content": "Connection failed - check your network"})
+    except requests.exceptions.Timeout:
+        yield out.push({"type": "error", "content": "Request timed out"})
+    except Exception as e:
+        yield out.push({"type": "error", "content": f"Unexpected error: {_redact(str(e), conv['api_key'])}"})
 
-        except requests.exceptions.ConnectionError:
-            yield f"data: {json.dumps({'type': 'error', 'content': 'Connection failed - check your network'})}\n\n"
-        except requests.exceptions.Timeout:
-            yield f"data: {json.dumps({'type': 'error', 'content': 'Request timed out'})}\n\n"
-        except Exception as e:
-            msg = str(e)
-            if api_key:
-                msg = msg.replace(api_key, "[REDACTED]")
-            yield f"data: {json.dumps({'type': 'error', 'content': f'Unexpected error: {msg}'})}\n\n"
 
+@app.route("/api/chat", methods=["POST"])
+def chat():
+    conv, error = prepare_chat(request.json)
+    if error:
+        return Response(_sse({"type": "error", "content": error}), mimetype="text/event-stream")
     return Response(
-        stream_with_context(generate()),
+        stream_with_context(stream_chat(conv)),
         mimetype="text/event-stream",
         headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
 
 
-def _stream_anthropic(api_key, full_messages, model, temperature, max_tokens):
-    """Anthropic streaming with tool loop."""
-    system, anthropic_msgs = convert_messages_for_anthropic(full_messages)
-    anthropic_tools = convert_tools_for_anthropic(TOOL_DEFINITIONS)
-
-    for iteration in range(10):
-        body = {"model": model, "max_tokens": max_tokens, "messages": anthropic_msgs,
-                "tools": anthropic_tools, "stream": True}
-        if system:
-            body["system"] = system
-        if temperature is not None:
-            body["temperature"] = temperature
-
-        resp = requests.post(
-            "https://api.anthropic.com/v1/messages",
-            headers={"Content-Type": "application/json", "x-api-key": api_key,
-                     "anthropic-version": "2023-06-01"},
-            json=body, stream=True, timeout=120,
-        )
-        resp.encoding = "utf-8"
-
-        if resp.status_code != 200:
-            error_msg = f"Anthropic API error {resp.status_code}"
-            try:
-                err = resp.json()
-                error_msg = err.get("error", {}).get("message", error_msg)
-            except Exception:
-                pass
-            if api_key:
-                error_msg = error_msg.replace(api_key, "[REDACTED]")
-            yield f"data: {json.dumps({'type': 'error', 'content': error_msg})}\n\n"
-            return
-
-        content_buffer = ""
-        tool_calls = {}
-        stop_reason = None
-        current_event = None
-
-        for line in resp.iter_lines(decode_unicode=True):
-            if not line:
-                continue
-            if line.startswith("event: "):
-                current_event = line[7:]
-                continue
-            if not line.startswith("data: "):
-                continue
-            try:
-                data = json.loads(line[6:])
-            except json.JSONDecodeError:
-                continue
-
-            if current_event == "content_block_start":
-                block = data.get("content_block", {})
-                if block.get("type") == "tool_use":
-                    idx = data["index"]
-                    tool_calls[idx] = {"id": block["id"], "name": block["name"], "arguments": ""}
-                    yield f"data: {json.dumps({'type': 'tool_call', 'name': block['name'], 'args': ''})}\n\n"
-
-            elif current_event == "content_block_delta":
-                delta = data.get("delta", {})
-                if delta.get("type") == "text_delta":
-                    content_buffer += delta["text"]
-                    yield f"data: {json.dumps({'type': 'content', 'content': delta['text']})}\n\n"
-                elif delta.get("type") == "input_json_delta":
-                    idx = data["index"]
-                    if idx in tool_calls:
-                        tool_calls[idx]["arguments"] += delta.get("partial_json", "")
-
-            elif current_event == "message_delta":
-                stop_reason = data.get("delta", {}).get("stop_reason")
-                usage = data.get("usage", {})
-                if usage:
-                    yield f"data: {json.dumps({'type': 'usage', 'usage': {'prompt_tokens': 0, 'completion_tokens': usage.get('output_tokens', 0), 'total_tokens': usage.get('output_tokens', 0)}})}\n\n"
-
-            elif current_event == "message_start":
-                usage = data.get("message", {}).get("usage", {})
-                if usage:
-                    yield f"data: {json.dumps({'type': 'usage', 'usage': {'prompt_tokens': usage.get('input_tokens', 0), 'completion_tokens': 0, 'total_tokens': usage.get('input_tokens', 0)}})}\n\n"
-
-        if stop_reason == "tool_use" and tool_calls:
-            sorted_calls = [tool_calls[k] for k in sorted(tool_calls.keys())]
-
-            # Build assistant message in Anthropic format
-            assistant_content = []
-            if content_buffer:
-                assistant_content.append({"type": "text", "text": content_buffer})
-            for tc in sorted_calls:
-                try:
-                    inp = json.loads(tc["arguments"])
-                except (json.JSONDecodeError, KeyError):
-                    inp = {}
-                assistant_content.append({"type": "tool_use", "id": tc["id"], "name": tc["name"], "input": inp})
-            anthropic_msgs.append({"role": "assistant", "content": assistant_content})
-
-            # Execute tools
-            tool_results = []
-            for tc in sorted_calls:
-                try:
-                    args = json.loads(tc["arguments"])
-                except (json.JSONDecodeError, KeyError):
-                    args = {}
-                result = execute_tool(tc["name"], args)
-                yield f"data: {json.dumps({'type': 'tool_result', 'name': tc['name'], 'result': result[:500]})}\n\n"
-                tool_results.append({"type": "tool_result", "tool_use_id": tc["id"], "content": result})
-            anthropic_msgs.append({"role": "user", "content": tool_results})
-
-            content_buffer = ""
-            tool_calls = {}
-            stop_reason = None
-            continue
-
-        yield f"data: {json.dumps({'type': 'done'})}\n\n"
-        return
-
-    yield f"data: {json.dumps({'type': 'error', 'content': 'Max tool iterations reached'})}\n\n"
-
-
 # ── File Browser ──────────────────────────────
 
 @app.route("/api/files/list")
 def list_dir():
-    path = request.args.get("path", WORKSPACE)
+    path = request.args.get("path", current_workspace())
     try:
         entries = []
         for item in sorted(os.listdir(path)):
@@ -796,26 +2676,42 @@ def list_dir():
 
 @app.route("/api/files/read")
 def read_file_api():
+    """File contents as JSON; ?offset=&length= (bytes) or ?start_line=&end_line= narrow the read."""
     path = request.args.get("path", "")
     try:
-        # Check if it's an image
-        mime, _ = mimetypes.guess_type(path)
-        if mime and mime.startswith("image/"):
-            import base64
-            with open(path, "rb") as f:
-                data = base64.b64encode(f.read()).decode()
-            return jsonify({"image": True, "mime": mime, "data": data, "path": path})
-
-        with open(path, "r", encoding="utf-8", errors="replace") as f:
-            content = f.read()
-        if len(content) > 200000:
-            content = content[:200000] + f"\n\n... [truncated]"
-        ext = os.path.splitext(path)[1].lstrip(".")
-        return jsonify({"content": content, "path": path, "extension": ext})
+        etag = file_etag(os.stat(path))
+        if request.if_none_match.contains_weak(etag):
+            resp = Response(status=304)
+        else:
+            resp = jsonify(_read_file_payload(path))
+        resp.set_etag(etag)
+        resp.headers["Cache-Control"] = "no-cache"  # always revalidate, usually with a 304
+        return resp
     except Exception as e:
         return jsonify({"error": str(e)}), 400
 
 
+def _read_file_payload(path):
+    # Check if it's an image
+    mime, _ = mimetypes.guess_type(path)
+    if mime and mime.startswith("image/"):
+        return {"image": True, "mime": mime, "path": path, "size": os.path.getsize(path),
+                "url": f"/api/files/raw?{urlencode({'path': path})}"}
+
+    offset, length = _int_arg("offset"), _int_arg("length")
+    start_line, end_line = _int_arg("start_line"), _int_arg("end_line")
+    content, truncated = read_text(path, FILE_READ_LIMIT, offset, length, start_line, end_line)
+    if truncated:
+        content += "\n\n... [truncated]"
+    ext = os.path.splitext(path)[1].lstrip(".")
+    payload = {"content": content, "path": path, "extension": ext}
+    if offset is not None or length is not None:
+        payload.update(offset=max(0, offset or 0), size=os.path.getsize(path), truncated=truncated)
+    elif start_line or end_line:
+        payload.update(start_line=max(1, start_line or 1), truncated=truncated)
+    return payload
+
+
 # ── File Upload ──────────────────────────────
 
 @app.route("/api/upload", methods=["POST"])
@@ -824,27 +2720,56 @@ def upload():
         return jsonify({"error": "no file"}), 400
     f = request.files["file"]
     mime = f.content_type or ""
-    if mime.startswith("image/"):
-        import base64
-        data = base64.b64encode(f.read()).decode()
-        return jsonify({"filename": f.filename, "image": True, "mime": mime, "data": data})
-    content = f.read().decode("utf-8", errors="replace")
+    data = f.read()
+    # SVG is text, so it is attached like any other file; other formats providers
+    # can't take (BMP, ICO, TIFF, ...) are converted to PNG when Pillow is installed
+    if mime.startswith("image/") and not mime.startswith("image/svg"):
+        if sniff_image(data) is None:
+            data = transcode_image(data) or data
+        try:
+            image = store_image(data)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        return jsonify({"filename": f.filename, "image": True, **image})
+    content = data.decode("utf-8", errors="replace")
     return jsonify({"filename": f.filename, "content": content})
 
 
 # ── Workspace ──────────────────────────────
 
+@app.before_request
+def bind_session():
+    # The session mapping lives in STATE, so every worker agrees on it
+    sid = request.headers.get(SESSION_HEADER) or request.cookies.get(SESSION_COOKIE)
+    g.new_session = not (sid and SESSION_ID_RE.match(sid))
+    g.session = secrets.token_urlsafe(18) if g.new_session else sid
+    enter_workspace(WORKSPACE if g.new_session else session_workspace(sid), g.session)
+
+
+@app.after_request
+def set_session_cookie(resp):
+    if g.get("new_session"):
+        resp.set_cookie(SESSION_COOKIE, g.session, httponly=True, samesite="Lax")
+    return resp
+
+
 @app.route("/api/workspace", methods=["GET", "POST"])
 def workspace():
-    global WORKSPACE
     if request.method == "POST":
         new_path = request.json.get("path", "")
         new_path = os.path.abspath(new_path)
         if os.path.isdir(new_path):
-            WORKSPACE = new_path
-            return jsonify({"workspace": WORKSPACE.replace("\\", "/")})
+            update_session(g.session, workspace=new_path)
+            enter_workspace(new_path, g.session)
+            with WATCH_LOCK:
+                followers = [sub for sub in WATCH_SUBSCRIBERS if sub["session"] == g.session]
+                for sub in followers:
+                    sub["root"] = new_path
+            if followers:
+                ensure_watcher(new_path)
+            return jsonify({"workspace": new_path.replace("\\", "/")})
         return jsonify({"error": "directory not found"}), 400
-    return jsonify({"workspace": WORKSPACE.replace("\\", "/")})
+    return jsonify({"workspace": current_workspace().replace("\\", "/")})
 
 
 # ── Providers ──────────────────────────────
@@ -861,6 +2786,11 @@ def providers():
     return jsonify(result)
 
 
+@app.route("/api/providers/stats")
+def provider_stats():
+    return jsonify({"pool_size": HTTP_POOL_SIZE, "timeouts": HTTP_TIMEOUTS, "origins": http_pool_stats()})
+
+
 @app.route("/api/models")
 def models():
     return {"models": ["grok-4-1-fast-reasoning", "grok-3-fast", "grok-3", "grok-3-mini"]}
@@ -871,7 +2801,7 @@ def models():
 @app.route("/api/terminal", methods=["POST"])
 def terminal():
     command = request.json.get("command", "")
-    cwd = request.json.get("cwd", WORKSPACE)
+    cwd = request.json.get("cwd", current_workspace())
     try:
         result = subprocess.run(
             command, shell=True, capture_output=True, text=True, timeout=30, cwd=cwd
@@ -888,22 +2818,404 @@ def terminal():
 
 # ── Git ──────────────────────────────
 
+# Whole-tree diffs come from one `git diff` (unstaged) and one `git diff
+# --cached` (staged), split per file as the output streams in. The staged
+# split only changes with the index and HEAD, so it is cached on their stat
+# signatures; the unstaged split also depends on the working tree, so its key
+# adds the stat of every file status reports as modified. Paths are relative
+# to the repository top level, as git prints them.
+GIT_TIMEOUT = 30
+GIT_DIFF_ARGS = ["-c", "core.quotepath=false", "diff", "--no-color", "--no-ext-diff", "--no-renames",
+                 "--src-prefix=a/", "--dst-prefix=b/"]
+GIT_CACHE = {}  # {root: {"repo": (gitdir, commondir, toplevel) or None, "staged": (key, diffs), "unstaged": (key, diffs)}}
+GIT_LOCK = threading.Lock()
+
+
+def _git_cache(root):
+    with GIT_LOCK:
+        return GIT_CACHE.setdefault(root, {})
+
+
+def git_repo(root):
+    """(gitdir, commondir, toplevel) of the repository containing root, or None; found without spawning git.
+
+    Only found repositories are cached (while their git dir exists): a
+    `git init` in a plain workspace is picked up by the next call.
+    """
+    cache = _git_cache(root)
+    repo = cache.get("repo")
+    if repo is not None and os.path.isdir(repo[0]):
+        return repo
+    repo = None
+    top = root
+    while True:
+        dot = os.path.join(top, ".git")
+        if os.path.isdir(dot):
+            repo = (dot, dot, top)
+            break
+        if os.path.isfile(dot):
+            with contextlib.suppress(OSError), open(dot, encoding="utf-8") as f:
+                line = f.read().strip()
+                if line.startswith("gitdir:"):
+                    gitdir = os.path.normpath(os.path.join(top, line[7:].strip()))
+                    common = gitdir
+                    with contextlib.suppress(OSError), open(os.path.join(gitdir, "commondir"), encoding="utf-8") as c:
+                        common = os.path.normpath(os.path.join(gitdir, c.read().strip()))
+                    repo = (gitdir, common, top)
+            break
+        parent = os.path.dirname(top)
+        if parent == top:
+            break
+        top = parent
+    if repo is None:
+        cache.pop("repo", None)
+    else:
+        cache["repo"] = repo
+    return repo
+
+
+def _stat_key(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+
+def git_head(repo):
+    """(branch or "", HEAD file contents) read straight from the git dir."""
+    gitdir, _, _ = repo
+    try:
+        with open(os.path.join(gitdir, "HEAD"), encoding="utf-8") as f:
+            head = f.read().strip()
+    except OSError:
+        return "", ""
+    return (head[16:] if head.startswith("ref: refs/heads/") else ""), head
+
+
+def _git_state_key(repo):
+    """Changes whenever the index or what HEAD points at does."""
+    gitdir, common, _ = repo
+    _, head = git_head(repo)
+    ref = os.path.join(common, head[5:]) if head.startswith("ref: ") else None
+    return (_stat_key(os.path.join(gitdir, "index")), head, ref and _stat_key(ref),
+            _stat_key(os.path.join(common, "packed-refs")))
+
+
+def _diff_header_path(rest):
+    """Path from the `a/X b/X` tail of a `diff --git` line (no renames, so both sides agree)."""
+    if rest.startswith('"'):
+        # C-quoted when the path has quotes, backslashes or control characters
+        quoted = rest[1:rest.index('" ')] if '" ' in rest else rest[1:]
+        raw = codecs.escape_decode(quoted.encode("utf-8"))[0].decode("utf-8", "replace")
+        return raw[2:]
+    n = (len(rest) - 5) // 2
+    return rest[2:2 + n]
+
+
+def git_diffs(root, staged=False):
+    """{path: diff text} for every file with unstaged (or staged) changes, from one git invocation."""
+    args = ["git"] + GIT_DIFF_ARGS + (["--cached"] if staged else [])
+    started = time.perf_counter()
+    proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True,
+                            encoding="utf-8", errors="replace", cwd=git_repo(root)[2])
+    diffs = {}
+    path, chunk = None, []
+    try:
+        for line in proc.stdout:
+            if line.startswith("diff --git "):
+                if path is not None:
+                    diffs[path] = "".join(chunk)
+                path, chunk = _diff_header_path(line[11:].rstrip("\n")), []
+            chunk.append(line)
+        if path is not None:
+            diffs[path] = "".join(chunk)
+        proc.wait(timeout=GIT_TIMEOUT)
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        record_git_call("diff", started)
+    return diffs
+
+
+def git_status_entries(root):
+    """[{path, status, staged, worktree}] from `git status --porcelain -z`, paths relative to the top level."""
+    repo = git_repo(root)
+    if repo is None:
+        return []
+    started = time.perf_counter()
+    try:
+        out = subprocess.run(["git", "status", "--porcelain", "-z"], capture_output=True, timeout=GIT_TIMEOUT,
+                             cwd=repo[2]).stdout.decode("utf-8", "replace")
+    finally:
+        record_git_call("status", started)
+    entries = []
+    fields = iter(out.split("\0"))
+    for field in fields:
+        if len(field) < 4:
+            continue
+        xy, path = field[:2], field[3:]
+        if xy[0] in "RC":
+            next(fields, None)  # the rename source follows
+        entries.append({"path": path, "status": xy.strip(), "staged": xy[0] not in (" ", "?"),
+                        "worktree": xy[1] not in (" ", "?")})
+    return entries
+
+
+def cached_diffs(root, entries):
+    """(unstaged, staged) per-file diffs, recomputed only when their cache keys change."""
+    repo = git_repo(root)
+    if repo is None:
+        return {}, {}
+    cache = _git_cache(root)
+    state = _git_state_key(repo)
+    top = repo[2]
+    keys = {
+        "staged": state,
+        "unstaged": (state, tuple((e["path"], _stat_key(os.path.join(top, e["path"])))
+                                  for e in entries if e["worktree"])),
+    }
+    result = {}
+    for kind, key in keys.items():
+        hit = cache.get(kind)
+        if hit is None or hit[0] != key:
+            hit = cache[kind] = (key, git_diffs(root, staged=kind == "staged"))
+        result[kind] = hit[1]
+    return result["unstaged"], result["staged"]
+
+
+# Object reads go through long-lived `git cat-file --batch` (contents) and
+# `--batch-check` (type and size) processes, a few per workspace, instead of
+# a fork+exec per request. Every git call is timed: totals per operation are
+# kept in GIT_STATS, and each response lists its own in a Server-Timing header.
+GIT_BATCH_WORKERS = 2
+GIT_BINARY_SNIFF = 8000
+GIT_STATS = {}  # {op: {calls, total_ms, max_ms}}
+GIT_STATS_LOCK = threading.Lock()
+
+
+def record_git_call(op, started):
+    ms = (time.perf_counter() - started) * 1000
+    with GIT_STATS_LOCK:
+        stat = GIT_STATS.setdefault(op, {"calls": 0, "total_ms": 0.0, "max_ms": 0.0})
+        stat["calls"] += 1
+        stat["total_ms"] += ms
+        stat["max_ms"] = max(stat["max_ms"], ms)
+    if has_request_context():
+        g.setdefault("git_timings", []).append((op, ms))
+
+
+@app.after_request
+def git_server_timing(resp):
+    timings = g.get("git_timings")
+    if timings:
+        totals = {}
+        for op, ms in timings:
+            calls, total = totals.get(op, (0, 0.0))
+            totals[op] = (calls + 1, total + ms)
+        resp.headers["Server-Timing"] = ", ".join(
+            f'git-{op};dur={total:.2f};desc="{calls} call{"s" if calls > 1 else ""}"'
+            for op, (calls, total) in totals.items())
+    return resp
+
+
+class GitBatch:
+    """A small pool of long-lived `git cat-file <mode>` processes for one repository."""
+
+    def __init__(self, top, mode):
+        self.top = top
+        self.mode = mode
+        self.idle = []
+        self.count = 0
+        self.cond = threading.Condition()
+        self.closed = False
+        self.deadlines = {}  # {proc: monotonic deadline} for queries in flight
+        self.watchdog = None
+
+    def _arm(self, proc):
+        with self.cond:
+            self.deadlines[proc] = time.monotonic() + GIT_TIMEOUT
+            if self.watchdog is None:
+                self.watchdog = threading.Thread(target=self._watch, daemon=True, name="tetsuo-git-watchdog")
+                self.watchdog.start()
+
+    def _disarm(self, proc):
+        with self.cond:
+            self.deadlines.pop(proc, None)
+
+    def _watch(self):
+        """Kill workers whose query outlived GIT_TIMEOUT; exits once nothing is in flight."""
+        while True:
+            with self.cond:
+                now = time.monotonic()
+                for proc, deadline in list(self.deadlines.items()):
+                    if deadline <= now:
+                        del self.deadlines[proc]
+                        proc.kill()  # unblocks the reader with EOF
+                if not self.deadlines:
+                    self.watchdog = None
+                    return
+                wait = min(self.deadlines.values()) - now
+            time.sleep(wait)
+
+    @contextlib.contextmanager
+    def _worker(self):
+        with self.cond:
+            while not self.idle and self.count >= GIT_BATCH_WORKERS:
+                self.cond.wait()
+            proc = self.idle.pop() if self.idle else None
+            if proc is None:
+                self.count += 1
+        healthy = False
+        try:
+            if proc is None or proc.poll() is not None:
+                proc = subprocess.Popen(["git", "cat-file", self.mode], stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, cwd=self.top)
+            yield proc
+            healthy = True
+        finally:
+            with self.cond:
+                if healthy and not self.closed:
+                    self.idle.append(proc)
+                else:
+                    self.count -= 1
+                    if proc is not None:
+                        if proc.poll() is None:
+                            proc.kill()
+                        proc.wait()
+                self.cond.notify()
+
+    def query(self, spec):
+        """(sha, type, size, data) for the object spec names (data None in --batch-check mode), or None."""
+        if "\n" in spec:
+            raise ValueError("object name contains a newline")
+        started = time.perf_counter()
+        try:
+            with self._worker() as proc:
+                # A wedged worker is killed by the pool's watchdog after GIT_TIMEOUT
+                self._arm(proc)
+                try:
+                    proc.stdin.write(spec.encode("utf-8") + b"\n")
+                    proc.stdin.flush()
+                    header = proc.stdout.readline()
+                    if not header.endswith(b"\n"):
+                        raise RuntimeError("git cat-file exited or timed out")
+                    header = header.decode("utf-8", "replace").rstrip("\n")
+                    if header.endswith((" missing", " ambiguous")):
+                        return None
+                    sha, kind, size = header.rsplit(" ", 2)
+                    data = None
+                    if self.mode == "--batch":
+                        data = proc.stdout.read(int(size) + 1)
+                        if len(data) != int(size) + 1:
+                            raise RuntimeError("git cat-file exited or timed out")
+                        data = data[:-1]
+                    return sha, kind, int(size), data
+                finally:
+                    self._disarm(proc)
+        finally:
+            record_git_call("cat-file" if self.mode == "--batch" else "cat-file-check", started)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            idle, self.idle = self.idle, []
+        for proc in idle:
+            with contextlib.suppress(OSError):
+                proc.stdin.close()
+            proc.wait()
+
+
+def git_batch(root, mode="--batch"):
+    """The cat-file pool for root's repository; recycled when HEAD or packed refs move."""
+    repo = git_repo(root)
+    if repo is None:
+        raise RuntimeError("not a git repository")
+    key = _git_state_key(repo)[1:]
+    cache = _git_cache(root)
+    with GIT_LOCK:
+        pools = cache.setdefault("batch", {})
+        old = pools.get(mode)
+        pool = old if old is not None and old.key == key else None
+        if pool is None:
+            pool = pools[mode] = GitBatch(repo[2], mode)
+            pool.key = key
+    if old is not None and old is not pool:
+        old.close()
+    return pool
+
+
+def _close_git_batches():
+    for git in list(GIT_CACHE.values()):
+        for pool in git.get("batch", {}).values():
+            pool.close()
+
+
+atexit.register(_close_git_batches)
+
+
+def git_object(root, spec):
+    """(sha, type, bytes) of a git object such as "HEAD:path/to/file", or None."""
+    found = git_batch(root).query(spec)
+    return found and (found[0], found[1], found[3])
+
+
+def git_object_info(root, spec):
+    """(sha, type, size) of a git object without reading it, or None."""
+    found = git_batch(root, "--batch-check").query(spec)
+    return found and found[:3]
+
+
+def _parse_tree(data):
+    entries = []
+    pos = 0
+    while pos < len(data):
+        space = data.index(b" ", pos)
+        nul = data.index(b"\0", space)
+        mode = data[pos:space].decode()
+        name = data[space + 1:nul].decode("utf-8", "replace")
+        sha = data[nul + 1:nul + 21].hex()
+        kind = "tree" if mode == "40000" else ("commit" if mode == "160000" else "blob")
+        entries.append({"name": name, "mode": mode, "type": kind, "sha": sha})
+        pos = nul + 21
+    return entries
+
+
+def _parse_commit(data):
+    text = data.decode("utf-8", "replace")
+    headers, _, message = text.partition("\n\n")
+    commit = {"parents": [], "message": message}
+    for line in headers.splitlines():
+        key, _, value = line.partition(" ")
+        if key == "tree":
+            commit["tree"] = value
+        elif key == "parent":
+            commit["parents"].append(value)
+        elif key == "author":
+            name, _, stamp = value.rpartition("> ")
+            commit["author"] = name.split(" <")[0]
+            commit["time"] = int(stamp.split()[0]) if stamp else None
+    return commit
+
+
+def _repo_rel(root, path):
+    """path (absolute, or relative to the workspace) relative to the repository top level."""
+    full = _resolve_path(path)
+    if full is None:
+        raise ValueError("Access denied: path outside workspace")
+    rel = os.path.relpath(full, git_repo(root)[2]).replace("\\", "/")
+    return "" if rel == "." else rel  # "HEAD:" names the root tree; "HEAD:." doesn't resolve
+
+
 @app.route("/api/git/status")
 def git_status():
     try:
-        branch = subprocess.run(
-            ["git", "branch", "--show-current"], capture_output=True, text=True, timeout=5, cwd=WORKSPACE
-        ).stdout.strip()
-        status = subprocess.run(
-            ["git", "status", "--porcelain"], capture_output=True, text=True, timeout=5, cwd=WORKSPACE
-        ).stdout
-        files = []
-        for line in status.splitlines():
-            if len(line) >= 4:
-                xy = line[:2]
-                path = line[3:]
-                staged = xy[0] not in (" ", "?")
-                files.append({"path": path, "status": xy.strip(), "staged": staged})
+        root = current_workspace()
+        entries = git_status_entries(root)
+        repo = git_repo(root)
+        branch = git_head(repo)[0] if repo else ""
+        files = [{"path": e["path"], "status": e["status"], "staged": e["staged"]} for e in entries]
         return jsonify({"branch": branch, "files": files})
     except Exception as e:
         return jsonify({"error": str(e)}), 400
@@ -913,24 +3225,95 @@ def git_status():
 def git_diff():
     path = request.args.get("path", "")
     try:
-        result = subprocess.run(
-            ["git", "diff", "--", path] if path else ["git", "diff"],
-            capture_output=True, text=True, timeout=10, cwd=WORKSPACE
-        )
-        staged = subprocess.run(
-            ["git", "diff", "--cached", "--", path] if path else ["git", "diff", "--cached"],
-            capture_output=True, text=True, timeout=10, cwd=WORKSPACE
-        )
-        return jsonify({"diff": result.stdout + staged.stdout})
+        root = current_workspace()
+        unstaged, staged = cached_diffs(root, git_status_entries(root))
+        if not path:
+            return jsonify({"diff": "".join(unstaged.values()) + "".join(staged.values())})
+        top = git_repo(root)[2] if unstaged or staged else root
+        # Paths from /api/git/status are top-level relative; others are taken relative to the workspace
+        full = path if os.path.isabs(path) else os.path.join(root, path)
+        rel = path if path in unstaged or path in staged else os.path.relpath(full, top).replace("\\", "/")
+        return jsonify({"diff": unstaged.get(rel, "") + staged.get(rel, "")})
     except Exception as e:
         return jsonify({"error": str(e)}), 400
 
 
+@app.route("/api/git/show")
+def git_show():
+    """?rev= (default HEAD) and ?path=: the file, directory listing or (without a path) commit at that revision."""
+    rev = request.args.get("rev", "HEAD")
+    path = request.args.get("path", "")
+    try:
+        root = current_workspace()
+        if git_repo(root) is None:
+            return jsonify({"error": "not a git repository"}), 400
+        spec = f"{rev}:{_repo_rel(root, path)}" if path else rev
+        info = git_object_info(root, spec)
+        if info is None:
+            return jsonify({"error": f"{spec} not found"}), 404
+        sha, kind, size = info
+        result = {"rev": rev, "path": path, "sha": sha, "type": kind, "size": size}
+        if kind == "blob" and size > FILE_READ_LIMIT * 4:
+            result["truncated"] = True
+            return jsonify(result)
+        _, kind, data = git_object(root, sha)
+        if kind == "tree":
+            result["entries"] = _parse_tree(data)
+        elif kind == "commit":
+            result.update(_parse_commit(data))
+        elif b"\0" in data[:GIT_BINARY_SNIFF]:
+            result["binary"] = True
+        else:
+            content = data.decode("utf-8", "replace")
+            result["content"] = content[:FILE_READ_LIMIT]
+            result["truncated"] = len(content) > FILE_READ_LIMIT
+        return jsonify(result)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+
+
+@app.route("/api/git/diff-head")
+def git_diff_head():
+    """Diff of a workspace file against its HEAD version, without spawning git."""
+    path = request.args.get("path", "")
+    if not path:
+        return jsonify({"error": "path required"}), 400
+    try:
+        root = current_workspace()
+        repo = git_repo(root)
+        if repo is None:
+            return jsonify({"error": "not a git repository"}), 400
+        rel = _repo_rel(root, path)
+        head = git_head_commit(repo)
+        found = git_object(root, f"{head}:{rel}") if head else None
+        old = found[2] if found and found[1] == "blob" else b""
+        try:
+            with open(os.path.join(repo[2], rel), "rb") as f:
+                new = f.read()
+        except FileNotFoundError:
+            new = b""
+        if b"\0" in old[:GIT_BINARY_SNIFF] or b"\0" in new[:GIT_BINARY_SNIFF]:
+            return jsonify({"path": rel, "binary": True, "changed": old != new})
+        diff = compute_diff(old.decode("utf-8", "replace"), new.decode("utf-8", "replace"), rel, DIFF_OUTPUT_LIMIT)
+        return jsonify({"path": rel, "head": head, "blob": found[0] if found else None, "diff": diff})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+
+
+@app.route("/api/git/stats")
+def git_stats():
+    """Per-operation git call counts and latencies since startup."""
+    with GIT_STATS_LOCK:
+        stats = {op: {"calls": st["calls"], "avg_ms": round(st["total_ms"] / st["calls"], 3),
+                      "max_ms": round(st["max_ms"], 3)} for op, st in GIT_STATS.items()}
+    return jsonify({"stats": stats})
+
+
 @app.route("/api/git/stage", methods=["POST"])
 def git_stage():
     files = request.json.get("files", [])
     try:
-        subprocess.run(["git", "add"] + files, capture_output=True, text=True, timeout=10, cwd=WORKSPACE)
+        subprocess.run(["git", "add"] + files, capture_output=True, text=True, timeout=10, cwd=current_workspace())
         return jsonify({"success": True})
     except Exception as e:
         return jsonify({"error": str(e)}), 400
@@ -940,7 +3323,7 @@ def git_stage():
 def git_unstage():
     files = request.json.get("files", [])
     try:
-        subprocess.run(["git", "reset", "HEAD"] + files, capture_output=True, text=True, timeout=10, cwd=WORKSPACE)
+        subprocess.run(["git", "reset", "HEAD"] + files, capture_output=True, text=True, timeout=10, cwd=current_workspace())
         return jsonify({"success": True})
     except Exception as e:
         return jsonify({"error": str(e)}), 400
@@ -953,7 +3336,7 @@ def git_commit():
         return jsonify({"error": "commit message required"}), 400
     try:
         result = subprocess.run(
-            ["git", "commit", "-m", message], capture_output=True, text=True, timeout=15, cwd=WORKSPACE
+            ["git", "commit", "-m", message], capture_output=True, text=True, timeout=15, cwd=current_workspace()
         )
         return jsonify({"output": result.stdout + result.stderr, "exit_code": result.returncode})
     except Exception as e:
@@ -964,7 +3347,7 @@ def git_commit():
 def git_push():
     try:
         result = subprocess.run(
-            ["git", "push"], capture_output=True, text=True, timeout=30, cwd=WORKSPACE
+            ["git", "push"], capture_output=True, text=True, timeout=30, cwd=current_workspace()
         )
         return jsonify({"output": result.stdout + result.stderr, "exit_code": result.returncode})
     except Exception as e:
@@ -981,6 +3364,7 @@ def save_file():
         os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
         with open(path, "w", encoding="utf-8") as f:
             f.write(content)
+        invalidate_scan(path)
         return jsonify({"success": True, "path": path})
     except Exception as e:
         return jsonify({"error": str(e)}), 400
@@ -994,18 +3378,11 @@ def search_files():
     if not query:
         return jsonify({"files": []})
     results = []
-    skip_dirs = {".git", "node_modules", "__pycache__", "dist", "build", ".next", "venv", ".venv", ".tox", "egg-info"}
-    for root, dirs, filenames in os.walk(WORKSPACE):
-        dirs[:] = [d for d in dirs if d not in skip_dirs and not d.startswith(".")]
-        for fn in filenames:
-            if query in fn.lower():
-                full = os.path.join(root, fn)
-                rel = os.path.relpath(full, WORKSPACE).replace("\\", "/")
-                results.append({"name": fn, "path": full.replace("\\", "/"), "rel": rel})
-                if len(results) >= 50:
-                    break
-        if len(results) >= 50:
-            break
+    for f in scan_workspace():
+        if query in f["name"].lower():
+            results.append({"name": f["name"], "path": f["full"], "rel": f["path"]})
+            if len(results) >= 50:
+                break
     return jsonify({"files": results})
 
 
@@ -1013,23 +3390,208 @@ def search_files():
 
 @app.route("/api/files/undo", methods=["POST"])
 def undo_file_edit():
-    if not FILE_EDIT_HISTORY:
+    path = (request.get_json(silent=True) or {}).get("path", "")
+    j = journal()
+    entry = j.pop_edit(_resolve_path(path) if path else None, current_session())
+    if not entry:
         return jsonify({"error": "Nothing to undo"}), 400
-    entry = FILE_EDIT_HISTORY.pop()
     try:
+        content = j.get(entry["old"])
         with open(entry["path"], "w", encoding="utf-8") as f:
-            f.write(entry["old_content"])
+            f.write(content)
+        invalidate_scan(entry["path"])
         return jsonify({"success": True, "path": entry["path"], "action": f"Reverted {entry['tool']} on {os.path.basename(entry['path'])}"})
     except Exception as e:
         return jsonify({"error": str(e)}), 400
 
 
-@app.route("/api/files/history")
-def file_edit_history():
-    return jsonify({"history": [
-        {"path": h["path"], "tool": h["tool"], "timestamp": h["timestamp"]}
-        for h in FILE_EDIT_HISTORY[-20:]
-    ]})
+@app.route("/api/files/history")
+def file_edit_history():
+    return jsonify({"history": [
+        {"path": h["path"], "tool": h["tool"], "timestamp": h["timestamp"]}
+        for h in journal().recent_edits(20, current_session())
+    ]})
+
+
+# ── Grep Engine ──────────────────────────────
+
+GREP_WORKERS = min(16, (os.cpu_count() or 2) * 2)
+GREP_WINDOW = GREP_WORKERS * 4  # files in flight at once
+GREP_MMAP_THRESHOLD = 1 << 20  # read files at least this large through mmap
+GREP_DECODE_WINDOW = 1 << 20  # bytes decoded at a time when searching a non-ASCII file
+GREP_BINARY_SNIFF = 8192
+GREP_MAX_RESULTS = 200
+GREP_MAX_PER_FILE = 100
+GREP_RESULTS_LIMIT = 10000
+GREP_EXECUTOR = None
+
+
+def _grep_executor():
+    global GREP_EXECUTOR
+    if GREP_EXECUTOR is None:
+        GREP_EXECUTOR = ThreadPoolExecutor(max_workers=GREP_WORKERS, thread_name_prefix="tetsuo-grep")
+    return GREP_EXECUTOR
+
+
+_NON_ASCII = re.compile(rb"[\x80-\xff]")
+# Anchors and lookarounds can match differently once a line has neighbours around it
+_CONTEXT_SENSITIVE = re.compile(r"\$|\\[AZB]|\(\?[=!<]")
+
+
+def compile_grep_pattern(query, is_regex=False, case_sensitive=False):
+    """Compile a search pattern; it is matched against one line at a time, like `grep`."""
+    return re.compile(query if is_regex else re.escape(query), 0 if case_sensitive else re.IGNORECASE)
+
+
+def _scan_pattern(pattern):
+    """MULTILINE twin of a line pattern, used to find candidate lines in a whole buffer, or None.
+
+    Without anchors or lookarounds, a line that matches on its own always
+    contains the start of a buffer match, so no line is missed; candidates
+    are then confirmed against the line alone.
+    """
+    if _CONTEXT_SENSITIVE.search(pattern.pattern):
+        return None
+    return re.compile(pattern.pattern, pattern.flags | re.MULTILINE)
+
+
+def _bytes_pattern(pattern):
+    """The bytes twin of an ASCII str pattern, or None. Only used on ASCII-only files, where both agree."""
+    if not pattern.pattern.isascii():
+        return None
+    try:
+        return re.compile(pattern.pattern.encode(), pattern.flags & ~re.UNICODE)
+    except re.error:  # e.g. \u escapes, which bytes patterns don't support
+        return None
+
+
+def _grep_lines(buf, scan, pattern, nl, line_no, max_per_file, cancel):
+    """Up to max_per_file [{line, text}] matches in buf (str, bytes or mmap), numbering from line_no."""
+    count = buf.count if not isinstance(buf, mmap.mmap) else lambda s, a, b: buf[a:b].count(s)
+    matches = []
+    counted, pos, end = 0, 0, len(buf)
+    while pos <= end and len(matches) < max_per_file and not cancel.is_set():
+        m = scan.search(buf, pos)
+        if m is None:
+            break
+        line_start = buf.rfind(nl, 0, m.start()) + 1
+        if line_start == end:  # after the final newline; not a line
+            break
+        line_end = buf.find(nl, m.start())
+        if line_end == -1:
+            line_end = end
+        pos = line_end + 1
+        # The buffer match may lean on the next line (\s, [^x], ...); only the line itself counts
+        if not pattern.search(buf[line_start:pos]):
+            continue
+        line_no += count(nl, counted, line_start)
+        counted = line_start
+        text = buf[line_start:line_end]
+        if not isinstance(text, str):
+            text = text.decode("utf-8", errors="replace")
+        matches.append({"line": line_no, "text": text.rstrip()[:200]})
+    return matches
+
+
+def _grep_each_line(text, pattern, line_no, max_per_file):
+    """The plain per-line loop, for patterns _scan_pattern can't speed up."""
+    matches = []
+    lines = text.split("\n")
+    last = len(lines) - 1
+    for i, line in enumerate(lines):
+        if i == last and not line:
+            break
+        if pattern.search(line if i == last else line + "\n"):
+            matches.append({"line": line_no + i, "text": line.rstrip()[:200]})
+            if len(matches) >= max_per_file:
+                break
+    return matches
+
+
+def _grep_file(full, pattern, max_per_file, cancel):
+    """Return up to max_per_file [{line, text}] matches in one file; [] for binary or unreadable files."""
+    if cancel.is_set():
+        return []
+    mapped = None
+    try:
+        with open(full, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if not size:
+                return []
+            if size >= GREP_MMAP_THRESHOLD:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                data = mapped
+            else:
+                data = f.read()
+    except (OSError, ValueError):
+        return []
+    try:
+        if b"\0" in data[:GREP_BINARY_SNIFF]:
+            return []
+        scan = _scan_pattern(pattern)
+        # ASCII files with plain \n endings are searched undecoded; anything else
+        # as str, so \w and IGNORECASE stay Unicode-aware
+        if scan is not None and data.find(b"\r") == -1 and not _NON_ASCII.search(data):
+            fast = _bytes_pattern(scan), _bytes_pattern(pattern)
+            if None not in fast:
+                return _grep_lines(data, *fast, b"\n", 1, max_per_file, cancel)
+        # Decoded a window at a time, cut after a newline (never inside a UTF-8
+        # sequence or a \r\n pair), so a large file is never held as one str.
+        # Line endings are normalized the way reading in text mode would.
+        matches, line_no, start, end = [], 1, 0, len(data)
+        while start < end and len(matches) < max_per_file and not cancel.is_set():
+            stop = data.find(b"\n", start + GREP_DECODE_WINDOW)
+            stop = end if stop == -1 else stop + 1
+            text = data[start:stop].decode("utf-8", errors="replace")
+            if "\r" in text:
+                text = text.replace("\r\n", "\n").replace("\r", "\n")
+            remaining = max_per_file - len(matches)
+            if scan is not None:
+                matches += _grep_lines(text, scan, pattern, "\n", line_no, remaining, cancel)
+            else:
+                matches += _grep_each_line(text, pattern, line_no, remaining)
+            line_no += text.count("\n")
+            start = stop
+        return matches
+    finally:
+        if mapped is not None:
+            mapped.close()
+
+
+def grep_stream(pattern, files=None, max_results=GREP_MAX_RESULTS, max_per_file=GREP_MAX_PER_FILE, cancel=None):
+    """Search files on the grep pool, yielding (entry, matches) per matching file in walk order.
+
+    Closing the generator (or setting cancel) stops outstanding work.
+    """
+    files = iter(scan_workspace(text_only=True) if files is None else files)
+    cancel = cancel or threading.Event()
+    executor = _grep_executor()
+    pending = collections.deque()
+
+    def submit_next():
+        for entry in files:
+            pending.append((entry, executor.submit(_grep_file, entry["full"], pattern, max_per_file, cancel)))
+            return
+
+    try:
+        for _ in range(GREP_WINDOW):
+            submit_next()
+        total = 0
+        while pending and not cancel.is_set():
+            entry, fut = pending.popleft()
+            matches = fut.result()
+            submit_next()
+            if not matches:
+                continue
+            matches = matches[:max_results - total]
+            total += len(matches)
+            yield entry, matches
+            if total >= max_results:
+                break
+    finally:
+        cancel.set()
+        for _, fut in pending:
+            fut.cancel()
 
 
 # ── Workspace Grep ──────────────────────────────
@@ -1039,38 +3601,34 @@ def grep_workspace():
     query = request.args.get("q", "")
     is_regex = request.args.get("regex", "false") == "true"
     case_sensitive = request.args.get("case", "false") == "true"
+    stream = request.args.get("stream", "false") == "true"
+    max_results = min(max(1, _int_arg("max") or GREP_MAX_RESULTS), GREP_RESULTS_LIMIT)
+    max_per_file = min(max(1, _int_arg("per_file") or GREP_MAX_PER_FILE), GREP_RESULTS_LIMIT)
     if not query:
         return jsonify({"results": []})
-    flags = 0 if case_sensitive else re.IGNORECASE
     try:
-        pattern = re.compile(query if is_regex else re.escape(query), flags)
+        pattern = compile_grep_pattern(query, is_regex, case_sensitive)
     except re.error:
         return jsonify({"error": "Invalid regex"}), 400
-    results = []
-    skip_dirs = {".git", "node_modules", "__pycache__", "dist", "build", ".next", "venv", ".venv"}
-    skip_ext = {".pyc", ".pyo", ".exe", ".dll", ".so", ".o", ".class", ".png", ".jpg", ".gif", ".ico", ".woff", ".woff2", ".ttf"}
-    for root, dirs, filenames in os.walk(WORKSPACE):
-        dirs[:] = [d for d in dirs if d not in skip_dirs and not d.startswith(".")]
-        for fn in filenames:
-            ext = os.path.splitext(fn)[1].lower()
-            if ext in skip_ext:
-                continue
-            full = os.path.join(root, fn)
-            rel = os.path.relpath(full, WORKSPACE).replace("\\", "/")
-            try:
-                with open(full, "r", encoding="utf-8", errors="replace") as f:
-                    for i, line in enumerate(f, 1):
-                        if pattern.search(line):
-                            results.append({"file": rel, "path": full.replace("\\", "/"), "line": i, "text": line.rstrip()[:200]})
-                            if len(results) >= 200:
-                                break
-            except Exception:
-                continue
-            if len(results) >= 200:
-                break
-        if len(results) >= 200:
-            break
-    return jsonify({"results": results, "count": len(results)})
+
+    if not stream:
+        results = []
+        for entry, matches in grep_stream(pattern, max_results=max_results, max_per_file=max_per_file):
+            results.extend({"file": entry["path"], "path": entry["full"], **m} for m in matches)
+        return jsonify({"results": results, "count": len(results)})
+
+    def generate():
+        count = 0
+        try:
+            for entry, matches in grep_stream(pattern, max_results=max_results, max_per_file=max_per_file):
+                count += len(matches)
+                yield f"data: {json.dumps({'type': 'file', 'file': entry['path'], 'path': entry['full'], 'matches': matches})}\n\n"
+            yield f"data: {json.dumps({'type': 'done', 'count': count, 'truncated': count >= max_results})}\n\n"
+        except Exception as e:
+            yield f"data: {json.dumps({'type': 'error', 'content': str(e)})}\n\n"
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 @app.route("/api/files/replace", methods=["POST"])
@@ -1089,14 +3647,7 @@ def replace_in_files():
     except re.error:
         return jsonify({"error": "Invalid regex"}), 400
     if not target_files:
-        skip_dirs = {".git", "node_modules", "__pycache__", "dist", "build"}
-        skip_ext = {".pyc", ".pyo", ".exe", ".dll", ".so", ".png", ".jpg", ".gif"}
-        target_files = []
-        for root, dirs, filenames in os.walk(WORKSPACE):
-            dirs[:] = [d for d in dirs if d not in skip_dirs and not d.startswith(".")]
-            for fn in filenames:
-                if os.path.splitext(fn)[1].lower() not in skip_ext:
-                    target_files.append(os.path.join(root, fn).replace("\\", "/"))
+        target_files = [f["full"] for f in scan_workspace(text_only=True)]
     replaced_count = 0
     files_changed = []
     for fpath in target_files:
@@ -1105,11 +3656,10 @@ def replace_in_files():
                 content = f.read()
             new_content, count = pattern.subn(replacement, content)
             if count > 0:
-                FILE_EDIT_HISTORY.append({"path": fpath, "old_content": content, "new_content": new_content, "tool": "replace", "timestamp": time.time()})
-                if len(FILE_EDIT_HISTORY) > MAX_UNDO_HISTORY:
-                    FILE_EDIT_HISTORY.pop(0)
+                record_edit(fpath, content, new_content, "replace")
                 with open(fpath, "w", encoding="utf-8") as f:
                     f.write(new_content)
+                invalidate_scan(fpath)
                 replaced_count += count
                 files_changed.append(fpath)
         except Exception:
@@ -1136,37 +3686,279 @@ SYMBOL_PATTERNS = {
               (r"^\s*(?:public\s+)?class\s+(\w+)", "class", 1)],
 }
 
+SYMBOL_REGEXES = {ext: [(re.compile(pat), kind, group) for pat, kind, group in pats] for ext, pats in SYMBOL_PATTERNS.items()}
+SYMBOL_EXT_ALIASES = {".tsx": ".js", ".jsx": ".js", ".mjs": ".js"}
+
+
+def _symbol_regexes(ext, fallback=True):
+    ext = SYMBOL_EXT_ALIASES.get(ext, ext)
+    if ext in SYMBOL_REGEXES:
+        return SYMBOL_REGEXES[ext]
+    return SYMBOL_REGEXES[".js"] if fallback else []
+
+
+def extract_symbols(lines, ext, fallback=True):
+    """Run SYMBOL_PATTERNS over lines, returning [{name, kind, line, indent}]."""
+    patterns = _symbol_regexes(ext, fallback)
+    symbols = []
+    seen = set()
+    for i, line in enumerate(lines, 1):
+        for pat, kind, group in patterns:
+            m = pat.match(line)
+            if m:
+                try:
+                    name = m.group(group)
+                except IndexError:
+                    continue
+                if (name, i) not in seen:
+                    seen.add((name, i))
+                    symbols.append({"name": name, "kind": kind, "line": i, "indent": len(line) - len(line.lstrip())})
+    return symbols
+
+
 @app.route("/api/files/symbols")
 def file_symbols():
     path = request.args.get("path", "")
     if not path:
         return jsonify({"symbols": []})
+    symbols = symbols_for_file(os.path.abspath(path))
+    if symbols is not None:
+        return jsonify({"symbols": symbols})
     try:
         with open(path, "r", encoding="utf-8", errors="replace") as f:
             lines = f.readlines()
     except Exception as e:
         return jsonify({"error": str(e)}), 400
-    ext = os.path.splitext(path)[1].lower()
-    patterns = SYMBOL_PATTERNS.get(ext, SYMBOL_PATTERNS.get(".js", []))
-    # Also try tsx/jsx as js
-    if ext in (".tsx", ".jsx", ".mjs"):
-        patterns = SYMBOL_PATTERNS.get(".js", [])
-    symbols = []
+    return jsonify({"symbols": extract_symbols(lines, os.path.splitext(path)[1].lower())})
+
+
+# ── Workspace Symbol Table ──────────────────────
+
+# One table per workspace. files: {rel: {mtime, size, symbols}}; by_name:
+# {lowercased name: [(rel, symbol)]}. names is the sorted key list of by_name
+# for prefix lookups, rebuilt lazily.
+SYMBOL_TABLES = {}  # {root: {root, files, by_name, names, ready, thread}}
+SYMBOL_LOCK = threading.Lock()
+SYMBOL_SEARCH_LIMIT = 50
+
+
+def _symbol_table(root):
+    """The symbol table for root, created empty on first use (caller holds SYMBOL_LOCK)."""
+    table = SYMBOL_TABLES.get(root)
+    if table is None:
+        table = SYMBOL_TABLES[root] = {"root": root, "files": {}, "by_name": {}, "names": None,
+                                       "ready": False, "thread": None}
+    return table
+
+
+def _symbol_add(table, rel, entry):
+    table["files"][rel] = entry
+    by_name = table["by_name"]
+    for sym in entry["symbols"]:
+        key = sym["name"].lower()
+        if key not in by_name:
+            by_name[key] = []
+            table["names"] = None
+        by_name[key].append((rel, sym))
+
+
+def _symbol_remove(table, rel):
+    entry = table["files"].pop(rel, None)
+    if not entry:
+        return
+    by_name = table["by_name"]
+    for sym in entry["symbols"]:
+        key = sym["name"].lower()
+        refs = [r for r in by_name.get(key, []) if r[0] != rel]
+        if refs:
+            by_name[key] = refs
+        else:
+            by_name.pop(key, None)
+            table["names"] = None
+
+
+def _parse_symbol_file(full, st):
+    try:
+        with open(full, "r", encoding="utf-8", errors="replace") as f:
+            symbols = extract_symbols(f, os.path.splitext(full)[1].lower(), fallback=False)
+    except OSError:
+        return None
+    return {"mtime": st.st_mtime, "size": st.st_size, "symbols": symbols}
+
+
+def _has_symbol_patterns(name):
+    ext = os.path.splitext(name)[1].lower()
+    return SYMBOL_EXT_ALIASES.get(ext, ext) in SYMBOL_REGEXES
+
+
+def update_symbols(root):
+    """Bring the symbol table for root up to date, re-parsing only new or changed files."""
+    with SYMBOL_LOCK:
+        table = _symbol_table(root)
     seen = set()
-    for i, line in enumerate(lines, 1):
-        for pat, kind, group in patterns:
-            m = re.match(pat, line)
-            if m:
-                try:
-                    name = m.group(group)
-                except IndexError:
+    for scanned in scan_workspace(root, text_only=True):
+        if not _has_symbol_patterns(scanned["name"]):
+            continue
+        rel = scanned["path"]
+        try:
+            st = os.stat(scanned["full"])
+        except OSError:
+            continue
+        seen.add(rel)
+        old = table["files"].get(rel)
+        if old and old["mtime"] == st.st_mtime and old["size"] == st.st_size:
+            continue
+        entry = _parse_symbol_file(scanned["full"], st)
+        with SYMBOL_LOCK:
+            if SYMBOL_TABLES.get(root) is not table:  # evicted mid-build
+                return
+            _symbol_remove(table, rel)
+            if entry is not None:
+                _symbol_add(table, rel, entry)
+    with SYMBOL_LOCK:
+        if SYMBOL_TABLES.get(root) is not table:
+            return
+        for rel in [r for r in table["files"] if r not in seen]:
+            _symbol_remove(table, rel)
+        table["ready"] = True
+
+
+def ensure_symbols(root=None):
+    """Start a background symbol table build for the workspace if one is not current; returns the table."""
+    root = root or current_workspace()
+    with SYMBOL_LOCK:
+        table = _symbol_table(root)
+        thread = table["thread"]
+        if table["ready"] or (thread and thread.is_alive()):
+            return table
+        thread = table["thread"] = threading.Thread(target=update_symbols, args=(root,), daemon=True,
+                                                    name="tetsuo-symbols")
+    thread.start()
+    ensure_watcher(root)
+    return table
+
+
+def refresh_symbol_entry(full):
+    """Re-parse one changed file in every symbol table that covers it (called by the file watcher)."""
+    if not _has_symbol_patterns(full):
+        return
+    with SYMBOL_LOCK:
+        tables = [(root, table) for root, table in SYMBOL_TABLES.items() if full.startswith(root + os.sep)]
+    if not tables:
+        return
+    # Parse outside the lock so symbol searches aren't stalled behind a big file
+    try:
+        entry = _parse_symbol_file(full, os.stat(full))
+    except OSError:
+        entry = None
+    with SYMBOL_LOCK:
+        for root, table in tables:
+            if SYMBOL_TABLES.get(root) is not table:  # evicted meanwhile
+                continue
+            rel = os.path.relpath(full, root).replace("\\", "/")
+            _symbol_remove(table, rel)
+            if entry is not None:
+                _symbol_add(table, rel, entry)
+
+
+def symbols_for_file(full):
+    """Symbols of a workspace file from the table, refreshing the entry if the file changed."""
+    root = current_workspace()
+    if not full.startswith(root + os.sep) or not _has_symbol_patterns(full):
+        return None
+    rel = os.path.relpath(full, root).replace("\\", "/")
+    try:
+        st = os.stat(full)
+    except OSError:
+        return None
+    with SYMBOL_LOCK:
+        # Created here if need be, so a file's symbols are cached before any workspace-wide build
+        table = _symbol_table(root)
+        entry = table["files"].get(rel)
+        if entry and entry["mtime"] == st.st_mtime and entry["size"] == st.st_size:
+            return entry["symbols"]
+    entry = _parse_symbol_file(full, st)
+    if entry is None:
+        return None
+    with SYMBOL_LOCK:
+        if SYMBOL_TABLES.get(root) is table:
+            _symbol_remove(table, rel)
+            _symbol_add(table, rel, entry)
+    return entry["symbols"]
+
+
+def _fuzzy_score(query, name):
+    """Subsequence match score (higher is better), or None if query is not a subsequence of name."""
+    pos, score, prev = 0, 0, -2
+    for ch in query:
+        idx = name.find(ch, pos)
+        if idx < 0:
+            return None
+        score += 3 if idx == prev + 1 else (2 if idx == 0 or not name[idx - 1].isalnum() else 0)
+        prev, pos = idx, idx + 1
+    return score - len(name) * 0.01
+
+
+def search_symbols(table, query, limit=SYMBOL_SEARCH_LIMIT, kind=None):
+    """Exact, then prefix, then fuzzy-subsequence matches over every symbol in table."""
+    q = query.lower()
+    with SYMBOL_LOCK:
+        by_name = table["by_name"]
+        if table["names"] is None:
+            table["names"] = sorted(by_name)
+        names = table["names"]
+        ranked = []
+        taken = set()
+        i = bisect.bisect_left(names, q)
+        while i < len(names) and names[i].startswith(q) and len(ranked) < limit * 4:
+            ranked.append((0 if names[i] == q else 1, len(names[i]), names[i]))
+            taken.add(names[i])
+            i += 1
+        if len(ranked) < limit:
+            fuzzy = []
+            for name in names:
+                if name in taken:
                     continue
-                indent = len(line) - len(line.lstrip())
-                key = f"{name}:{i}"
-                if key not in seen:
-                    seen.add(key)
-                    symbols.append({"name": name, "kind": kind, "line": i, "indent": indent})
-    return jsonify({"symbols": symbols})
+                score = _fuzzy_score(q, name)
+                if score is not None:
+                    fuzzy.append((-score, name))
+            ranked.extend((2, s, name) for s, name in heapq.nsmallest(limit, fuzzy))
+        ranked.sort()
+        results = []
+        for _, _, name in ranked:
+            for rel, sym in by_name.get(name, []):
+                if kind and sym["kind"] != kind:
+                    continue
+                results.append({**sym, "file": rel, "path": f"{table['root']}/{rel}".replace("\\", "/")})
+            if len(results) >= limit:
+                break
+        return results[:limit]
+
+
+@app.route("/api/symbols/search")
+def symbol_search():
+    query = request.args.get("q", "")
+    limit = min(int(request.args.get("limit", SYMBOL_SEARCH_LIMIT)), 500)
+    table = ensure_symbols()
+    results = search_symbols(table, query, limit, request.args.get("kind") or None) if query else []
+    return jsonify({"symbols": results, "ready": table["ready"], "files": len(table["files"])})
+
+
+@app.route("/api/symbols/definition")
+def symbol_definition():
+    name = request.args.get("name", "")
+    if not name:
+        return jsonify({"error": "name required"}), 400
+    table = ensure_symbols()
+    near = request.args.get("path", "").replace("\\", "/")
+    with SYMBOL_LOCK:
+        root = table["root"]
+        defs = [{**sym, "file": rel, "path": f"{root}/{rel}".replace("\\", "/")}
+                for rel, sym in table["by_name"].get(name.lower(), []) if sym["name"] == name]
+    # Prefer definitions in the requesting file, then in its directory
+    near_dir = os.path.dirname(near)
+    defs.sort(key=lambda d: (d["path"] != near, os.path.dirname(d["path"]) != near_dir, d["file"], d["line"]))
+    return jsonify({"definitions": defs, "ready": table["ready"]})
 
 
 # ── Rename Symbol ──────────────────────────────
@@ -1181,28 +3973,21 @@ def rename_symbol():
     pattern = re.compile(r'\b' + re.escape(old_name) + r'\b')
     replaced_count = 0
     files_changed = []
-    skip_dirs = {".git", "node_modules", "__pycache__", "dist", "build", ".venv", "venv"}
-    skip_ext = {".pyc", ".pyo", ".exe", ".dll", ".so", ".png", ".jpg", ".gif", ".ico"}
-    for root, dirs, filenames in os.walk(WORKSPACE):
-        dirs[:] = [d for d in dirs if d not in skip_dirs and not d.startswith(".")]
-        for fn in filenames:
-            if os.path.splitext(fn)[1].lower() in skip_ext:
-                continue
-            fpath = os.path.join(root, fn).replace("\\", "/")
-            try:
-                with open(fpath, "r", encoding="utf-8", errors="replace") as f:
-                    content = f.read()
-                new_content, count = pattern.subn(new_name, content)
-                if count > 0:
-                    FILE_EDIT_HISTORY.append({"path": fpath, "old_content": content, "new_content": new_content, "tool": "rename", "timestamp": time.time()})
-                    if len(FILE_EDIT_HISTORY) > MAX_UNDO_HISTORY:
-                        FILE_EDIT_HISTORY.pop(0)
-                    with open(fpath, "w", encoding="utf-8") as f:
-                        f.write(new_content)
-                    replaced_count += count
-                    files_changed.append({"path": fpath, "count": count})
-            except Exception:
-                continue
+    for entry in scan_workspace(text_only=True):
+        fpath = entry["full"]
+        try:
+            with open(fpath, "r", encoding="utf-8", errors="replace") as f:
+                content = f.read()
+            new_content, count = pattern.subn(new_name, content)
+            if count > 0:
+                record_edit(fpath, content, new_content, "rename")
+                with open(fpath, "w", encoding="utf-8") as f:
+                    f.write(new_content)
+                invalidate_scan(fpath)
+                replaced_count += count
+                files_changed.append({"path": fpath, "count": count})
+        except Exception:
+            continue
     return jsonify({"replaced": replaced_count, "files": len(files_changed), "changed": files_changed})
 
 
@@ -1217,14 +4002,15 @@ def file_summary():
         with open(path, "r", encoding="utf-8", errors="replace") as f:
             content = f.read()
         total_lines = content.count("\n") + 1
-        total_tokens = estimate_tokens(content)
+        family = token_family(request.args.get("provider"), request.args.get("model"))
         skeleton = _build_file_skeleton(path, content)
+        total_tokens, skeleton_tokens = count_tokens_batch([content, skeleton], family)
         return jsonify({
             "path": path,
             "total_lines": total_lines,
             "total_tokens": total_tokens,
             "skeleton": skeleton,
-            "skeleton_tokens": estimate_tokens(skeleton),
+            "skeleton_tokens": skeleton_tokens,
         })
     except Exception as e:
         return jsonify({"error": str(e)}), 400
@@ -1241,28 +4027,30 @@ def file_chunk():
     if not path:
         return jsonify({"error": "path required"}), 400
     try:
-        with open(path, "r", encoding="utf-8", errors="replace") as f:
-            lines = f.readlines()
+        total = len(line_index(path)[0])
         chunks = []
         if center_line > 0:
             start = max(0, center_line - ctx_lines - 1)
-            end = min(len(lines), center_line + ctx_lines)
-            chunks.append({"start": start + 1, "end": end, "text": "".join(lines[start:end])})
+            end = min(total, center_line + ctx_lines)
+            chunks.append({"start": start + 1, "end": end, "text": "".join(read_lines(path, start, end)[0])})
         if pattern:
             try:
                 pat = re.compile(pattern, re.IGNORECASE)
-                for i, line in enumerate(lines):
-                    if pat.search(line):
-                        s = max(0, i - 10)
-                        e = min(len(lines), i + 10)
-                        chunks.append({"start": s + 1, "end": e, "text": "".join(lines[s:e]), "match_line": i + 1})
-                        if len(chunks) >= 10:
-                            break
+                # Stream the scan; windows around matches are read back through the line index
+                with open(path, "r", encoding="utf-8", errors="replace") as f:
+                    for i, line in enumerate(f):
+                        if pat.search(line):
+                            s = max(0, i - 10)
+                            e = min(total, i + 10)
+                            chunks.append({"start": s + 1, "end": e, "text": "".join(read_lines(path, s, e)[0]),
+                                           "match_line": i + 1})
+                            if len(chunks) >= 10:
+                                break
             except re.error:
                 pass
         if not chunks and not center_line and not pattern:
-            chunks.append({"start": 1, "end": min(len(lines), ctx_lines), "text": "".join(lines[:ctx_lines])})
-        return jsonify({"path": path, "total_lines": len(lines), "chunks": chunks})
+            chunks.append({"start": 1, "end": min(total, ctx_lines), "text": "".join(read_lines(path, 0, ctx_lines)[0])})
+        return jsonify({"path": path, "total_lines": total, "chunks": chunks})
     except Exception as e:
         return jsonify({"error": str(e)}), 400
 
@@ -1272,8 +4060,9 @@ def file_chunk():
 @app.route("/api/files/tree")
 def workspace_tree():
     max_files = int(request.args.get("max", 200))
-    files = _get_workspace_tree(max_files)
-    return jsonify({"files": files, "workspace": WORKSPACE.replace("\\", "/")})
+    family = token_family(request.args.get("provider"), request.args.get("model"))
+    files = _get_workspace_tree(max_files, family)
+    return jsonify({"files": files, "workspace": current_workspace().replace("\\", "/")})
 
 
 # ── Context Budget Estimation ──────────────────────
@@ -1283,21 +4072,13 @@ def estimate_context():
     data = request.json
     msgs = data.get("messages", [])
     model = data.get("model", "grok-3")
-    limits = {
-        "grok-4-1-fast-reasoning": 131072, "grok-3-fast": 131072, "grok-3": 131072, "grok-3-mini": 131072,
-        "gpt-4o": 128000, "gpt-4o-mini": 128000, "o1": 200000, "o1-mini": 128000,
-        "claude-sonnet-4-5-20250929": 200000, "claude-haiku-4-5-20251001": 200000,
-    }
-    limit = limits.get(model, 131072)
-    total = 0
-    breakdown = []
-    for msg in msgs:
-        content = msg.get("content", "") or ""
-        tokens = estimate_tokens(content)
-        total += tokens
-        breakdown.append({"role": msg.get("role", ""), "tokens": tokens})
+    limit = context_limit(model)
+    family = token_family(data.get("provider"), model)
+    counts = count_tokens_batch([_message_text(msg) for msg in msgs], family)
+    breakdown = [{"role": msg.get("role", ""), "tokens": n + MESSAGE_OVERHEAD_TOKENS} for msg, n in zip(msgs, counts)]
+    total = sum(b["tokens"] for b in breakdown)
     return jsonify({
-        "total_tokens": total, "limit": limit,
+        "total_tokens": total, "limit": limit, "tokenizer": family,
         "usage_pct": round((total / limit) * 100, 1) if limit else 0,
         "remaining": limit - total, "breakdown": breakdown,
     })
@@ -1309,23 +4090,25 @@ def estimate_context():
 def list_pending():
     return jsonify({"pending": [
         {"id": k, "path": v["path"], "tool": v["tool"], "diff": v["diff"][:2000], "timestamp": v["timestamp"]}
-        for k, v in PENDING_EDITS.items()
+        for k, v in journal().pending_edits(current_session())
     ]})
 
 
 @app.route("/api/tools/approve", methods=["POST"])
 def approve_edit():
     edit_id = request.json.get("id", "")
-    edit = PENDING_EDITS.pop(edit_id, None)
+    j = journal()
+    edit = j.take_pending(edit_id, current_session())
     if not edit:
         return jsonify({"error": "Pending edit not found"}), 404
     try:
-        FILE_EDIT_HISTORY.append({"path": edit["path"], "old_content": edit["old_content"], "new_content": edit["new_content"], "tool": edit["tool"], "timestamp": time.time()})
-        if len(FILE_EDIT_HISTORY) > MAX_UNDO_HISTORY:
-            FILE_EDIT_HISTORY.pop(0)
+        content = j.get(edit["new"])
+        j.push_edit({"path": edit["path"], "tool": edit["tool"], "timestamp": time.time(),
+                     "old": edit["old"], "new": edit["new"]}, MAX_UNDO_HISTORY, current_session())
         os.makedirs(os.path.dirname(edit["path"]) or ".", exist_ok=True)
         with open(edit["path"], "w", encoding="utf-8") as f:
-            f.write(edit["new_content"])
+            f.write(content)
+        invalidate_scan(edit["path"])
         return jsonify({"success": True, "path": edit["path"]})
     except Exception as e:
         return jsonify({"error": str(e)}), 400
@@ -1334,7 +4117,7 @@ def approve_edit():
 @app.route("/api/tools/reject", methods=["POST"])
 def reject_edit():
     edit_id = request.json.get("id", "")
-    edit = PENDING_EDITS.pop(edit_id, None)
+    edit = journal().take_pending(edit_id, current_session())
     if not edit:
         return jsonify({"error": "Pending edit not found"}), 404
     return jsonify({"success": True, "rejected": edit["path"]})
@@ -1342,9 +4125,9 @@ def reject_edit():
 
 @app.route("/api/settings/approval", methods=["POST"])
 def set_approval():
-    global REQUIRE_APPROVAL
-    REQUIRE_APPROVAL = request.json.get("enabled", False)
-    return jsonify({"require_approval": REQUIRE_APPROVAL})
+    enabled = bool(request.json.get("enabled", False))
+    update_session(current_session(), require_approval=enabled)
+    return jsonify({"require_approval": enabled})
 
 
 # ── Streaming Terminal ──────────────────────────
@@ -1352,7 +4135,7 @@ def set_approval():
 @app.route("/api/terminal/stream", methods=["POST"])
 def terminal_stream():
     command = request.json.get("command", "")
-    cwd = request.json.get("cwd", WORKSPACE)
+    cwd = request.json.get("cwd", current_workspace())
 
     def generate():
         try:
@@ -1376,43 +4159,247 @@ def terminal_stream():
 
 # ── File Watcher ──────────────────────────────
 
-@app.route("/api/files/mtime", methods=["POST"])
-def file_mtime():
-    paths = request.json.get("paths", [])
-    changed = []
-    for p in paths:
+WATCH_POLL_INTERVAL = float(os.environ.get("TETSUO_WATCH_POLL", "2.0"))
+WATCH_DEBOUNCE = 0.2  # seconds to coalesce bursts of events for the same path
+WATCH_KEEPALIVE = 15
+
+IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE = 0x2, 0x4, 0x8
+IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x40, 0x80, 0x100, 0x200
+IN_DELETE_SELF, IN_IGNORED, IN_Q_OVERFLOW, IN_ISDIR = 0x400, 0x8000, 0x4000, 0x40000000
+IN_NONBLOCK, IN_CLOEXEC = 0o4000, 0o2000000
+INOTIFY_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+
+WATCHERS = {}  # {root: {root, backend, stop, thread}}
+WATCH_SUBSCRIBERS = []  # [{session, root, q}] one per /api/files/events stream
+WATCH_LOCK = threading.Lock()
+
+
+def _notify(root, event):
+    with WATCH_LOCK:
+        subscribers = [sub["q"] for sub in WATCH_SUBSCRIBERS if sub["root"] == root]
+    for q in subscribers:
+        q.put(event)
+
+
+def _publish_changes(root, changes):
+    """Fan out {full_path: kind} to the scanner, index and root's SSE subscribers."""
+    for full, kind in changes.items():
+        invalidate_scan(full)
+        refresh_index_entry(full)
+        refresh_symbol_entry(full)
+        event = {"type": kind, "path": full.replace("\\", "/")}
+        if kind == "change":
+            try:
+                event["mtime"] = os.path.getmtime(full)
+            except OSError:
+                event["type"] = "delete"
+        _notify(root, event)
+
+
+def _resync(root):
+    """Events for root were lost: revalidate the scan, index and symbols, and tell subscribers to reload."""
+    invalidate_scan(root=root)
+    with SYMBOL_LOCK:
+        table = SYMBOL_TABLES.get(root)
+        if table is not None:
+            table["ready"] = False
+    if table is not None:
+        ensure_symbols(root)
+    with INDEX_LOCK:
+        indexed = root in INDEXES
+    if indexed:
+        threading.Thread(target=update_index, args=(root,), daemon=True, name="tetsuo-index").start()
+    _notify(root, {"type": "resync"})
+
+
+def _inotify_loop(watcher):
+    """Watch every scanned directory with inotify. Returns False if inotify is unusable."""
+    root, stop = watcher["root"], watcher["stop"]
+    import ctypes
+    import select
+    import struct
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    except (OSError, AttributeError):
+        return False
+    if fd < 0:
+        return False
+    wds = {}  # wd -> absolute dir
+
+    def add_tree(top):
+        for dirpath, dirs, _ in os.walk(top):
+            dirs[:] = [d for d in dirs if d not in SCAN_SKIP_DIRS and not d.startswith(".")]
+            wd = libc.inotify_add_watch(fd, os.fsencode(dirpath), INOTIFY_MASK)
+            if wd < 0:
+                return False
+            wds[wd] = dirpath
+        return True
+
+    try:
+        if not add_tree(root):
+            return False
+        watcher["backend"] = "inotify"
+        pending = {}
+        deadline = None
+        while not stop.is_set():
+            timeout = max(0.0, deadline - time.monotonic()) if deadline else 1.0
+            ready, _, _ = select.select([fd], [], [], timeout)
+            if ready:
+                try:
+                    buf = os.read(fd, 65536)
+                except BlockingIOError:
+                    buf = b""
+                offset = 0
+                while offset + 16 <= len(buf):
+                    wd, mask, _, length = struct.unpack_from("iIII", buf, offset)
+                    name = buf[offset + 16:offset + 16 + length].split(b"\0", 1)[0]
+                    offset += 16 + length
+                    if mask & IN_Q_OVERFLOW:
+                        _resync(root)
+                        continue
+                    if mask & IN_IGNORED:
+                        wds.pop(wd, None)
+                        continue
+                    parent = wds.get(wd)
+                    if parent is None or not name:
+                        continue
+                    full = os.path.join(parent, os.fsdecode(name))
+                    if mask & IN_ISDIR:
+                        invalidate_scan(full)
+                        base = os.path.basename(full)
+                        if mask & (IN_CREATE | IN_MOVED_TO) and base not in SCAN_SKIP_DIRS and not base.startswith("."):
+                            add_tree(full)
+                        continue
+                    pending[full] = "delete" if mask & (IN_DELETE | IN_MOVED_FROM) else "change"
+                if pending and deadline is None:
+                    deadline = time.monotonic() + WATCH_DEBOUNCE
+            if deadline and time.monotonic() >= deadline:
+                changes, pending, deadline = pending, {}, None
+                _publish_changes(root, changes)
+        return True
+    finally:
+        os.close(fd)
+
+
+def _poll_loop(watcher):
+    """Fallback watcher: diff (mtime, size) of every scanned file each interval."""
+    root, stop = watcher["root"], watcher["stop"]
+    watcher["backend"] = "poll"
+    known = None
+    while not stop.is_set():
+        invalidate_scan(root=root)
+        current = {}
+        for entry in scan_workspace(root):
+            try:
+                st = os.stat(entry["full"])
+            except OSError:
+                continue
+            current[entry["full"]] = (st.st_mtime, st.st_size)
+        if known is not None:
+            changes = {p: "change" for p, sig in current.items() if known.get(p) != sig}
+            changes.update({p: "delete" for p in known if p not in current})
+            if changes:
+                _publish_changes(root, changes)
+        known = current
+        stop.wait(WATCH_POLL_INTERVAL)
+
+
+def _watch(watcher):
+    try:
+        if os.environ.get("TETSUO_WATCH_BACKEND", "") != "poll" and _inotify_loop(watcher):
+            return
+    except Exception:
+        pass
+    if not watcher["stop"].is_set():
+        _poll_loop(watcher)
+
+
+def ensure_watcher(root=None):
+    """Start the background watcher for the workspace unless one is running; returns it."""
+    root = root or current_workspace()
+    with WATCH_LOCK:
+        watcher = WATCHERS.get(root)
+        if watcher and watcher["thread"].is_alive():
+            return watcher
+        watcher = WATCHERS[root] = {"root": root, "backend": None, "stop": threading.Event(), "thread": None}
+        watcher["thread"] = threading.Thread(target=_watch, args=(watcher,), daemon=True, name="tetsuo-watcher")
+        watcher["thread"].start()
+        return watcher
+
+
+def watch_subscribe(session, root, q):
+    """Follow root's changes into q (anything with put()) until watch_unsubscribe; returns (watcher, sub)."""
+    watcher = ensure_watcher(root)
+    sub = {"session": session, "root": root, "q": q}
+    with WATCH_LOCK:
+        WATCH_SUBSCRIBERS.append(sub)
+    return watcher, sub
+
+
+def watch_unsubscribe(sub):
+    with WATCH_LOCK:
+        if sub in WATCH_SUBSCRIBERS:
+            WATCH_SUBSCRIBERS.remove(sub)
+
+
+def stop_watcher(root):
+    """Stop root's watcher unless an events stream is still following it; returns whether it stopped."""
+    with WATCH_LOCK:
+        if any(sub["root"] == root for sub in WATCH_SUBSCRIBERS):
+            return False
+        watcher = WATCHERS.pop(root, None)
+    if watcher:
+        watcher["stop"].set()
+    return True
+
+
+@app.route("/api/files/events")
+def file_events():
+    """SSE stream of workspace file changes: {type: change|delete, path, mtime}, or {type: resync}."""
+    q = queue.Queue()
+    watcher, sub = watch_subscribe(g.session, current_workspace(), q)
+
+    def generate():
         try:
-            mtime = os.path.getmtime(p)
-            if p in FILE_MTIMES and FILE_MTIMES[p] < mtime:
-                changed.append({"path": p, "mtime": mtime})
-            FILE_MTIMES[p] = mtime
-        except Exception:
-            pass
-    return jsonify({"changed": changed})
+            yield f"data: {json.dumps({'type': 'ready', 'backend': watcher['backend']})}\n\n"
+            while True:
+                try:
+                    event = q.get(timeout=WATCH_KEEPALIVE)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"data: {json.dumps(event)}\n\n"
+        finally:
+            watch_unsubscribe(sub)
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 # ── MCP Server Support ──────────────────────────
 
 @app.route("/api/mcp/servers", methods=["GET", "POST", "DELETE"])
 def mcp_servers():
-    global MCP_SERVERS
     if request.method == "POST":
         data = request.json
         server = {"name": data.get("name", ""), "url": data.get("url", ""), "tools": []}
         try:
-            r = requests.post(server["url"], json={"jsonrpc": "2.0", "id": 1, "method": "tools/list"}, timeout=10)
+            # Listing runs while the user waits on "add server", so it keeps its shorter timeout
+            r = http_post(server["url"], kind="mcp", json={"jsonrpc": "2.0", "id": 1, "method": "tools/list"},
+                          timeout=10)
             if r.ok:
                 tools = r.json().get("result", {}).get("tools", [])
                 server["tools"] = tools
         except Exception:
             pass
-        MCP_SERVERS.append(server)
+        STATE.update("mcp_servers", lambda servers: servers + [server], [])
         return jsonify({"success": True, "server": server})
     if request.method == "DELETE":
         name = request.args.get("name", "")
-        MCP_SERVERS = [s for s in MCP_SERVERS if s["name"] != name]
+        STATE.update("mcp_servers", lambda servers: [s for s in servers if s["name"] != name], [])
         return jsonify({"success": True})
-    return jsonify({"servers": MCP_SERVERS})
+    return jsonify({"servers": STATE.get("mcp_servers", [])})
 
 
 @app.route("/api/mcp/invoke", methods=["POST"])
@@ -1421,14 +4408,14 @@ def mcp_invoke():
     server_name = data.get("server", "")
     tool_name = data.get("tool", "")
     tool_args = data.get("args", {})
-    server = next((s for s in MCP_SERVERS if s["name"] == server_name), None)
+    server = next((s for s in STATE.get("mcp_servers", []) if s["name"] == server_name), None)
     if not server:
         return jsonify({"error": "MCP server not found"}), 404
     try:
-        r = requests.post(server["url"], json={
+        r = http_post(server["url"], kind="mcp", json={
             "jsonrpc": "2.0", "id": 1, "method": "tools/call",
             "params": {"name": tool_name, "arguments": tool_args}
-        }, timeout=30)
+        })
         return jsonify(r.json().get("result", {}))
     except Exception as e:
         return jsonify({"error": str(e)}), 400
@@ -1436,15 +4423,72 @@ def mcp_invoke():
 
 # ── Inline Completions (Ghost Text) ──────────────
 
+COMPLETION_CACHE_SIZE = 512
+COMPLETION_MAX_SESSIONS = 256
+COMPLETION_CACHE = collections.OrderedDict()  # {context hash: completion}, LRU order
+COMPLETION_INFLIGHT = {}  # {context hash: Future} for coalescing identical requests
+COMPLETION_SESSIONS = collections.OrderedDict()  # {session: {seq, prefix, completion}}
+COMPLETION_STATS = {"requests": 0, "hits": 0, "prefix_hits": 0, "coalesced": 0, "stale": 0,
+                    "latencies": collections.deque(maxlen=2000)}  # (ms, source)
+COMPLETION_LOCK = threading.Lock()
+
+
+def _credential_key(api_key):
+    return hashlib.sha256(api_key.encode()).hexdigest()[:16]
+
+
+def _completion_key(provider_id, model, ext, context, credential):
+    """Cache key for a completion; credential (see _credential_key) keeps one API key's results from another."""
+    normalized = "\n".join(line.rstrip() for line in context.split("\n")).strip("\n")
+    return hashlib.sha1(f"{provider_id}\0{model}\0{ext}\0{credential}\0{normalized}".encode()).hexdigest()
+
+
+def _request_completion(provider, api_key, model, prompt):
+    try:
+        if provider["format"] == "anthropic":
+            r = http_post(f"{provider['base_url']}/messages", kind="complete",
+                headers={"Content-Type": "application/json", "x-api-key": api_key, "anthropic-version": "2023-06-01"},
+                json={"model": model, "max_tokens": 150, "messages": [{"role": "user", "content": prompt}]})
+            if r.ok:
+                content = r.json().get("content", [{}])
+                return (content[0].get("text", "") if content else "").strip()
+        else:
+            r = http_post(f"{provider['base_url']}/chat/completions", kind="complete",
+                headers={"Content-Type": "application/json", "Authorization": f"Bearer {api_key}"},
+                json={"model": model, "messages": [{"role": "user", "content": prompt}], "max_tokens": 150, "temperature": 0.2})
+            if r.ok:
+                choices = r.json().get("choices", [{}])
+                return (choices[0].get("message", {}).get("content", "") if choices else "").strip()
+    except Exception:
+        pass
+    return ""
+
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))], 1)
+
+
+def _completion_done(t0, source, completion, **extra):
+    """Record latency for one answered request (caller holds COMPLETION_LOCK)."""
+    COMPLETION_STATS["latencies"].append(((time.monotonic() - t0) * 1000, source))
+    return jsonify({"completion": completion, "source": source, **extra})
+
+
 @app.route("/api/complete", methods=["POST"])
 def inline_complete():
     data = request.json
     code = data.get("code", "")
     cursor_line = data.get("line", 0)
+    cursor = data.get("cursor")
     path = data.get("path", "")
+    session_id = data.get("session", "")
     provider_id = data.get("provider", "xai")
     user_api_key = data.get("api_key", "")
     model = data.get("model", "grok-3-mini")
+    t0 = time.monotonic()
 
     provider = PROVIDERS.get(provider_id, PROVIDERS["xai"])
     api_key = user_api_key or os.environ.get(provider.get("env_key", ""), "") or API_KEY
@@ -1457,25 +4501,83 @@ def inline_complete():
     context = "\n".join(lines[start:end])
     ext = os.path.splitext(path)[1].lstrip(".")
     prompt = f"Complete the following {ext} code. Output ONLY the completion (1-3 lines), no explanation, no markdown, no backticks.\n\n{context}"
-
-    try:
-        if provider["format"] == "anthropic":
-            r = requests.post("https://api.anthropic.com/v1/messages",
-                headers={"Content-Type": "application/json", "x-api-key": api_key, "anthropic-version": "2023-06-01"},
-                json={"model": model, "max_tokens": 150, "messages": [{"role": "user", "content": prompt}]}, timeout=10)
-            if r.ok:
-                content = r.json().get("content", [{}])
-                return jsonify({"completion": (content[0].get("text", "") if content else "").strip()})
-        else:
-            r = requests.post(f"{provider['base_url']}/chat/completions",
-                headers={"Content-Type": "application/json", "Authorization": f"Bearer {api_key}"},
-                json={"model": model, "messages": [{"role": "user", "content": prompt}], "max_tokens": 150, "temperature": 0.2}, timeout=10)
-            if r.ok:
-                choices = r.json().get("choices", [{}])
-                return jsonify({"completion": (choices[0].get("message", {}).get("content", "") if choices else "").strip()})
-    except Exception:
-        pass
-    return jsonify({"completion": ""})
+    prefix = code[:cursor] if isinstance(cursor, int) else "\n".join(lines[:cursor_line])
+    credential = _credential_key(api_key)
+    key = _completion_key(provider_id, model, ext, context, credential)
+
+    with COMPLETION_LOCK:
+        COMPLETION_STATS["requests"] += 1
+        session = COMPLETION_SESSIONS.pop(session_id, None)
+        if session is None or session.get("credential") != credential:
+            session = {"seq": 0, "prefix": None, "completion": "", "credential": credential}
+        COMPLETION_SESSIONS[session_id] = session
+        while len(COMPLETION_SESSIONS) > COMPLETION_MAX_SESSIONS:
+            COMPLETION_SESSIONS.popitem(last=False)
+        session["seq"] += 1
+        seq = session["seq"]
+
+        # The user typed the start of the last suggestion: serve the rest of it
+        anchor, suggestion = session["prefix"], session["completion"]
+        if suggestion and anchor is not None and prefix.startswith(anchor):
+            typed = prefix[len(anchor):]
+            if typed and suggestion.startswith(typed) and len(typed) < len(suggestion):
+                COMPLETION_STATS["prefix_hits"] += 1
+                return _completion_done(t0, "prefix", suggestion[len(typed):])
+
+        if key in COMPLETION_CACHE:
+            COMPLETION_CACHE.move_to_end(key)
+            completion = COMPLETION_CACHE[key]
+            session.update(prefix=prefix, completion=completion)
+            COMPLETION_STATS["hits"] += 1
+            return _completion_done(t0, "cache", completion)
+
+        future = COMPLETION_INFLIGHT.get(key)
+        owner = future is None
+        if owner:
+            future = COMPLETION_INFLIGHT[key] = Future()
+
+    if owner:
+        completion = _request_completion(provider, api_key, model, prompt)
+        with COMPLETION_LOCK:
+            COMPLETION_INFLIGHT.pop(key, None)
+            if completion:
+                COMPLETION_CACHE[key] = completion
+                while len(COMPLETION_CACHE) > COMPLETION_CACHE_SIZE:
+                    COMPLETION_CACHE.popitem(last=False)
+        future.set_result(completion)
+    else:
+        try:
+            completion = future.result(timeout=HTTP_TIMEOUTS["complete"] + HTTP_CONNECT_TIMEOUT)
+        except FutureTimeout:
+            completion = ""
+
+    with COMPLETION_LOCK:
+        if not owner:
+            COMPLETION_STATS["coalesced"] += 1
+        if session["seq"] != seq:
+            # A newer request from this editor session superseded this one
+            COMPLETION_STATS["stale"] += 1
+            return _completion_done(t0, "stale", "", stale=True)
+        session.update(prefix=prefix, completion=completion)
+        return _completion_done(t0, "provider" if owner else "coalesced", completion)
+
+
+@app.route("/api/complete/stats")
+def completion_stats():
+    with COMPLETION_LOCK:
+        stats = {k: v for k, v in COMPLETION_STATS.items() if k != "latencies"}
+        latencies = list(COMPLETION_STATS["latencies"])
+        cached = len(COMPLETION_CACHE)
+    served = stats["hits"] + stats["prefix_hits"] + stats["coalesced"]
+    all_ms = [ms for ms, _ in latencies]
+    provider_ms = [ms for ms, source in latencies if source == "provider"]
+    stats.update({
+        "cache_entries": cached,
+        "hit_rate": round(served / stats["requests"], 3) if stats["requests"] else 0.0,
+        "p50_ms": _percentile(all_ms, 50), "p95_ms": _percentile(all_ms, 95),
+        "provider_p50_ms": _percentile(provider_ms, 50), "provider_p95_ms": _percentile(provider_ms, 95),
+    })
+    return jsonify(stats)
 
 
 # ── Test Runner ──────────────────────────
@@ -1484,26 +4586,22 @@ def inline_complete():
 def detect_tests():
     test_patterns = [r"test_.*\.py$", r".*_test\.py$", r".*\.test\.[jt]sx?$", r".*\.spec\.[jt]sx?$", r".*_test\.go$"]
     test_files = []
-    skip_dirs = {".git", "node_modules", "__pycache__", "dist", "build", ".venv", "venv"}
-    for root, dirs, filenames in os.walk(WORKSPACE):
-        dirs[:] = [d for d in dirs if d not in skip_dirs]
-        for fn in filenames:
-            for pat in test_patterns:
-                if re.match(pat, fn, re.IGNORECASE):
-                    full = os.path.join(root, fn)
-                    rel = os.path.relpath(full, WORKSPACE).replace("\\", "/")
-                    test_files.append({"name": fn, "path": full.replace("\\", "/"), "rel": rel})
-                    break
-            if len(test_files) >= 100:
+    for entry in scan_workspace():
+        for pat in test_patterns:
+            if re.match(pat, entry["name"], re.IGNORECASE):
+                test_files.append({"name": entry["name"], "path": entry["full"], "rel": entry["path"]})
                 break
+        if len(test_files) >= 100:
+            break
     runner = None
-    if os.path.exists(os.path.join(WORKSPACE, "pytest.ini")) or os.path.exists(os.path.join(WORKSPACE, "setup.py")) or os.path.exists(os.path.join(WORKSPACE, "pyproject.toml")):
+    root = current_workspace()
+    if os.path.exists(os.path.join(root, "pytest.ini")) or os.path.exists(os.path.join(root, "setup.py")) or os.path.exists(os.path.join(root, "pyproject.toml")):
         runner = "python -m pytest -v"
-    elif os.path.exists(os.path.join(WORKSPACE, "package.json")):
+    elif os.path.exists(os.path.join(root, "package.json")):
         runner = "npm test"
-    elif os.path.exists(os.path.join(WORKSPACE, "go.mod")):
+    elif os.path.exists(os.path.join(root, "go.mod")):
         runner = "go test ./..."
-    elif os.path.exists(os.path.join(WORKSPACE, "Cargo.toml")):
+    elif os.path.exists(os.path.join(root, "Cargo.toml")):
         runner = "cargo test"
     return jsonify({"files": test_files, "runner": runner})
 
@@ -1512,10 +4610,11 @@ def detect_tests():
 def run_tests():
     data = request.json
     command = data.get("command", "python -m pytest -v")
+    root = current_workspace()
     def generate():
         try:
             proc = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                                    text=True, cwd=WORKSPACE, bufsize=1)
+                                    text=True, cwd=root, bufsize=1)
             for line in iter(proc.stdout.readline, ""):
                 yield f"data: {json.dumps({'type': 'output', 'text': line})}\n\n"
             proc.wait(timeout=120)
@@ -1528,36 +4627,137 @@ def run_tests():
 
 # ── Git Blame & File History ──────────────────────
 
+# Blame is cached per workspace by (path, HEAD commit, content hash) as one
+# row per line, filled in window by window: a request for lines the cache
+# lacks runs `git blame -L` over just the missing span. Commit metadata lives
+# once per commit in the workspace's git cache, not on every row.
+BLAME_MAX_LINES = 5000
+BLAME_CACHE_FILES = 32
+
+
+def git_head_commit(repo):
+    """The commit HEAD resolves to, read from the git dir (None on an unborn branch)."""
+    _, common, _ = repo
+    _, head = git_head(repo)
+    if not head.startswith("ref: "):
+        return head or None
+    ref = head[5:]
+    try:
+        with open(os.path.join(common, ref), encoding="utf-8") as f:
+            return f.read().strip()
+    except OSError:
+        pass
+    with contextlib.suppress(OSError), open(os.path.join(common, "packed-refs"), encoding="utf-8") as f:
+        for line in f:
+            sha, _, name = line.strip().partition(" ")
+            if name == ref:
+                return sha
+    return None
+
+
+def _file_digest(path):
+    """(sha1, line count) of path, from a single read so the two always describe the same content."""
+    h = hashlib.sha1()
+    lines, last = 0, b"\n"
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+            lines += block.count(b"\n")
+            last = block[-1:]
+    return h.hexdigest(), lines + (last != b"\n")
+
+
+def _parse_blame(lines, rows, commits):
+    """Fill rows[final_line - 1] = (sha, text) from `git blame --porcelain` output, metadata into commits."""
+    header = True
+    sha = final = None
+    for line in lines:
+        if header:
+            parts = line.split()
+            sha, final = parts[0], int(parts[2])
+            meta = None if sha in commits else commits.setdefault(sha, {"hash": sha[:8]})
+            header = False
+        elif line.startswith("\t"):
+            if final <= len(rows):  # the file grew after it was hashed
+                rows[final - 1] = (sha, line[1:].rstrip("\n"))
+            header = True
+        elif meta is not None:
+            key, _, value = line.rstrip("\n").partition(" ")
+            if key == "author":
+                meta["author"] = value
+            elif key == "author-time":
+                meta["time"] = int(value)
+            elif key == "summary":
+                meta["summary"] = value
+
+
+def _run_blame(root, rel, start, end, rows, commits):
+    started = time.perf_counter()
+    proc = subprocess.Popen(["git", "blame", "--porcelain", "-L", f"{start},{end}", "--", rel],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding="utf-8",
+                            errors="replace", cwd=root)
+    try:
+        _parse_blame(proc.stdout, rows, commits)
+        err = proc.stderr.read()
+        proc.wait(timeout=GIT_TIMEOUT)
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        record_git_call("blame", started)
+    if proc.returncode != 0:
+        raise RuntimeError(err.strip() or "git blame failed")
+
+
+def git_blame_lines(root, path, start=1, end=None):
+    """Blame rows [{hash, line, text, author, time, summary}] for lines start..end (1-based) of path.
+
+    Returns (rows, total_lines, cached) where cached says no git process was needed.
+    """
+    repo = git_repo(root)
+    if repo is None:
+        raise RuntimeError("not a git repository")
+    digest, total = _file_digest(path)
+    end = min(end or total, total, start + BLAME_MAX_LINES - 1)
+    key = (path, git_head_commit(repo), digest)
+    cache = _git_cache(root)
+    with GIT_LOCK:
+        # Commit metadata is kept per file so it is evicted with the file's rows
+        files = cache.setdefault("blame", collections.OrderedDict())
+        entry = files.get(key)
+        if entry is None:
+            entry = files[key] = {"rows": [None] * total, "commits": {}}
+            while len(files) > BLAME_CACHE_FILES:
+                files.popitem(last=False)
+        files.move_to_end(key)
+        rows, commits = entry["rows"], entry["commits"]
+        missing = [i for i in range(start - 1, end) if rows[i] is None]
+    if missing:
+        rel = os.path.relpath(path, root).replace("\\", "/")
+        _run_blame(root, rel, missing[0] + 1, missing[-1] + 1, rows, commits)
+    result = []
+    for n in range(start, end + 1):
+        row = rows[n - 1]
+        if row is not None:
+            sha, text = row
+            result.append({**commits.get(sha, {"hash": sha[:8]}), "line": n, "text": text})
+    return result, total, not missing
+
+
 @app.route("/api/git/blame")
 def git_blame():
+    """Blame for ?path=, optionally just ?start=&end= (1-based, inclusive) such as the visible window."""
     path = request.args.get("path", "")
     if not path:
         return jsonify({"error": "path required"}), 400
     try:
-        rel = os.path.relpath(path, WORKSPACE).replace("\\", "/")
-        result = subprocess.run(["git", "blame", "--porcelain", rel],
-            capture_output=True, text=True, timeout=15, cwd=WORKSPACE)
-        if result.returncode != 0:
-            return jsonify({"error": result.stderr.strip() or "git blame failed"}), 400
-        lines = result.stdout.splitlines()
-        blame = []
-        current = {}
-        for line in lines:
-            if line.startswith("\t"):
-                current["text"] = line[1:]
-                blame.append(current)
-                current = {}
-            elif not current:
-                parts = line.split()
-                if len(parts) >= 3:
-                    current = {"hash": parts[0][:8], "line": int(parts[2])}
-            elif line.startswith("author "):
-                current["author"] = line[7:]
-            elif line.startswith("author-time "):
-                current["time"] = int(line[12:])
-            elif line.startswith("summary "):
-                current["summary"] = line[8:]
-        return jsonify({"blame": blame[:5000]})
+        root = current_workspace()
+        full = _resolve_path(path)
+        if full is None:
+            return jsonify({"error": "Access denied: path outside workspace"}), 400
+        start = max(1, _int_arg("start") or 1)
+        rows, total, cached = git_blame_lines(root, full, start, _int_arg("end"))
+        return jsonify({"blame": rows, "total": total, "start": start, "cached": cached})
     except Exception as e:
         return jsonify({"error": str(e)}), 400
 
@@ -1568,9 +4768,11 @@ def git_file_log():
     if not path:
         return jsonify({"error": "path required"}), 400
     try:
-        rel = os.path.relpath(path, WORKSPACE).replace("\\", "/")
+        rel = os.path.relpath(path, current_workspace()).replace("\\", "/")
+        started = time.perf_counter()
         result = subprocess.run(["git", "log", "--oneline", "-20", "--", rel],
-            capture_output=True, text=True, timeout=10, cwd=WORKSPACE)
+            capture_output=True, text=True, timeout=10, cwd=current_workspace())
+        record_git_call("log", started)
         commits = []
         for line in result.stdout.splitlines():
             parts = line.split(" ", 1)
@@ -1662,17 +4864,12 @@ def suggest_prompts():
 @app.route("/api/review/changes")
 def review_changes():
     try:
-        status = subprocess.run(["git", "status", "--porcelain"], capture_output=True, text=True, timeout=5, cwd=WORKSPACE).stdout
-        changes = []
-        for line in status.splitlines():
-            if len(line) < 4:
-                continue
-            xy = line[:2]
-            path = line[3:]
-            diff_r = subprocess.run(["git", "diff", "--", path], capture_output=True, text=True, timeout=10, cwd=WORKSPACE)
-            staged_r = subprocess.run(["git", "diff", "--cached", "--", path], capture_output=True, text=True, timeout=10, cwd=WORKSPACE)
-            changes.append({"path": path, "status": xy.strip(), "staged": xy[0] not in (" ", "?"), "diff": (diff_r.stdout + staged_r.stdout)[:5000]})
-        pending = [{"id": k, "path": os.path.basename(v["path"]), "diff": v["diff"][:3000], "type": "ai_edit"} for k, v in PENDING_EDITS.items()]
+        root = current_workspace()
+        entries = git_status_entries(root)
+        unstaged, staged = cached_diffs(root, entries)
+        changes = [{"path": e["path"], "status": e["status"], "staged": e["staged"],
+                    "diff": (unstaged.get(e["path"], "") + staged.get(e["path"], ""))[:5000]} for e in entries]
+        pending = [{"id": k, "path": os.path.basename(v["path"]), "diff": v["diff"][:3000], "type": "ai_edit"} for k, v in journal().pending_edits(current_session())]
         return jsonify({"changes": changes, "pending": pending})
     except Exception as e:
         return jsonify({"error": str(e)}), 400
@@ -1680,53 +4877,244 @@ def review_changes():
 
 # ── Workspace Indexing ──────────────────────
 
-WORKSPACE_INDEX = {}
+INDEX_DIR = ".tetsuo"
+INDEX_FILE = "index.json"
+INDEX_VERSION = 1
+INDEX_MAX_FILE_BYTES = 200000
+INDEX_APPLY_BATCH = 256  # files applied per INDEX_LOCK acquisition while updating
+BM25_K1 = 1.2
+BM25_B = 0.75
+INDEX_TOKEN_RE = re.compile(r'\b\w{3,}\b')
 
-@app.route("/api/index/build", methods=["POST"])
-def build_index():
-    global WORKSPACE_INDEX
-    WORKSPACE_INDEX = {}
-    count = 0
-    skip_dirs = {".git", "node_modules", "__pycache__", "dist", "build", ".venv", "venv"}
-    skip_ext = {".pyc", ".pyo", ".exe", ".dll", ".so", ".o", ".class", ".png", ".jpg", ".gif", ".ico", ".woff", ".woff2"}
-    for root, dirs, filenames in os.walk(WORKSPACE):
-        dirs[:] = [d for d in dirs if d not in skip_dirs and not d.startswith(".")]
-        for fn in filenames:
-            ext = os.path.splitext(fn)[1].lower()
-            if ext in skip_ext:
-                continue
-            full = os.path.join(root, fn)
-            rel = os.path.relpath(full, WORKSPACE).replace("\\", "/")
+# Inverted index per workspace: files holds per-file term frequencies (the
+# persisted part), postings maps term -> {rel: tf} and is rebuilt from files
+# on load.
+INDEXES = {}  # {root: {root, files, postings, total_length, dirty}}
+INDEX_LOCK = threading.Lock()
+
+
+def tetsuo_dir(root):
+    """root/.tetsuo, created on first use with a .gitignore so its contents are never committed."""
+    path = os.path.join(root, INDEX_DIR)
+    ignore = os.path.join(path, ".gitignore")
+    if not os.path.exists(ignore):
+        os.makedirs(path, exist_ok=True)
+        with open(ignore, "w", encoding="utf-8") as f:
+            f.write("*\n")
+    return path
+
+
+def _index_path(root):
+    return os.path.join(root, INDEX_DIR, INDEX_FILE)
+
+
+def _index_add(idx, rel, entry):
+    idx["files"][rel] = entry
+    idx["total_length"] += entry["length"]
+    postings = idx["postings"]
+    for term, tf in entry["terms"].items():
+        postings.setdefault(term, {})[rel] = tf
+
+
+def _index_remove(idx, rel):
+    entry = idx["files"].pop(rel, None)
+    if not entry:
+        return
+    idx["total_length"] -= entry["length"]
+    postings = idx["postings"]
+    for term in entry["terms"]:
+        plist = postings.get(term)
+        if plist is not None:
+            plist.pop(rel, None)
+            if not plist:
+                del postings[term]
+
+
+def _load_index(root):
+    """The index for root, loaded from disk on first use (caller holds INDEX_LOCK)."""
+    idx = INDEXES.get(root)
+    if idx is not None:
+        return idx
+    idx = INDEXES[root] = {"root": root, "files": {}, "postings": {}, "total_length": 0, "dirty": False}
+    try:
+        with open(_index_path(root), "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return idx
+    if data.get("version") != INDEX_VERSION:
+        return idx
+    for rel, entry in data.get("files", {}).items():
+        _index_add(idx, rel, entry)
+    return idx
+
+
+def _save_index(idx):
+    tetsuo_dir(idx["root"])
+    path = _index_path(idx["root"])
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"version": INDEX_VERSION, "files": idx["files"]}, f, separators=(",", ":"))
+    os.replace(tmp, path)
+    idx["dirty"] = False
+
+
+def _flush_index(idx=None):
+    """Persist in-memory changes made by the file watcher, if any."""
+    for idx in [idx] if idx else list(INDEXES.values()):
+        if idx["dirty"]:
+            try:
+                _save_index(idx)
+            except OSError:
+                pass
+
+
+atexit.register(_flush_index)
+
+
+def _index_file(full, st):
+    """Tokenize one file into an index entry, or None if unreadable.
+
+    Only the first INDEX_MAX_FILE_BYTES are tokenized, but the hash covers
+    the whole file so an edit past that point still registers as a change.
+    """
+    try:
+        with open(full, "rb") as f:
+            raw = f.read(INDEX_MAX_FILE_BYTES)
+            if b"\0" in raw[:8000]:
+                return None
+            digest = hashlib.sha1(raw)
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+    except OSError:
+        return None
+    terms = {}
+    for word in INDEX_TOKEN_RE.findall(raw.decode("utf-8", errors="replace").lower()):
+        terms[word] = terms.get(word, 0) + 1
+    return {"mtime": st.st_mtime, "size": st.st_size, "hash": digest.hexdigest(),
+            "length": sum(terms.values()), "terms": terms}
+
+
+def update_index(root):
+    """Bring the index for root up to date, re-reading only new or changed files.
+
+    Files are read and tokenized outside INDEX_LOCK and applied in batches, so
+    searches and the file watcher aren't stalled behind a large build.
+    """
+    stats = {"updated": 0, "removed": 0, "unchanged": 0}
+    with INDEX_LOCK:
+        idx = _load_index(root)
+        known = dict(idx["files"])  # rel -> entry as of now; the watcher may replace entries meanwhile
+    files = idx["files"]
+    seen = set()
+    batch = []
+
+    def apply():
+        with INDEX_LOCK:
+            for rel, old, st, entry in batch:
+                if files.get(rel) is not old:  # refreshed by the watcher since we read it
+                    continue
+                if old and old["hash"] == entry["hash"]:
+                    old["mtime"], old["size"] = st.st_mtime, st.st_size
+                    idx["dirty"] = True
+                    stats["unchanged"] += 1
+                    continue
+                _index_remove(idx, rel)
+                _index_add(idx, rel, entry)
+                stats["updated"] += 1
+        batch.clear()
+
+    for scanned in scan_workspace(root, text_only=True):
+        rel = scanned["path"]
+        try:
+            st = os.stat(scanned["full"])
+        except OSError:
+            continue
+        old = known.get(rel)
+        if old and old["mtime"] == st.st_mtime and old["size"] == st.st_size:
+            seen.add(rel)
+            stats["unchanged"] += 1
+            continue
+        entry = _index_file(scanned["full"], st)
+        if entry is None:
+            continue
+        seen.add(rel)
+        batch.append((rel, old, st, entry))
+        if len(batch) >= INDEX_APPLY_BATCH:
+            apply()
+    apply()
+    with INDEX_LOCK:
+        for rel in [r for r, entry in known.items() if r not in seen and files.get(r) is entry]:
+            _index_remove(idx, rel)
+            stats["removed"] += 1
+        if stats["updated"] or stats["removed"] or idx["dirty"] or not os.path.exists(_index_path(root)):
             try:
-                with open(full, "r", encoding="utf-8", errors="replace") as f:
-                    content = f.read(50000)
-                words = set(re.findall(r'\b\w{3,}\b', content.lower()))
-                WORKSPACE_INDEX[rel] = {"tokens": words, "size": len(content)}
-                count += 1
-            except Exception:
+                _save_index(idx)
+            except OSError:
+                pass
+        stats["indexed"] = len(files)
+    return stats
+
+
+def refresh_index_entry(full):
+    """Re-tokenize one changed file in every loaded index that covers it (called by the file watcher)."""
+    if os.path.splitext(full)[1].lower() in SCAN_SKIP_EXT:
+        return
+    with INDEX_LOCK:
+        indexes = [(root, idx) for root, idx in INDEXES.items() if full.startswith(root + os.sep)]
+    if not indexes:
+        return
+    # Read outside the lock so searches aren't stalled behind a big file
+    try:
+        entry = _index_file(full, os.stat(full))
+    except OSError:
+        entry = None
+    with INDEX_LOCK:
+        for root, idx in indexes:
+            if INDEXES.get(root) is not idx:  # evicted meanwhile
                 continue
-            if count >= 500:
-                break
-        if count >= 500:
-            break
-    return jsonify({"indexed": count})
+            rel = os.path.relpath(full, root).replace("\\", "/")
+            _index_remove(idx, rel)
+            if entry is not None:
+                _index_add(idx, rel, entry)
+            idx["dirty"] = True
+
+
+def search_index(query, limit=20, root=None):
+    """Rank indexed files against query with BM25."""
+    qtokens = set(INDEX_TOKEN_RE.findall(query.lower()))
+    if not qtokens:
+        return []
+    with INDEX_LOCK:
+        idx = _load_index(root or current_workspace())
+        files = idx["files"]
+        n = len(files)
+        if not n:
+            return []
+        avgdl = (idx["total_length"] / n) or 1
+        scores = {}
+        for term in qtokens:
+            plist = idx["postings"].get(term)
+            if not plist:
+                continue
+            idf = math.log(1 + (n - len(plist) + 0.5) / (len(plist) + 0.5))
+            for rel, tf in plist.items():
+                norm = tf + BM25_K1 * (1 - BM25_B + BM25_B * files[rel]["length"] / avgdl)
+                scores[rel] = scores.get(rel, 0.0) + idf * tf * (BM25_K1 + 1) / norm
+        top = heapq.nlargest(limit, scores.items(), key=lambda kv: kv[1])
+        return [{"path": rel, "score": round(score, 3), "size": files[rel]["size"]} for rel, score in top]
+
+
+@app.route("/api/index/build", methods=["POST"])
+def build_index():
+    return jsonify(update_index(current_workspace()))
 
 
 @app.route("/api/index/search", methods=["POST"])
 def index_search():
-    query = request.json.get("query", "").lower()
+    query = request.json.get("query", "")
     if not query:
         return jsonify({"results": []})
-    qtokens = set(re.findall(r'\b\w{3,}\b', query))
-    if not qtokens:
-        return jsonify({"results": []})
-    results = []
-    for path, info in WORKSPACE_INDEX.items():
-        overlap = qtokens & info["tokens"]
-        if overlap:
-            results.append({"path": path, "score": round(len(overlap) / len(qtokens), 2), "size": info["size"]})
-    results.sort(key=lambda x: x["score"], reverse=True)
-    return jsonify({"results": results[:20]})
+    return jsonify({"results": search_index(query)})
 
 
 if __name__ == "__main__":
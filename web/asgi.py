@@ -0,0 +1,419 @@
+"""ASGI entry point for tetsuocode Web: async chat streaming on one event loop.
+
+/api/chat runs natively on the event loop. Provider responses stream
+through a shared httpx.AsyncClient and tools run on app.TOOL_EXECUTOR, so
+an idle conversation costs a coroutine rather than a thread. The
+/api/files/events stream, which every open tab holds, is served on the
+loop too. Every other route is the Flask app, bridged onto a thread pool.
+
+    pip install 'tetsuocode[async]'
+    tetsuocode --asgi                   # or: uvicorn web.asgi:app
+"""
+import asyncio
+import contextlib
+import functools
+import hashlib
+import io
+import json
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+from web import app as web
+
+WSGI_THREADS = int(os.environ.get("TETSUO_WSGI_THREADS", "32"))
+WSGI_EXECUTOR = ThreadPoolExecutor(max_workers=WSGI_THREADS, thread_name_prefix="tetsuo-wsgi")
+SSE_HEADERS = [(b"content-type", b"text/event-stream"), (b"cache-control", b"no-cache"),
+               (b"x-accel-buffering", b"no")]
+
+_clients = {}  # {event loop: httpx.AsyncClient}
+
+
+def _client():
+    """The AsyncClient for the running loop, created on first use."""
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        timeout = httpx.Timeout(web.HTTP_TIMEOUTS["chat"], connect=web.HTTP_CONNECT_TIMEOUT)
+        limits = httpx.Limits(max_connections=None, max_keepalive_connections=web.HTTP_POOL_SIZE)
+        client = _clients[loop] = httpx.AsyncClient(timeout=timeout, limits=limits)
+    return client
+
+
+async def run_tool_calls(calls, root, session):
+    """Async twin of app.run_tool_calls: yields (index, result) as tools finish."""
+    loop = asyncio.get_running_loop()
+    for i, j in web.tool_batches(calls):
+        pending = {loop.run_in_executor(web.TOOL_EXECUTOR, functools.partial(
+                       web.in_workspace, root, web._execute_tool_safe, *calls[k], session=session)): k
+                   for k in range(i, j)}
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for fut in done:
+                yield pending.pop(fut), fut.result()
+
+
+_EOF = object()
+
+
+async def _lines(resp, out):
+    """Provider lines, with None whenever content held in out comes due first.
+
+    A reader task feeds each network chunk's lines into a queue, and a timer
+    armed once per held window drops a None in to wake the consumer, so a
+    quiet provider never strands buffered text and a fast one costs no extra
+    task per line.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+
+    async def read():
+        buffer = ""
+        try:
+            async for chunk in resp.aiter_text():
+                buffer += chunk
+                if "\n" in buffer:
+                    *lines, buffer = buffer.split("\n")
+                    queue.put_nowait(lines)
+            if buffer:
+                queue.put_nowait([buffer])
+        except Exception as e:
+            queue.put_nowait(e)
+        finally:
+            queue.put_nowait(_EOF)
+
+    reader = asyncio.ensure_future(read())
+    timer = None
+    try:
+        while True:
+            due = out.remaining()
+            if due is None and timer is not None:
+                timer.cancel()
+                timer = None
+            elif due is not None and timer is None:
+                timer = loop.call_later(due, queue.put_nowait, None)
+            item = await queue.get()
+            if item is None:
+                timer = None
+                yield None
+            elif item is _EOF:
+                return
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                for line in item:
+                    yield line.rstrip("\r")
+    finally:
+        reader.cancel()
+        if timer is not None:
+            timer.cancel()
+
+
+async def stream_chat(conv):
+    """Async twin of app.stream_chat, yielding SSE frames."""
+    out = web.SSEWriter()
+    try:
+        for _ in range(web.MAX_TOOL_ITERATIONS):
+            url, headers, body = web.provider_request(conv)
+            turn = web.new_turn()
+            async with _client().stream("POST", url, headers=headers, json=body) as resp:
+                if resp.status_code != 200:
+                    text = (await resp.aread()).decode("utf-8", errors="replace")
+                    yield out.push({"type": "error", "content": web.provider_error(conv, resp.status_code, text)})
+                    return
+                lines = _lines(resp, out)
+                try:
+                    async for line in lines:
+                        if line is None:
+                            frame = out.flush()
+                            if frame:
+                                yield frame
+                            continue
+                        for event in web.parse_stream_line(conv, line, turn):
+                            frame = out.push(event)
+                            if frame:
+                                yield frame
+                        if turn["done"]:
+                            break
+                finally:
+                    await lines.aclose()
+            if turn["error"]:
+                return
+
+            tool_round = web.begin_tool_round(conv, turn)
+            if tool_round is None:
+                yield out.push({"type": "done"})
+                return
+            frame = out.flush()
+            if frame:
+                yield frame
+            tool_calls, calls, events = tool_round
+            for event in events:
+                yield out.push(event)
+            results = [None] * len(calls)
+            async for i, result in run_tool_calls(calls, conv["workspace"], conv["session"]):
+                results[i] = result
+                yield out.push(web.tool_result_event(tool_calls[i], result))
+            web.end_tool_round(conv, tool_calls, results)
+
+        yield out.push({"type": "error", "content": "Max tool iterations reached"})
+
+    except httpx.ConnectError:
+        yield out.push({"type": "error", "content": "Connection failed - check your network"})
+    except httpx.TimeoutException:
+        yield out.push({"type": "error", "content": "Request timed out"})
+    except Exception as e:
+        yield out.push({"type": "error", "content": f"Unexpected error: {web._redact(str(e), conv['api_key'])}"})
+
+
+async def _read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+def _cookies(scope):
+    for name, value in scope["headers"]:
+        if name == b"cookie":
+            for part in value.decode("latin-1").split(";"):
+                key, _, val = part.strip().partition("=")
+                yield key, val
+
+
+def _authorized(scope):
+    """Mirror of app.check_auth for routes served outside Flask."""
+    if not web.AUTH_PASSWORD:
+        return True
+    expected = hashlib.sha256(web.AUTH_PASSWORD.encode()).hexdigest()
+    return any(key == "tetsuo_auth" and val == expected for key, val in _cookies(scope))
+
+
+def _session(scope):
+    """Mirror of app.bind_session: the request's session id, or None."""
+    header = web.SESSION_HEADER.lower().encode("latin-1")
+    sid = next((v.decode("latin-1") for k, v in scope["headers"] if k == header), None)
+    sid = sid or next((val for key, val in _cookies(scope) if key == web.SESSION_COOKIE), None)
+    return sid if sid and web.SESSION_ID_RE.match(sid) else None
+
+
+async def _watch_disconnect(receive, task):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+    task.cancel()
+
+
+async def _send_json(send, status, payload):
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", b"application/json")]})
+    await send({"type": "http.response.body", "body": json.dumps(payload).encode()})
+
+
+async def chat(scope, receive, send):
+    body = await _read_body(receive)
+    if body is None:
+        return
+    if not _authorized(scope):
+        await _send_json(send, 401, {"error": "unauthorized"})
+        return
+    try:
+        data = json.loads(body or b"{}")
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        await _send_json(send, 400, {"error": "invalid JSON body"})
+        return
+    sid = _session(scope)
+    root = web.session_workspace(sid)
+    web.enter_workspace(root, sid)
+    loop = asyncio.get_running_loop()
+    # prepare_chat may walk the workspace (lazy context mode), so keep it off the loop
+    conv, error = await loop.run_in_executor(WSGI_EXECUTOR, functools.partial(
+        web.in_workspace, root, web.prepare_chat, data, session=sid))
+    await send({"type": "http.response.start", "status": 200, "headers": SSE_HEADERS})
+    if error:
+        await send({"type": "http.response.body", "body": web._sse({"type": "error", "content": error}).encode()})
+        return
+
+    async def pump():
+        async for frame in stream_chat(conv):
+            await send({"type": "http.response.body", "body": frame, "more_body": True})
+
+    task = asyncio.ensure_future(pump())
+    watcher = asyncio.ensure_future(_watch_disconnect(receive, task))
+    try:
+        await task
+    except asyncio.CancelledError:
+        if not task.cancelled():
+            raise
+        return
+    finally:
+        watcher.cancel()
+    await send({"type": "http.response.body", "body": b""})
+
+
+class _LoopQueue:
+    """A put()-able handle the watcher thread can publish into, feeding an asyncio.Queue."""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.queue = asyncio.Queue()
+
+    def put(self, item):
+        with contextlib.suppress(RuntimeError):  # loop already closed
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+
+
+async def file_events(scope, receive, send):
+    """Native twin of app.file_events, so open tabs don't each pin a WSGI_EXECUTOR thread."""
+    if not _authorized(scope):
+        await _send_json(send, 401, {"error": "unauthorized"})
+        return
+    sid = _session(scope)
+    loop = asyncio.get_running_loop()
+    q = _LoopQueue(loop)
+    # ensure_watcher may start a thread and take WATCH_LOCK; keep that off the loop
+    watcher, sub = await loop.run_in_executor(WSGI_EXECUTOR, web.watch_subscribe, sid,
+                                              web.session_workspace(sid), q)
+
+    async def pump():
+        await send({"type": "http.response.start", "status": 200, "headers": SSE_HEADERS})
+        ready = web._sse({"type": "ready", "backend": watcher["backend"]}).encode()
+        await send({"type": "http.response.body", "body": ready, "more_body": True})
+        while True:
+            try:
+                event = await asyncio.wait_for(q.queue.get(), web.WATCH_KEEPALIVE)
+            except asyncio.TimeoutError:
+                frame = b": keepalive\n\n"
+            else:
+                frame = web._sse(event).encode()
+            await send({"type": "http.response.body", "body": frame, "more_body": True})
+
+    task = asyncio.ensure_future(pump())
+    disconnect = asyncio.ensure_future(_watch_disconnect(receive, task))
+    try:
+        await task
+    except asyncio.CancelledError:
+        if not task.cancelled():
+            raise
+    finally:
+        disconnect.cancel()
+        web.watch_unsubscribe(sub)
+
+
+def _environ(scope, body):
+    headers = {}
+    for name, value in scope["headers"]:
+        key = name.decode("latin-1").upper().replace("-", "_")
+        if key not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            key = "HTTP_" + key
+        value = value.decode("latin-1")
+        headers[key] = f"{headers[key]},{value}" if key in headers else value
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": str(server[0]), "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0], "REMOTE_PORT": str(client[1]),
+        "wsgi.version": (1, 0), "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body), "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True, "wsgi.multiprocess": False, "wsgi.run_once": False,
+    }
+    environ.setdefault("CONTENT_LENGTH", str(len(body)))
+    environ.update(headers)
+    return environ
+
+
+async def wsgi(scope, receive, send):
+    """Serve one request with the Flask app on WSGI_EXECUTOR, streaming its body back."""
+    body = await _read_body(receive)
+    if body is None:
+        return
+    loop = asyncio.get_running_loop()
+    out = asyncio.Queue()
+    stop = threading.Event()
+
+    def start_response(status, headers, exc_info=None):
+        code = int(status.split(" ", 1)[0])
+        raw = [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers]
+        loop.call_soon_threadsafe(out.put_nowait, ("start", code, raw))
+
+    def run():
+        result = None
+        try:
+            result = web.app(_environ(scope, body), start_response)
+            for chunk in result:
+                if stop.is_set():
+                    break
+                if chunk:
+                    loop.call_soon_threadsafe(out.put_nowait, ("body", chunk))
+        except BaseException as e:  # surfaced to the event loop below
+            loop.call_soon_threadsafe(out.put_nowait, ("error", e))
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+            loop.call_soon_threadsafe(out.put_nowait, ("end",))
+
+    loop.run_in_executor(WSGI_EXECUTOR, run)
+    watcher = asyncio.ensure_future(_watch_disconnect(receive, asyncio.current_task()))
+    started = False
+    try:
+        while True:
+            item = await out.get()
+            if item[0] == "start":
+                await send({"type": "http.response.start", "status": item[1], "headers": item[2]})
+                started = True
+            elif item[0] == "body":
+                await send({"type": "http.response.body", "body": item[1], "more_body": True})
+            elif item[0] == "error":
+                if not started:
+                    await send({"type": "http.response.start", "status": 500,
+                                "headers": [(b"content-type", b"text/plain")]})
+                    await send({"type": "http.response.body", "body": b"Internal Server Error"})
+                return
+            else:
+                await send({"type": "http.response.body", "body": b""})
+                return
+    except asyncio.CancelledError:
+        return
+    finally:
+        # A streaming route notices the disconnect at its next chunk and exits
+        stop.set()
+        watcher.cancel()
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            _client()  # building the client loads the TLS context; pay that before the first chat
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            client = _clients.pop(asyncio.get_running_loop(), None)
+            if client is not None:
+                await client.aclose()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+    if scope["path"] == "/api/chat" and scope["method"] == "POST":
+        return await chat(scope, receive, send)
+    if scope["path"] == "/api/files/events" and scope["method"] == "GET":
+        return await file_events(scope, receive, send)
+    return await wsgi(scope, receive, send)
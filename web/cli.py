@@ -1,11 +1,92 @@
 """tetsuocode CLI — launch the AI coding assistant."""
 import argparse
+import atexit
 import os
+import shutil
 import sys
+import tempfile
 import webbrowser
 import threading
 
 
+def _remove_state_dir(path, owner):
+    # Forked workers inherit atexit hooks; only the process that created the dir removes it
+    if os.getpid() == owner:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def _shared_state():
+    """Point every worker process at one SQLite state file, removed on exit."""
+    state_dir = tempfile.mkdtemp(prefix="tetsuo-state-")
+    atexit.register(_remove_state_dir, state_dir, os.getpid())
+    os.environ["TETSUO_STATE_DB"] = os.path.join(state_dir, "state.db")
+
+
+def serve_asgi(host, port, workers):
+    """Run web.asgi under uvicorn: chat streams on an event loop, other routes on a thread pool."""
+    try:
+        import uvicorn
+    except ImportError:
+        print("Error: --asgi needs uvicorn and httpx: pip install 'tetsuocode[async]'")
+        sys.exit(1)
+    if workers > 1:
+        _shared_state()
+    uvicorn.run("web.asgi:app", host=host, port=port, workers=workers, log_level="warning",
+                timeout_graceful_shutdown=10)
+
+
+def serve(host, port, workers, threads):
+    """Run the app under a production WSGI server.
+
+    Several workers need gunicorn (POSIX only) and share settings through a
+    SQLite state file (edits already go through the workspace's journal); a
+    single worker prefers waitress, which also runs on Windows.
+    """
+    try:
+        import gunicorn  # noqa: F401
+        have_gunicorn = os.name != "nt"
+    except ImportError:
+        have_gunicorn = False
+    try:
+        import waitress
+    except ImportError:
+        waitress = None
+
+    if workers > 1 and not have_gunicorn:
+        print("Error: --workers > 1 needs gunicorn (Linux/macOS): pip install 'tetsuocode[server]'")
+        sys.exit(1)
+    if not have_gunicorn and waitress is None:
+        print("Error: no production server installed: pip install 'tetsuocode[server]'")
+        sys.exit(1)
+
+    if workers > 1:
+        _shared_state()
+
+    if waitress is not None and workers == 1:
+        from web.app import app
+        # send_bytes=1 so SSE frames go out as they are yielded instead of in 18 KB batches
+        waitress.serve(app, host=host, port=port, threads=threads, send_bytes=1,
+                       channel_timeout=300, ident="tetsuocode")
+        return
+
+    from gunicorn.app.base import BaseApplication
+
+    class Server(BaseApplication):
+        def load_config(self):
+            # gthread keeps long SSE streams on worker threads without blocking the heartbeat
+            for key, value in {"bind": f"{host}:{port}", "workers": workers, "threads": threads,
+                               "worker_class": "gthread", "timeout": 120, "graceful_timeout": 10,
+                               "keepalive": 5}.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            # Imported in each worker after fork so threads, pools and caches are per process
+            from web.app import app
+            return app
+
+    Server().run()
+
+
 def main():
     parser = argparse.ArgumentParser(
         prog="tetsuocode",
@@ -23,6 +104,12 @@ def main():
                         help="Set access password")
     parser.add_argument("--api-key", default="",
                         help="xAI API key (or set XAI_API_KEY env var)")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="Serve with a production WSGI server using N worker processes")
+    parser.add_argument("--threads", type=int, default=0,
+                        help="Threads per worker in production mode (default: 16)")
+    parser.add_argument("--asgi", action="store_true",
+                        help="Serve through the async engine (uvicorn); chat streams don't hold threads")
     parser.add_argument("--version", action="version", version="tetsuocode 1.0.0")
 
     args = parser.parse_args()
@@ -54,13 +141,18 @@ def main():
         except Exception as e:
             print(f"Warning: Failed to load .tetsuorc: {e}")
 
-    # Import app after env is set
-    from web.app import app
+    production = args.workers > 0 or args.threads > 0 or args.asgi
+    workers = max(1, args.workers)
+    threads = args.threads or 16
 
     url = f"http://{args.host}:{args.port}"
     print(f"\n  tetsuocode v1.0.0")
     print(f"  Workspace: {workspace}")
     print(f"  Running on {url}")
+    if args.asgi:
+        print(f"  Serving async with {workers} worker(s)")
+    elif production:
+        print(f"  Serving with {workers} worker(s) x {threads} thread(s)")
     print(f"  Press Ctrl+C to quit\n")
 
     # Auto-open browser
@@ -68,7 +160,14 @@ def main():
         threading.Timer(1.2, lambda: webbrowser.open(url)).start()
 
     try:
-        app.run(host=args.host, port=args.port, debug=False, use_reloader=False)
+        if args.asgi:
+            serve_asgi(args.host, args.port, workers)
+        elif production:
+            serve(args.host, args.port, workers, threads)
+        else:
+            # Import app after env is set
+            from web.app import app
+            app.run(host=args.host, port=args.port, debug=False, use_reloader=False, threaded=True)
     except KeyboardInterrupt:
         print("\nShutting down...")
 
@@ -222,18 +222,24 @@ function openWorkspaceSearch(){document.getElementById("wsearchOverlay").classLi
 function closeWorkspaceSearch(){document.getElementById("wsearchOverlay").classList.add("hidden")}
 function toggleWSearchReplace(){document.getElementById("wsearchReplace").classList.toggle("hidden");document.getElementById("wsearchActions").classList.toggle("hidden")}
 function debounceWSearch(){clearTimeout(wsearchDebounce);wsearchDebounce=setTimeout(doWorkspaceSearch,300)}
+let _wsearchAbort=null;
 async function doWorkspaceSearch(){
   const q=document.getElementById("wsearchQuery").value.trim();if(!q){document.getElementById("wsearchResults").innerHTML="";return}
   const cs=document.getElementById("wsearchCase").checked;const rx=document.getElementById("wsearchRegex").checked;
-  try{const r=await fetch(`/api/files/grep?q=${encodeURIComponent(q)}&case=${cs}&regex=${rx}`);const d=await r.json();
-    if(d.error){document.getElementById("wsearchResults").innerHTML=`<div class="wsearch-msg">${escapeHtml(d.error)}</div>`;return}
-    const results=document.getElementById("wsearchResults");
-    document.getElementById("wsearchSummary").textContent=`${d.count} results`;
-    if(!d.results.length){results.innerHTML='<div class="wsearch-msg">no results</div>';return}
-    // Group by file
-    const grouped={};d.results.forEach(r=>{(grouped[r.file]=grouped[r.file]||[]).push(r)});
-    results.innerHTML=Object.entries(grouped).map(([file,matches])=>`<div class="wsearch-file"><div class="wsearch-file-name" onclick="this.nextElementSibling.classList.toggle('hidden')">${escapeHtml(file)} <span class="wsearch-file-count">(${matches.length})</span></div><div class="wsearch-file-matches">${matches.map(m=>`<div class="wsearch-match" onclick="openInEditor('${m.path.replace(/'/g,"\\'")}')"><span class="wsearch-line-num">${m.line}</span><span>${escapeHtml(m.text)}</span></div>`).join("")}</div></div>`).join("")
-  }catch(e){document.getElementById("wsearchResults").innerHTML='<div class="wsearch-msg">search failed</div>'}
+  if(_wsearchAbort)_wsearchAbort.abort();const ctrl=_wsearchAbort=new AbortController();
+  const results=document.getElementById("wsearchResults");const summary=document.getElementById("wsearchSummary");
+  try{const r=await fetch(`/api/files/grep?q=${encodeURIComponent(q)}&case=${cs}&regex=${rx}&stream=true`,{signal:ctrl.signal});
+    if(!r.ok){const d=await r.json().catch(()=>({}));results.innerHTML=`<div class="wsearch-msg">${escapeHtml(d.error||"search failed")}</div>`;return}
+    results.innerHTML="";summary.textContent="searching...";let count=0;
+    const reader=r.body.getReader();const decoder=new TextDecoder();let buffer="";
+    while(true){const{done,value}=await reader.read();if(done)break;buffer+=decoder.decode(value,{stream:true});const lines=buffer.split("\n");buffer=lines.pop();
+      for(const line of lines){if(!line.startsWith("data: "))continue;let d;try{d=JSON.parse(line.slice(6))}catch(e){continue}
+        if(d.type==="file"){count+=d.matches.length;summary.textContent=`${count} results`;
+          results.insertAdjacentHTML("beforeend",`<div class="wsearch-file"><div class="wsearch-file-name" onclick="this.nextElementSibling.classList.toggle('hidden')">${escapeHtml(d.file)} <span class="wsearch-file-count">(${d.matches.length})</span></div><div class="wsearch-file-matches">${d.matches.map(m=>`<div class="wsearch-match" onclick="openInEditor('${d.path.replace(/'/g,"\\'")}')"><span class="wsearch-line-num">${m.line}</span><span>${escapeHtml(m.text)}</span></div>`).join("")}</div></div>`)}
+        else if(d.type==="done"){summary.textContent=`${d.count}${d.truncated?"+":""} results`;if(!d.count)results.innerHTML='<div class="wsearch-msg">no results</div>'}
+        else if(d.type==="error"){results.innerHTML=`<div class="wsearch-msg">${escapeHtml(d.content)}</div>`}}}
+  }catch(e){if(e.name!=="AbortError")results.innerHTML='<div class="wsearch-msg">search failed</div>'}
+  finally{if(_wsearchAbort===ctrl)_wsearchAbort=null}
 }
 async function replaceAllWorkspace(){
   const q=document.getElementById("wsearchQuery").value.trim();const rep=document.getElementById("wsearchReplace").value;
@@ -288,7 +294,7 @@ function insertMention(path){if(!mentionSearch)return;const val=inputEl.value;co
 function switchTab(tab){["chats","files","git","outline"].forEach(t=>{document.getElementById("tab"+t.charAt(0).toUpperCase()+t.slice(1)).classList.toggle("active",t===tab);document.getElementById("panel"+t.charAt(0).toUpperCase()+t.slice(1)).classList.toggle("hidden",t!==tab)});if(tab==="files")loadFileTree();if(tab==="git")loadGitStatus();if(tab==="outline")loadOutline()}
 async function loadFileTree(path){try{const url=path?`/api/files/list?path=${encodeURIComponent(path)}`:"/api/files/list";const r=await fetch(url);const d=await r.json();document.getElementById("workspacePath").textContent=d.path;if(!path){document.getElementById("fileTree").innerHTML="";renderFileEntries(d.entries,document.getElementById("fileTree"),0)}return d}catch(e){}}
 function renderFileEntries(entries,container,depth){for(const e of entries){const item=document.createElement("div");item.className="file-item"+(e.type==="dir"?" dir":"");item.style.paddingLeft=(12+depth*16)+"px";item.setAttribute("tabindex","0");item.setAttribute("data-path",e.path);const selectBox=e.type==="file"?`<input type="checkbox" class="file-checkbox" onclick="event.stopPropagation();toggleFileSelect('${e.path.replace(/'/g,"\\'")}',this)" ${selectedFiles.has(e.path)?"checked":""}> `:"";item.innerHTML=`${selectBox}<span class="file-icon">${e.type==="dir"?"&#9656;":"&#9671;"}</span><span class="file-name">${escapeHtml(e.name)}</span>`;if(e.type==="dir"){let loaded=false;const ch=document.createElement("div");ch.className="file-children hidden";item.onclick=async(ev)=>{ev.stopPropagation();if(!loaded){const d=await loadFileTree(e.path);if(d&&d.entries)renderFileEntries(d.entries,ch,depth+1);loaded=true}ch.classList.toggle("hidden");item.querySelector(".file-icon").innerHTML=ch.classList.contains("hidden")?"&#9656;":"&#9662;"};container.appendChild(item);container.appendChild(ch)}else{item.onclick=()=>openInEditor(e.path);container.appendChild(item)}item.addEventListener("keydown",(ev)=>{if(ev.key==="j"||ev.key==="ArrowDown"){ev.preventDefault();const next=item.nextElementSibling;if(next&&next.classList.contains("file-item"))next.focus();else if(next&&next.nextElementSibling)next.nextElementSibling.focus()}if(ev.key==="k"||ev.key==="ArrowUp"){ev.preventDefault();const prev=item.previousElementSibling;if(prev&&prev.classList.contains("file-item"))prev.focus();else if(prev&&prev.previousElementSibling&&prev.previousElementSibling.classList.contains("file-item"))prev.previousElementSibling.focus()}if(ev.key==="Enter"){ev.preventDefault();item.click()}})}}
-async function changeWorkspace(){const p=prompt("Enter workspace path:");if(!p)return;try{const r=await fetch("/api/workspace",{method:"POST",headers:{"Content-Type":"application/json"},body:JSON.stringify({path:p})});const d=await r.json();if(d.workspace)loadFileTree();else alert(d.error||"Failed")}catch(e){alert("Failed")}}
+async function changeWorkspace(){const p=prompt("Enter workspace path:");if(!p)return;try{const r=await fetch("/api/workspace",{method:"POST",headers:{"Content-Type":"application/json"},body:JSON.stringify({path:p})});const d=await r.json();if(d.workspace){loadFileTree();restartFileWatcher()}else alert(d.error||"Failed")}catch(e){alert("Failed")}}
 function toggleFileSelect(path,cb){if(cb.checked)selectedFiles.add(path);else selectedFiles.delete(path);const bar=document.getElementById("fileSelectBar");document.getElementById("fileSelectCount").textContent=`${selectedFiles.size} selected`;if(selectedFiles.size>0)bar.classList.remove("hidden");else bar.classList.add("hidden")}
 function clearFileSelection(){selectedFiles.clear();document.querySelectorAll(".file-checkbox").forEach(cb=>cb.checked=false);document.getElementById("fileSelectBar").classList.add("hidden")}
 async function attachSelectedFiles(){
@@ -460,8 +466,8 @@ function removeToolThinking(){const el=document.querySelector("#streamingMessage
 function renderDiff(diff){if(!diff)return"";return`<div class="diff-side-by-side">${renderSideBySide(diff)}</div>`}
 function renderSideBySide(diff){const lines=diff.split("\n");let left=[],right=[];for(const line of lines){if(line.startsWith("---")||line.startsWith("+++"))continue;if(line.startsWith("@@")){left.push({type:"hunk",text:line});right.push({type:"hunk",text:line});continue}if(line.startsWith("-")){left.push({type:"del",text:line.slice(1)});right.push({type:"empty",text:""})}else if(line.startsWith("+")){left.push({type:"empty",text:""});right.push({type:"add",text:line.slice(1)})}else{left.push({type:"ctx",text:line.slice(1)||line});right.push({type:"ctx",text:line.slice(1)||line})}}const renderCol=(col)=>col.map(l=>`<div class="diff-line diff-${l.type}">${escapeHtml(l.text)}</div>`).join("");return`<div class="diff-col">${renderCol(left)}</div><div class="diff-col">${renderCol(right)}</div>`}
 // formatToolOutput moved below (approval flow version)
-function addToolCall(name,args){const sm=document.getElementById("streamingMessage");if(!sm)return;removeToolThinking();const b=sm.querySelector(".message-body");const div=document.createElement("div");div.className="tool-call";let preview=args;try{preview=JSON.stringify(JSON.parse(args),null,2)}catch(e){}if(preview.length>200)preview=preview.slice(0,200)+"...";div.innerHTML=`<div class="tool-call-header" onclick="this.parentElement.classList.toggle('collapsed')"><span class="tool-collapse-icon">&#9660;</span><span class="tool-name">${escapeHtml(name)}</span><span class="tool-status">running</span></div><div class="tool-call-body"><code>${escapeHtml(preview)}</code></div>`;b.appendChild(div);showToolThinking();scrollToBottom()}
-function addToolResult(name,result){const sm=document.getElementById("streamingMessage");if(!sm)return;removeToolThinking();const divs=sm.querySelectorAll(".tool-call");if(divs.length){const last=divs[divs.length-1];let preview=result;if(preview.length>1000)preview=preview.slice(0,1000)+"...";last.querySelector(".tool-call-body").innerHTML=`<code>${formatToolOutput(preview)}</code>`;const st=last.querySelector(".tool-status");if(st)st.textContent="done";last.classList.add("collapsed")}showToolThinking();scrollToBottom()}
+function addToolCall(name,args,id){const sm=document.getElementById("streamingMessage");if(!sm)return;removeToolThinking();const b=sm.querySelector(".message-body");const div=document.createElement("div");div.className="tool-call";if(id)div.dataset.callId=id;let preview=args;try{preview=JSON.stringify(JSON.parse(args),null,2)}catch(e){}if(preview.length>200)preview=preview.slice(0,200)+"...";div.innerHTML=`<div class="tool-call-header" onclick="this.parentElement.classList.toggle('collapsed')"><span class="tool-collapse-icon">&#9660;</span><span class="tool-name">${escapeHtml(name)}</span><span class="tool-status">running</span></div><div class="tool-call-body"><code>${escapeHtml(preview)}</code></div>`;b.appendChild(div);showToolThinking();scrollToBottom()}
+function addToolResult(name,result,id){const sm=document.getElementById("streamingMessage");if(!sm)return;removeToolThinking();const divs=sm.querySelectorAll(".tool-call");const match=id?[...divs].find(d=>d.dataset.callId===id):null;if(match||divs.length){const last=match||divs[divs.length-1];let preview=result;if(preview.length>1000)preview=preview.slice(0,1000)+"...";last.querySelector(".tool-call-body").innerHTML=`<code>${formatToolOutput(preview)}</code>`;const st=last.querySelector(".tool-status");if(st)st.textContent="done";last.classList.add("collapsed")}showToolThinking();scrollToBottom()}
 function playNotification(){if(!settings.sound)return;try{const ctx=new(window.AudioContext||window.webkitAudioContext)();const o=ctx.createOscillator();const g=ctx.createGain();o.connect(g);g.connect(ctx.destination);o.frequency.value=660;g.gain.value=0.08;o.start();o.stop(ctx.currentTime+0.12)}catch(e){}}
 
 // ── Chat ──────────────────────────────
@@ -479,20 +485,21 @@ async function sendMessage(retryText){
     }
     contextText=await attachContext(contextText);
     addMessage("user",text,false,Date.now(),messages.length);
-    messages.push({role:"user",content:contextText,timestamp:Date.now()});
+    const images=pendingImages.map(img=>img.id);pendingImages=[];
+    messages.push({role:"user",content:contextText,timestamp:Date.now(),...(images.length?{images}:{})});
     checkContextBudget();
   }
   if(messages.filter(m=>m.role==="user").length===1)chatTitleEl.textContent=text.length>40?text.slice(0,40)+"...":text;
   inputEl.value="";inputEl.style.height="auto";streaming=true;sendBtn.classList.add("hidden");cancelBtn.classList.remove("hidden");
   const streamMsg=addThinking();const body=streamMsg.querySelector(".message-body");let fullContent="";let hadError=false;abortController=new AbortController();
-  try{const model=document.getElementById("modelSelect").value;const payload={messages,model,provider:settings.provider,context_mode:settings.contextMode||"smart"};if(settings.temperature!==0.7)payload.temperature=settings.temperature;if(settings.max_tokens!==4096)payload.max_tokens=settings.max_tokens;if(settings.system_prompt)payload.system_prompt=settings.system_prompt;if(settings.api_key)payload.api_key=settings.api_key;if(pendingImages.length){payload.images=pendingImages.slice();pendingImages=[]}
+  try{const model=document.getElementById("modelSelect").value;const payload={messages,model,provider:settings.provider,context_mode:settings.contextMode||"smart"};if(settings.temperature!==0.7)payload.temperature=settings.temperature;if(settings.max_tokens!==4096)payload.max_tokens=settings.max_tokens;if(settings.system_prompt)payload.system_prompt=settings.system_prompt;if(settings.api_key)payload.api_key=settings.api_key;
     const resp=await fetch("/api/chat",{method:"POST",headers:{"Content-Type":"application/json"},body:JSON.stringify(payload),signal:abortController.signal});if(!resp.ok)throw new Error(`server returned ${resp.status}`);
     const reader=resp.body.getReader();const decoder=new TextDecoder();let buffer="";
     while(true){const{done,value}=await reader.read();if(done)break;buffer+=decoder.decode(value,{stream:true});const lines=buffer.split("\n");buffer=lines.pop();
       for(const line of lines){if(!line.startsWith("data: "))continue;let data;try{data=JSON.parse(line.slice(6))}catch(e){continue}
         if(data.type==="content"){if(!fullContent)body.innerHTML="";removeToolThinking();fullContent+=data.content;scheduleStreamRender(body,fullContent);scrollToBottom()}
-        else if(data.type==="tool_call"){if(!fullContent)body.innerHTML="";addToolCall(data.name,data.args)}
-        else if(data.type==="tool_result"){addToolResult(data.name,data.result)}
+        else if(data.type==="tool_call"){if(!fullContent)body.innerHTML="";addToolCall(data.name,data.args,data.id)}
+        else if(data.type==="tool_result"){addToolResult(data.name,data.result,data.id)}
         else if(data.type==="usage"){totalTokens.prompt+=data.usage.prompt_tokens||0;totalTokens.completion+=data.usage.completion_tokens||0;totalTokens.total+=data.usage.total_tokens||0;updateTokenDisplay()}
         else if(data.type==="error"){removeToolThinking();hadError=true;body.innerHTML=`<span class="error-text">${escapeHtml(data.content)}</span><button class="retry-btn" onclick="retryLast()">retry</button>`}
         else if(data.type==="done"){removeToolThinking()}}}
@@ -530,7 +537,7 @@ function formatToolOutput(raw){
       return renderDiff(p.diff)+`<div class="diff-meta diff-pending">${escapeHtml(p.path||"")}<button class="approve-btn" onclick="approveEdit('${p.pending_id}')">apply</button><button class="reject-btn" onclick="rejectEdit('${p.pending_id}')">reject</button><span class="pending-badge">pending</span></div>`;
     }
     if(p.diff){const revertBtn=p.path?`<button class="revert-btn" onclick="undoLastEdit()">revert</button>`:"";return renderDiff(p.diff)+`<div class="diff-meta">${escapeHtml(p.path||"")}${revertBtn}</div>`}
-    if(p.image&&p.data)return`<img src="data:${p.mime};base64,${p.data}" style="max-width:100%;border-radius:4px">`;
+    if(p.image&&p.url)return`<img src="${escapeHtml(p.url)}" style="max-width:100%;border-radius:4px" loading="lazy">`;
     return escapeHtml(JSON.stringify(p,null,2))
   }catch(e){return escapeHtml(raw)}
 }
@@ -567,20 +574,23 @@ function syncEditorScroll(){
 }
 
 // ── File Watcher ──────────────────────────
-let _watcherInterval=null;
+let _watcherSource=null;
 function startFileWatcher(){
-  if(_watcherInterval)return;
-  _watcherInterval=setInterval(async()=>{
-    if(!editorTabs.length)return;
-    const paths=editorTabs.map(t=>t.path);
-    try{const r=await fetch("/api/files/mtime",{method:"POST",headers:{"Content-Type":"application/json"},body:JSON.stringify({paths})});
-      const d=await r.json();
-      for(const c of d.changed||[]){
-        const tab=editorTabs.find(t=>t.path===c.path);
-        if(tab&&tab.content===tab.original){refreshEditorTab(c.path);showNotification(c.path.split("/").pop()+" changed on disk")}
-      }
-    }catch(e){}
-  },3000);
+  if(_watcherSource||!window.EventSource)return;
+  _watcherSource=new EventSource("/api/files/events");
+  _watcherSource.onmessage=(ev)=>{
+    let c;try{c=JSON.parse(ev.data)}catch(e){return}
+    // resync: the server lost events, so any clean tab may be stale
+    if(c.type==="resync"){editorTabs.filter(t=>t.content===t.original).forEach(t=>refreshEditorTab(t.path));return}
+    if(c.type!=="change")return;
+    const tab=editorTabs.find(t=>t.path===c.path);
+    if(tab&&tab.content===tab.original){refreshEditorTab(c.path);showNotification(c.path.split("/").pop()+" changed on disk")}
+  };
+}
+// The stream is bound to the workspace it was opened in
+function restartFileWatcher(){
+  if(_watcherSource){_watcherSource.close();_watcherSource=null}
+  startFileWatcher();
 }
 
 // ── Streaming Terminal ──────────────────────
@@ -647,10 +657,10 @@ async function uploadFile(file){
   const f=new FormData();f.append("file",file);
   try{const r=await fetch("/api/upload",{method:"POST",body:f});const d=await r.json();
     if(d.image){
-      pendingImages.push({mime:d.mime,data:d.data,filename:d.filename});
+      pendingImages.push({id:d.id,mime:d.mime,filename:d.filename});
       inputEl.value+=`\n[Image attached: ${d.filename}]`;
       showNotification("Image attached — will be sent with next message");
-    }else if(d.content){inputEl.value+=`\n\`\`\`\n// ${d.filename}\n${d.content.slice(0,5000)}\n\`\`\`\n`}
+    }else if(d.content){inputEl.value+=`\n\`\`\`\n// ${d.filename}\n${d.content.slice(0,5000)}\n\`\`\`\n`}else if(d.error){showNotification(d.error)}
     inputEl.focus();inputEl.style.height=Math.min(inputEl.scrollHeight,200)+"px";
   }catch(e){alert("Upload failed")}
 }
@@ -699,20 +709,22 @@ async function removeMcpServer(name){
 }
 
 // ── Ghost Text / Inline Completions ──────────────
-let _ghostDebounce=null,_ghostText="";
+let _ghostDebounce=null,_ghostText="",_ghostAbort=null;const _ghostSession=Math.random().toString(36).slice(2);
 function setupGhostText(){
   const ed=document.getElementById("editorContent");
-  ed.addEventListener("input",()=>{clearTimeout(_ghostDebounce);_ghostText="";updateGhostDisplay();_ghostDebounce=setTimeout(fetchGhostCompletion,1200)});
+  ed.addEventListener("input",()=>{clearTimeout(_ghostDebounce);if(_ghostAbort)_ghostAbort.abort();_ghostText="";updateGhostDisplay();_ghostDebounce=setTimeout(fetchGhostCompletion,1200)});
   ed.addEventListener("keydown",(e)=>{if(e.key==="Tab"&&_ghostText){e.preventDefault();acceptGhostText();return}if(e.key==="Escape"&&_ghostText){_ghostText="";updateGhostDisplay()}});
 }
 async function fetchGhostCompletion(){
   const ed=document.getElementById("editorContent");const active=editorTabs.find(t=>t.active);
   if(!active||!ed.value||ed.value.length<20)return;
   const line=ed.value.substring(0,ed.selectionStart).split("\n").length;
-  try{const r=await fetch("/api/complete",{method:"POST",headers:{"Content-Type":"application/json"},
-    body:JSON.stringify({code:ed.value,line,path:active.path,provider:settings.provider,api_key:settings.api_key,model:document.getElementById("modelSelect").value})});
-    const d=await r.json();if(d.completion&&d.completion.length>2){_ghostText=d.completion;updateGhostDisplay()}
+  if(_ghostAbort)_ghostAbort.abort();const ctrl=_ghostAbort=new AbortController();
+  try{const r=await fetch("/api/complete",{method:"POST",headers:{"Content-Type":"application/json"},signal:ctrl.signal,
+    body:JSON.stringify({code:ed.value,line,cursor:ed.selectionStart,session:`${_ghostSession}:${active.path}`,path:active.path,provider:settings.provider,api_key:settings.api_key,model:document.getElementById("modelSelect").value})});
+    const d=await r.json();if(!d.stale&&d.completion&&d.completion.length>2){_ghostText=d.completion;updateGhostDisplay()}
   }catch(e){}
+  finally{if(_ghostAbort===ctrl)_ghostAbort=null}
 }
 function acceptGhostText(){
   if(!_ghostText)return;const ed=document.getElementById("editorContent");
@@ -753,16 +765,30 @@ async function runTestCmd(cmd){
 }
 
 // ── Git Blame & File History ──────────────────────
-let blameVisible=false;
+// The gutter is a spacer as tall as the file holding rows for just the visible window (plus a margin),
+// re-rendered as the editor scrolls, so a huge file costs a few hundred DOM nodes
+let blameVisible=false,blamePath=null,blameRange=null,blameTimer=null,blameScrollBound=false;
+const BLAME_LINE_PX=13*1.6,BLAME_MARGIN=100;
+function blameRow(b){return`<div class="blame-line" title="${escapeHtml(b.summary||'')}"><span class="blame-author">${escapeHtml((b.author||'').slice(0,10))}</span> <span class="blame-hash">${b.hash||''}</span></div>`}
+async function loadBlameWindow(){
+  const ed=document.getElementById("editorContent");const gutter=document.getElementById("blameGutter");
+  const active=editorTabs.find(t=>t.active);if(!blameVisible||!active)return;
+  const first=Math.floor(ed.scrollTop/BLAME_LINE_PX)+1;const start=Math.max(1,first-BLAME_MARGIN);const end=first+Math.ceil(ed.clientHeight/BLAME_LINE_PX)+BLAME_MARGIN;
+  if(blamePath===active.path&&blameRange&&start>=blameRange[0]&&Math.min(end,blameRange[2])<=blameRange[1])return;
+  const r=await fetch(`/api/git/blame?path=${encodeURIComponent(active.path)}&start=${start}&end=${end}`);const d=await r.json();
+  if(d.error){showNotification(d.error,"error");blameVisible=false;gutter.classList.add("hidden");return}
+  const top=d.blame.length?d.blame[0].line:d.start;
+  gutter.innerHTML=`<div class="blame-spacer" style="height:${d.total*BLAME_LINE_PX}px"><div class="blame-window" style="top:${(top-1)*BLAME_LINE_PX}px">${d.blame.map(blameRow).join("")}</div></div>`;
+  blamePath=active.path;blameRange=[top,top+d.blame.length-1,d.total];
+  gutter.classList.remove("hidden");gutter.scrollTop=ed.scrollTop;
+}
 async function toggleGitBlame(){
   blameVisible=!blameVisible;const gutter=document.getElementById("blameGutter");
-  if(!blameVisible){gutter.classList.add("hidden");gutter.innerHTML="";return}
-  const active=editorTabs.find(t=>t.active);if(!active){blameVisible=false;return}
-  try{const r=await fetch(`/api/git/blame?path=${encodeURIComponent(active.path)}`);const d=await r.json();
-    if(d.error){showNotification(d.error,"error");blameVisible=false;return}
-    gutter.classList.remove("hidden");
-    gutter.innerHTML=(d.blame||[]).map(b=>`<div class="blame-line" title="${escapeHtml(b.summary||'')}"><span class="blame-author">${escapeHtml((b.author||'').slice(0,10))}</span> <span class="blame-hash">${b.hash||''}</span></div>`).join("");
-  }catch(e){blameVisible=false}
+  if(!blameVisible){gutter.classList.add("hidden");gutter.innerHTML="";blamePath=null;blameRange=null;return}
+  if(!editorTabs.find(t=>t.active)){blameVisible=false;return}
+  if(!blameScrollBound){blameScrollBound=true;const ed=document.getElementById("editorContent");
+    ed.addEventListener("scroll",()=>{if(!blameVisible)return;gutter.scrollTop=ed.scrollTop;clearTimeout(blameTimer);blameTimer=setTimeout(loadBlameWindow,150)})}
+  try{await loadBlameWindow()}catch(e){blameVisible=false}
 }
 async function showFileHistory(){
   const active=editorTabs.find(t=>t.active);if(!active)return;